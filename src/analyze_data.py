@@ -3,16 +3,16 @@ Analyses real data in all-data directory. Outputs csvs for
 plotting in plot.py
 """
 import argparse
+import collections
 import csv
 import os.path
 import json
-import itertools
-import operator
 import pickle
 
 import numpy as np
 import pandas as pd
 import pyreadr
+import scipy.sparse
 
 import tskit
 import tsinfer
@@ -20,6 +20,8 @@ import tsdate
 
 from tqdm import tqdm
 
+import constants
+import edge_index
 import utility
 import tmrcas
 
@@ -170,54 +172,86 @@ def tgp_date_estimates(args):
 
 def get_site_frequencies(ts):
     """
-    Calculate frequency of each site and return numpy 1d array of len num_mutations
-    with frequency as values. This assumes that if there are multiple mutations at a
-    site they are recurrent.
+    Calculate frequency of each site and return numpy 1d array of len num_sites
+    with the frequency of derived alleles as values, computed from the tree topology
+    (see utility.derived_allele_frequencies()).
     """
-    site_freq = np.zeros(ts.num_sites)
-    for var in tqdm(ts.variants(), total=ts.num_sites, desc="Get mutation frequencies"):
-        site_freq[var.site.id] = np.sum(var.genotypes) / ts.num_samples
-    return site_freq
+    return utility.derived_allele_frequencies(ts)
+
+
+def get_mutation_parents(ts):
+    """
+    Return the parent of the node of each mutation in the tree at the mutation's
+    site, or tskit.NULL if it is a root, by looking up the edge above the node which
+    spans the site position
+    """
+    tables = ts.tables
+    edges = tables.edges
+    positions = tables.sites.position[tables.mutations.site]
+    nodes = tables.mutations.node
+    # Sort edges by child then left, and give every edge and mutation an integer key
+    # in the same order, replacing coordinates by their rank
+    order = np.lexsort((edges.left, edges.child))
+    child = edges.child[order]
+    coords = np.unique(np.concatenate([edges.left, positions]))
+    edge_keys = child.astype(np.int64) * len(coords) + np.searchsorted(
+        coords, edges.left[order]
+    )
+    mut_keys = nodes.astype(np.int64) * len(coords) + np.searchsorted(
+        coords, positions
+    )
+    index = np.searchsorted(edge_keys, mut_keys, side="right") - 1
+    found = index >= 0
+    found[found] = np.logical_and(
+        child[index[found]] == nodes[found],
+        edges.right[order][index[found]] > positions[found],
+    )
+    parents = np.full(ts.num_mutations, tskit.NULL, dtype=np.int32)
+    parents[found] = edges.parent[order][index[found]]
+    return parents
 
 
 def get_mut_ages(ts, unconstrained=True, ignore_sample_muts=False, geometric=True):
     # Get age of oldest mutations associated with a site, ignoring mutations below oldest root
-    mut_ages = np.zeros(ts.num_sites)
-    mut_upper_bounds = np.zeros(ts.num_sites)
-    node_ages = ts.tables.nodes.time
-    oldest_mut_ids = np.zeros(ts.num_sites)
+    node_ages = ts.tables.nodes.time.copy()
     if unconstrained:
+        is_sample = np.zeros(ts.num_nodes, dtype=bool)
+        is_sample[ts.samples()] = True
         metadata = ts.tables.nodes.metadata[:]
         metadata_offset = ts.tables.nodes.metadata_offset[:]
         for index, met in enumerate(tskit.unpack_bytes(metadata, metadata_offset)):
-            if index not in ts.samples():
+            if not is_sample[index]:
                 node_ages[index] = json.loads(met.decode())["mn"]
-    if ignore_sample_muts:
-        mutations_table = ts.tables.mutations
-        unique_sites = np.unique(ts.tables.mutations.site, return_counts=True)
-        unique_sites = unique_sites[0][unique_sites[1] > 1]
-        no_samp_muts = ~np.logical_and(
-            np.isin(mutations_table.site, unique_sites),
-            np.isin(mutations_table.node, ts.samples()),
-        )
-    samples = set(ts.samples())
-    for tree in tqdm(ts.trees(), total=ts.num_trees, desc="Finding mutation ages"):
-        for site in tree.sites():
-            for mut in site.mutations:
-                parent_age = node_ages[tree.parent(mut.node)]
-                if geometric:
-                    age = np.sqrt(node_ages[mut.node] * parent_age)
-                else:
-                    age = (node_ages[mut.node] + parent_age) / 2
-                if mut_ages[site.id] < age:
-                    if tree.parent(mut.node) == ts.num_nodes - 1:
-                        mut_upper_bounds[site.id] = np.nan
-                        mut_ages[site.id] = np.nan
-                        oldest_mut_ids[site.id] = np.nan
-                    else:
-                        mut_upper_bounds[site.id] = parent_age
-                        mut_ages[site.id] = age
-                        oldest_mut_ids[site.id] = mut.id
+    mutations = ts.tables.mutations
+    parents = get_mutation_parents(ts)
+    # As in a tree, a parent of tskit.NULL takes the age of the last node
+    parent_ages = node_ages[parents]
+    if geometric:
+        ages = np.sqrt(node_ages[mutations.node] * parent_ages)
+    else:
+        ages = (node_ages[mutations.node] + parent_ages) / 2
+    # Mutations older than all earlier ones at their site. The last of these is the
+    # oldest, but a site is excluded if any of them is directly below the root. NaN
+    # ages (from negative unconstrained times) are skipped, so the running maximum
+    # is carried over them.
+    running_max = pd.Series(ages).groupby(mutations.site).cummax()
+    running_max = running_max.groupby(mutations.site).ffill()
+    previous_max = running_max.groupby(mutations.site).shift(1).fillna(0)
+    oldest = np.where(ages > np.maximum(previous_max.values, 0))[0]
+    oldest_sites = mutations.site[oldest]
+    last = np.append(oldest_sites[1:] != oldest_sites[:-1], True)
+    below_root = np.zeros(ts.num_sites, dtype=bool)
+    below_root[oldest_sites[parents[oldest] == ts.num_nodes - 1]] = True
+
+    mut_ages = np.zeros(ts.num_sites)
+    mut_upper_bounds = np.zeros(ts.num_sites)
+    oldest_mut_ids = np.zeros(ts.num_sites)
+    mut_ages[oldest_sites[last]] = ages[oldest[last]]
+    mut_upper_bounds[oldest_sites[last]] = parent_ages[oldest[last]]
+    oldest_mut_ids[oldest_sites[last]] = oldest[last]
+    mut_ages[below_root] = np.nan
+    mut_upper_bounds[below_root] = np.nan
+    oldest_mut_ids[below_root] = np.nan
     return mut_ages, mut_upper_bounds, oldest_mut_ids.astype(int)
 
 
@@ -272,40 +306,27 @@ def get_recurrent_mutations(ts):
     Get number of mutations per site.
     """
     mutations_sites = ts.tables.mutations.site
-    muts_per_site = np.unique(mutations_sites, return_counts=True)[1]
-    sites_by_muts = np.unique(muts_per_site, return_counts=True)[1]
+    num_samples = utility.mutation_num_samples(ts)
+
+    def sites_by_num_mutations(sites):
+        muts_per_site = np.unique(sites, return_counts=True)[1]
+        return np.unique(muts_per_site, return_counts=True)[1]
 
+    sites_by_muts = sites_by_num_mutations(mutations_sites)
     # Exclude mutations above samples, this is simplier as there are no singletons
-    mutations_sites = mutations_sites[~np.isin(ts.tables.mutations.node, ts.samples())]
-    muts_per_site = np.unique(mutations_sites, return_counts=True)[1]
-    sites_by_muts_nosamples = np.unique(muts_per_site, return_counts=True)[1]
+    is_sample = np.zeros(ts.num_nodes, dtype=bool)
+    is_sample[ts.samples()] = True
+    non_sample = ~is_sample[ts.tables.mutations.node]
+    sites_by_muts_nosamples = sites_by_num_mutations(mutations_sites[non_sample])
     # Exclude mutations above two samples
-    muts_non_sample_edge = np.where(~np.isin(ts.tables.mutations.node, ts.samples()))[0]
-    mut_sites_nodouble = list()
-    for tree in ts.trees():
-        for site in tree.sites():
-            for mutation in site.mutations:
-                if tree.num_samples(mutation.node) > 2:
-                    mut_sites_nodouble.append(mutation.site)
-    unique_sites_counts_nodouble = np.unique(
-        np.array(mut_sites_nodouble), return_counts=True
-    )[1]
-    sites_by_muts_nodouble = np.unique(
-        unique_sites_counts_nodouble, return_counts=True
-    )[1]
+    sites_by_muts_nodouble = sites_by_num_mutations(mutations_sites[num_samples > 2])
 
     # Tips below mutations at sites with two mutations
-    two_mutations_id = set(
-        muts_non_sample_edge[
-            np.where(np.unique(mutations_sites, return_counts=True)[1] == 2)[0]
-        ]
-    )
-    num_samples_muts = list()
-    for tree in ts.trees():
-        for site in tree.sites():
-            for mutation in site.mutations:
-                if mutation.id in two_mutations_id:
-                    num_samples_muts.append(tree.num_samples(mutation.node))
+    non_sample_sites = mutations_sites[non_sample]
+    muts_per_site = np.bincount(non_sample_sites, minlength=ts.num_sites)
+    two_mutations = non_sample.copy()
+    two_mutations[non_sample] = muts_per_site[non_sample_sites] == 2
+    num_samples_muts = num_samples[two_mutations]
 
     return (
         sites_by_muts,
@@ -341,54 +362,59 @@ def get_unified_recurrent_mutations(args):
 
 
 class AncestralGeography:
+    """
+    Locate each ancestral node at the geographic center of its children, working
+    back in time from the sample locations. Parents are processed in batches of
+    consecutive parent times, each containing no parent of another node in the
+    batch, so that every batch only needs the locations of earlier batches.
+    """
+
     def __init__(self, ts):
         self.ts = ts
-        self.fixed_nodes = set(ts.samples())
+        self.fixed_nodes = np.zeros(ts.num_nodes, dtype=bool)
+        self.fixed_nodes[ts.samples()] = True
         self.locations = np.zeros((self.ts.num_nodes, 2))
 
-    def get_parent_age(self, edge):
-        times = self.ts.tables.nodes.time[:]
-        return times[operator.attrgetter("parent")(edge)]
-
-    def edges_by_parent_age_asc(self):
-        return itertools.groupby(self.ts.edges(), self.get_parent_age)
-
     def edges_by_parent_asc(self):
         """
-        Return an itertools.groupby object of edges grouped by parent in ascending order
-        of the time of the parent. Since tree sequence properties guarantee that edges
-        are listed in nondecreasing order of parent time
+        Return arrays of the parent, child and span of each edge sorted by the time
+        of the parent, and the index of the first edge of each parent in them. Since
+        tree sequence properties guarantee that edges are listed in nondecreasing
+        order of parent time, with the edges of each parent together
         (https://tskit.readthedocs.io/en/latest/data-model.html#edge-requirements)
         we can simply use the standard edge order
         """
-        return itertools.groupby(self.ts.edges(), operator.attrgetter("parent"))
-
-    def parents_in_epoch(parents):
-        return itertools.groupby(parents, operator.attrgetter("parent"))
-
-    def edge_span(self, edge):
-        return edge.right - edge.left
-
-    def average_edges(self, parent_edges):
-        parent = parent_edges[0]
-        edges = parent_edges[1]
-
-        child_spanfracs = list()
-        child_lats = list()
-        child_longs = list()
-
-        for edge in edges:
-            child_spanfracs.append(self.edge_span(edge))
-            child_lats.append(self.locations[edge.child][0])
-            child_longs.append(self.locations[edge.child][1])
-        val = utility.weighted_geographic_center(
-            child_lats, child_longs, np.ones_like(len(child_lats))
-        )
-        return parent, val
+        edges = self.ts.tables.edges
+        parent = edges.parent
+        starts = np.append(0, np.where(parent[1:] != parent[:-1])[0] + 1)
+        return parent, edges.child, edges.right - edges.left, starts
 
-    def get_ancestral_geography(self, pop_lats, pop_longs, show_progress=False):
+    def batches(self, parent, child, starts):
         """
-        Use dynamic programming to find approximate posterior to sample from
+        Yield (first, last) indexes into starts of consecutive parents which can be
+        located together. A batch ends before the first parent with a child at least
+        as old as the first parent of the batch, which is the first parent after the
+        batch whose children include a parent in it.
+        """
+        times = self.ts.tables.nodes.time
+        parent_times = times[parent[starts]]
+        oldest_child = np.maximum.reduceat(times[child], starts)
+        # All children of the parents before a batch are younger than its first
+        # parent, so the first parent to end a batch is found on the running maximum
+        oldest_child = np.maximum.accumulate(oldest_child)
+        first = 0
+        while first < len(starts):
+            last = np.searchsorted(oldest_child, parent_times[first], side="left")
+            yield first, max(last, first + 1)
+            first = max(last, first + 1)
+
+    def get_ancestral_geography(
+        self, pop_lats, pop_longs, show_progress=False, span_weighted=False
+    ):
+        """
+        Use dynamic programming to find approximate posterior to sample from. If
+        span_weighted is True, children are weighted by the span of their edges
+        rather than counting each edge once.
         """
 
         # Set lat and long for sample nodes
@@ -405,15 +431,44 @@ class AncestralGeography:
             else:
                 for node in indiv.nodes:
                     self.locations[node] = (indiv.location[0], indiv.location[1])
-        # Iterate through the nodes via groupby on parent node
-        for parent_edges in tqdm(
-            self.edges_by_parent_asc(),
-            total=self.ts.num_nodes,
-            disable=not show_progress,
-        ):
-            if parent_edges[0] not in self.fixed_nodes:
-                parent, val = self.average_edges(parent_edges)
-                self.locations[parent] = val
+        parent, child, span, starts = self.edges_by_parent_asc()
+        ends = np.append(starts[1:], len(parent))
+        with tqdm(total=len(starts), disable=not show_progress) as progress:
+            for first, last in self.batches(parent, child, starts):
+                edge_start, edge_end = starts[first], ends[last - 1]
+                parents = parent[starts[first:last]]
+                children = child[edge_start:edge_end]
+                lat = np.radians(self.locations[children, 0])
+                long = np.radians(self.locations[children, 1])
+                weights = np.ones(len(children))
+                if span_weighted:
+                    weights = span[edge_start:edge_end]
+                coordinates = np.column_stack(
+                    [
+                        weights,
+                        weights * np.cos(lat) * np.cos(long),
+                        weights * np.cos(lat) * np.sin(long),
+                        weights * np.sin(lat),
+                    ]
+                )
+                totals = np.add.reduceat(
+                    coordinates, starts[first:last] - edge_start, axis=0
+                )
+                x, y, z = (totals[:, 1:] / totals[:, :1]).T
+                centers = np.column_stack(
+                    [
+                        np.degrees(np.arctan2(z, np.sqrt(x * x + y * y))),
+                        np.degrees(np.arctan2(y, x)),
+                    ]
+                )
+                # A parent with a single edge takes its child's location unchanged
+                single = ends[first:last] - starts[first:last] == 1
+                centers[single] = self.locations[
+                    child[starts[first:last][single]]
+                ]
+                keep = ~self.fixed_nodes[parents]
+                self.locations[parents[keep]] = centers[keep]
+                progress.update(last - first)
         return self.locations
 
 
@@ -486,91 +541,74 @@ def average_population_ancestors_geography(args):
         population_names.append(name)
     descendants = ts.mean_descendants(reference_sets)
 
-    avg_lat_lists = list()
-    avg_long_lists = list()
     locations = tgp_hgdp_sgdp_ancestor_locations
     time_windows_smaller = np.concatenate(
         [np.array([0]), np.logspace(3.5, 11, num=40, base=2.718)]
     )
     times = ts.tables.nodes.time[:]
-    time_slices_child = list()
-    time_slices_parent = list()
-    for time in time_windows_smaller:
-        time_slices_child.append(
-            ts.tables.edges.child[
-                np.where(
-                    np.logical_and(
-                        times[ts.tables.edges.child] <= time,
-                        times[ts.tables.edges.parent] > time,
-                    )
-                )[0]
-            ]
+    edges = ts.tables.edges
+    index = edge_index.load_or_build(ts, constants.NO_TGP_EDGE_INDEX)
+    time_slices = index.crossing_edges_at(time_windows_smaller)
+    time_slices_child = [edges.child[time_slice] for time_slice in time_slices]
+    time_slices_parent = [edges.parent[time_slice] for time_slice in time_slices]
+    num_populations = 55
+    num_ancestral_lineages = [list() for _ in range(num_populations)]
+    avg_lat_lists = [list() for _ in range(num_populations)]
+    avg_long_lists = [list() for _ in range(num_populations)]
+    for i, time in enumerate(tqdm(time_windows_smaller)):
+        time_slice_child = time_slices_child[i]
+        time_slice_parent = time_slices_parent[i]
+        # Location of each lineage at this time, on the edge from child to parent
+        edge_lengths = times[time_slice_parent] - times[time_slice_child]
+        weight_parent = 1 - ((times[time_slice_parent] - time) / edge_lengths)
+        weight_child = 1 - ((time - times[time_slice_parent]) / edge_lengths)
+        lat_arr = np.vstack(
+            [locations[time_slice_parent][:, 0], locations[time_slice_child][:, 0]]
+        ).T
+        long_arr = np.vstack(
+            [locations[time_slice_parent][:, 1], locations[time_slice_child][:, 1]]
+        ).T
+        weights = np.vstack([weight_parent, weight_child]).T
+        lats, longs = utility.vectorized_weighted_geographic_center(
+            lat_arr, long_arr, weights
         )
-        time_slices_parent.append(
-            ts.tables.edges.parent[
-                np.where(
-                    np.logical_and(
-                        times[ts.tables.edges.child] <= time,
-                        times[ts.tables.edges.parent] > time,
-                    )
-                )[0]
+        lat_radians = np.radians(lats)
+        long_radians = np.radians(longs)
+        coordinates = np.column_stack(
+            [
+                np.cos(lat_radians) * np.cos(long_radians),
+                np.cos(lat_radians) * np.sin(long_radians),
+                np.sin(lat_radians),
             ]
         )
-    num_ancestral_lineages = list()
-    for population in tqdm(np.arange(0, 55)):
-        avg_lat = list()
-        avg_long = list()
-        cur_ancestral_lineages = list()
-        for i, time in enumerate(time_windows_smaller):
-            time_slice_child = time_slices_child[i]
-            time_slice_parent = time_slices_parent[i]
-            ancestral_lineages = np.logical_and(
-                descendants[time_slice_child, population] != 0,
-                descendants[time_slice_parent, population] != 0,
-            )
-
-            cur_ancestral_lineages.append(np.sum(ancestral_lineages))
-
-            time_slice_child = time_slice_child[ancestral_lineages]
-            time_slice_parent = time_slice_parent[ancestral_lineages]
-            edge_lengths = times[time_slice_parent] - times[time_slice_child]
-            weight_parent = 1 - ((times[time_slice_parent] - time) / edge_lengths)
-            weight_child = 1 - ((time - times[time_slice_parent]) / edge_lengths)
-            if len(time_slice_child) != 0 and len(time_slice_parent) != 0:
-                lat_arr = np.vstack(
-                    [
-                        locations[time_slice_parent][:, 0],
-                        locations[time_slice_child][:, 0],
-                    ]
-                ).T
-                long_arr = np.vstack(
-                    [
-                        locations[time_slice_parent][:, 1],
-                        locations[time_slice_child][:, 1],
-                    ]
-                ).T
-                weights = np.vstack([weight_parent, weight_child]).T
-                lats, longs = utility.vectorized_weighted_geographic_center(
-                    lat_arr, long_arr, weights
-                )
-                avg_coord = utility.weighted_geographic_center(
-                    lats,
-                    longs,
-                    np.mean(
-                        [
-                            descendants[time_slice_child, population],
-                            descendants[time_slice_parent, population],
-                        ],
-                        axis=0,
-                    ),
-                )
-                avg_lat.append(avg_coord[0])
-                avg_long.append(avg_coord[1])
 
-        num_ancestral_lineages.append(cur_ancestral_lineages)
-
-        avg_lat_lists.append(avg_lat)
-        avg_long_lists.append(avg_long)
+        # Lineages ancestral to each population, weighted by their mean descendants
+        child_descendants = descendants[time_slice_child, :num_populations]
+        parent_descendants = descendants[time_slice_parent, :num_populations]
+        ancestral_lineages = np.logical_and(
+            child_descendants != 0, parent_descendants != 0
+        )
+        pop_weights = np.where(
+            ancestral_lineages, (child_descendants + parent_descendants) / 2, 0
+        )
+        total_weights = np.sum(pop_weights, axis=0)
+        # Populations without ancestral lineages are skipped below
+        total_weights[total_weights == 0] = 1
+        avg_x, avg_y, avg_z = (pop_weights.T @ coordinates).T / total_weights
+        avg_longs = np.degrees(np.arctan2(avg_y, avg_x))
+        avg_lats = np.degrees(np.arctan2(avg_z, np.sqrt(avg_x ** 2 + avg_y ** 2)))
+
+        num_lineages = np.sum(ancestral_lineages, axis=0)
+        for population in range(num_populations):
+            num_ancestral_lineages[population].append(num_lineages[population])
+            if num_lineages[population] == 1:
+                # A single lineage keeps its location unchanged
+                lineage = np.where(ancestral_lineages[:, population])[0][0]
+                avg_lat_lists[population].append(lats[lineage])
+                avg_long_lists[population].append(longs[lineage])
+            elif num_lineages[population] > 1:
+                avg_lat_lists[population].append(avg_lats[population])
+                avg_long_lists[population].append(avg_longs[population])
 
     with open("data/avg_pop_ancestral_location_LATS.csv", "w", newline="") as f:
         writer = csv.writer(f)
@@ -706,6 +744,86 @@ def find_ancient_descendants(args):
     descendants.to_csv("data/combined_ts_ancient_descendants.csv")
 
 
+# Number of set bits in each possible byte
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def descendant_segments(ts, focal_nodes):
+    """
+    Return arrays of the node, left and right coordinates of each interval over which
+    a node descends from one of focal_nodes (not including the focal nodes
+    themselves), following edges down from the focal nodes one generation at a time
+    """
+    edges = ts.tables.edges
+    order = np.argsort(edges.parent, kind="stable")
+    parent = edges.parent[order]
+    nodes = np.arange(ts.num_nodes)
+    first_edge = np.searchsorted(parent, nodes, side="left")
+    num_edges = np.searchsorted(parent, nodes, side="right") - first_edge
+
+    focal_nodes = np.asarray(focal_nodes)
+    node = focal_nodes
+    left = np.zeros(len(focal_nodes))
+    right = np.full(len(focal_nodes), ts.sequence_length)
+    segments = []
+    while len(node) > 0:
+        # Pair every segment with each edge below its node
+        counts = num_edges[node]
+        total = np.sum(counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        edge = order[np.repeat(first_edge[node], counts) + offsets]
+        left = np.maximum(np.repeat(left, counts), edges.left[edge])
+        right = np.minimum(np.repeat(right, counts), edges.right[edge])
+        overlap = left < right
+        node, left, right = edges.child[edge][overlap], left[overlap], right[overlap]
+        segments.append((node, left, right))
+    if len(segments) == 0:
+        return np.array([], dtype=np.int32), np.array([]), np.array([])
+    return tuple(np.concatenate(arrays) for arrays in zip(*segments))
+
+
+def packed_descent(ts, focal_nodes, bin_size=1000, chunk_size=128):
+    """
+    Return a bitpacked np.uint8 matrix with a row for each sample (by node ID) and a
+    bit for each bin_size chunk of the genome, set if the sample descends from any of
+    focal_nodes in that chunk (in any of the trees rounded to overlap it)
+    """
+    num_bins = int(ts.get_sequence_length() / bin_size)
+    node, left, right = descendant_segments(ts, focal_nodes)
+    is_sample = np.zeros(ts.num_nodes, dtype=bool)
+    is_sample[ts.samples()] = True
+    keep = is_sample[node]
+    node = node[keep]
+    first_bin = np.minimum(np.round(left[keep] / bin_size).astype(int), num_bins)
+    last_bin = np.minimum(np.round(right[keep] / bin_size).astype(int), num_bins)
+
+    packed = np.zeros((ts.num_samples, (num_bins + 7) // 8), dtype=np.uint8)
+    for start in range(0, ts.num_samples, chunk_size):
+        in_chunk = np.logical_and(node >= start, node < start + chunk_size)
+        rows = node[in_chunk] - start
+        coverage = np.zeros((min(chunk_size, ts.num_samples - start), num_bins + 1))
+        np.add.at(coverage, (rows, first_bin[in_chunk]), 1)
+        np.add.at(coverage, (rows, last_bin[in_chunk]), -1)
+        covered = np.cumsum(coverage[:, :num_bins], axis=1) > 0
+        packed[start : start + chunk_size] = np.packbits(covered, axis=1)
+    return packed, num_bins
+
+
+def binary_corrcoef(matrix):
+    """
+    Pearson correlation coefficients between the rows of a 0/1 matrix, as given by
+    np.corrcoef, computed from sparse counts of shared ones
+    """
+    num_cols = matrix.shape[1]
+    sparse = scipy.sparse.csr_matrix(matrix, dtype=np.int64)
+    shared = (sparse @ sparse.T).toarray().astype(float)
+    ones = np.diag(shared)
+    covariance = num_cols * shared - np.outer(ones, ones)
+    variance = num_cols * ones - ones ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return covariance / np.sqrt(np.outer(variance, variance))
+
+
 def find_descent(ts, proxy_nodes, descent_cutoff, exclude_pop, ref_set_map, pop_names):
     """
     Get genomic locations of descent from given ancestral nodes in 1Kb chunks
@@ -714,41 +832,25 @@ def find_descent(ts, proxy_nodes, descent_cutoff, exclude_pop, ref_set_map, pop_
     only one.
     """
 
-    # Array indicating where indivdual descends from ancient sample
-    descendants_arr = np.zeros(
-        (ts.num_samples, int(ts.get_sequence_length() / 1000)), dtype=int
-    )
-    for focal_node in proxy_nodes:
-        for tree in tqdm(ts.trees()):
-            stack = list(tree.children(focal_node))
-            while len(stack) != 0:
-                cur_node = stack.pop()
-                if cur_node in ts.samples():
-                    descendants_arr[
-                        cur_node,
-                        int(np.round(tree.interval[0] / 1000)) : int(
-                            np.round(tree.interval[1] / 1000)
-                        ),
-                    ] = 1
-                for child in tree.children(cur_node):
-                    stack.append(child)
+    # Bitpacked array indicating where indivdual descends from ancient sample
+    packed, num_bins = packed_descent(ts, proxy_nodes)
     # Sum descent from ancient per sample
-    sample_desc_sum = np.sum(descendants_arr, axis=1)
+    sample_desc_sum = np.sum(POPCOUNT[packed], axis=1, dtype=int)
 
     # Note samples which descend from the ancient sample for a span > than the cutoff
     high_descendants = ts.samples()[
-        np.where(np.sum(descendants_arr[ts.samples()], axis=1) > descent_cutoff)[0]
+        np.where(sample_desc_sum[ts.samples()] > descent_cutoff)[0]
     ]
     high_descendants = high_descendants[
         pop_names[ref_set_map[high_descendants]] != exclude_pop
     ]
-    descendants_arr = descendants_arr[high_descendants]
+    descendants_arr = np.unpackbits(packed[high_descendants], axis=1, count=num_bins)
     # Construct a dataframe of correlation coefficients between descendants
     corrcoef_df = pd.DataFrame(
-        np.corrcoef(descendants_arr),
+        binary_corrcoef(descendants_arr),
         index=pop_names[ref_set_map[high_descendants]],
     )
-    return descendants_arr.astype(int), corrcoef_df, high_descendants, sample_desc_sum
+    return descendants_arr, corrcoef_df, high_descendants, sample_desc_sum
 
 
 def find_ancient_descent_haplotypes(args):
@@ -822,118 +924,66 @@ def find_archaic_relationships(args):
     chagyrskaya = np.where(tables.nodes.population == ts.num_populations - 2)[0]
     nonarchaic = ts.samples()[:-8]
 
-    # Descent from Vindija: straightforward descent in nonarchaic samples
+    # Membership masks, and the archaic (if any) of which each node is a proxy
+    is_nonarchaic = np.zeros(ts.num_nodes, dtype=bool)
+    is_nonarchaic[nonarchaic] = True
+    members = {}
+    for name, nodes in [
+        ("a", altai),
+        ("c", chagyrskaya),
+        ("d", denisovan),
+        ("v", vindija),
+    ]:
+        members[name] = np.zeros(ts.num_nodes, dtype=bool)
+        members[name][nodes] = True
+    proxies = {
+        "a": altai_proxy,
+        "c": chagyrskaya_proxy,
+        "d": denisovan_proxy,
+        "v": vindija_proxy,
+    }
+    proxy_of = np.full(ts.num_nodes, "", dtype="<U1")
+    for name, nodes in proxies.items():
+        proxy_of[nodes] = name
+    # Oldest first, so that the subtrees of younger proxies are found while
+    # traversing those of older ones
+    proxies_by_age = np.concatenate([proxies[name] for name in "acdv"])
+
+    def proxy_leaves(tree):
+        """
+        Return a dict mapping each proxy node with children in tree to a list of
+        (leaf, archaics) tuples for the leaves below it, where archaics is the set
+        of archaics with a proxy on the path between the leaf and the proxy node
+        """
+        below = collections.defaultdict(list)
+        visited = set()
+        for proxy in proxies_by_age:
+            if proxy in visited or tree.num_children(proxy) == 0:
+                continue
+            # Stack of nodes with the proxies above them, top down
+            stack = [(proxy, ())]
+            while len(stack) > 0:
+                node, path = stack.pop()
+                children = tree.children(node)
+                if len(children) == 0:
+                    for i, ancestor in enumerate(path):
+                        archaics = {proxy_of[u] for u in path[i + 1 :]}
+                        below[ancestor].append((node, archaics))
+                    continue
+                if proxy_of[node] != "":
+                    visited.add(node)
+                    path = path + (node,)
+                for child in children:
+                    stack.append((child, path))
+        return below
+
     # v=vindija, d=denisovan, c=chagyrskaya, a=altai, m=modern (nonarchaic)
     v_descent = dict.fromkeys(["total_v_descent", "v_m"], 0)
-
-    for tree in tqdm(ts.trees(), desc="Vindija Descent"):
-        for node in vindija_proxy:
-            leaves = list(tree.leaves(node))
-            if len(leaves) > 1:
-                v_descent["total_v_descent"] += tree.span
-                if len(np.intersect1d(leaves, nonarchaic)) > 0:
-                    v_descent["v_m"] += tree.span
-                else:
-                    raise ValueError("Leaves must be younger than Vindija")
-            elif len(leaves) == 1:
-                assert leaves[0] in vindija_proxy or leaves[0] in vindija
-
-    # Chagyrskaya
-    arrows = ["c_v", "c_d", "c_m", "c_d_v", "c_d_m", "c_v_m"]
-    c_descent = dict.fromkeys(["total_c_descent"] + arrows, 0)
-
-    # Iterate over each tree in the tree sequence
-    for tree in tqdm(ts.trees(), desc="Chagyrskaya Descent"):
-        # Check both archaic chromosome copies
-        for node in chagyrskaya_proxy:
-            leaves = list(tree.leaves(node))
-            # Only investigate tree if > 1 leaves (otherwise check child is archaic)
-            if len(leaves) > 1:
-                # Dictionary of booleans to track of relationships seen at this tree
-                flags = dict.fromkeys(arrows, False)
-                # If any descent, add to total
-                c_descent["total_c_descent"] += tree.span
-                for leaf in leaves:
-                    # First check the c->d relationship
-                    if leaf in denisovan:
-                        flags["c_d"] = True
-                    # Next check vindija, which could be c->v or d->v
-                    elif leaf in vindija:
-                        denisovan_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in chagyrskaya_proxy:
-                            if parent in denisovan_proxy:
-                                denisovan_descendant = True
-                            parent = tree.parent(parent)
-                        # If denisovan is noted along path, then path is d->v
-                        if denisovan_descendant is True:
-                            flags["c_d_v"] = True
-                        # If no denisovan seen on path, then path is c->v
-                        else:
-                            flags["c_v"] = True
-                    # Enumerate possible paths if leaf is nonarchaic
-                    elif leaf in nonarchaic:
-                        vindija_descendant = False
-                        denisovan_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in chagyrskaya_proxy:
-                            if parent in vindija_proxy:
-                                vindija_descendant = True
-                            elif parent in denisovan_proxy:
-                                denisovan_descendant = True
-                            parent = tree.parent(parent)
-                        # If we see vindija, we assign relationship to v->m
-                        if vindija_descendant:
-                            flags["c_v_m"] = True
-                        # If we don't see vindija, but do see denisovan, then it's d->m
-                        elif (
-                            vindija_descendant is False and denisovan_descendant is True
-                        ):
-                            flags["c_d_m"] = True
-                        # If we don't see vindija or denisovan, it's c->m
-                        elif (
-                            vindija_descendant is False
-                            and denisovan_descendant is False
-                        ):
-                            flags["c_m"] = True
-                for path, flag in flags.items():
-                    if flag is True:
-                        c_descent[path] += tree.span
-            else:
-                assert leaves[0] in chagyrskaya or leaves[0] in chagyrskaya_proxy
-
-    # Denisovan
-    arrows = ["d_v", "d_m", "d_v_m"]
-    d_descent = dict.fromkeys(["total_d_descent"] + arrows, 0)
-
-    for tree in tqdm(ts.trees(), desc="Denisovan Descent"):
-        for node in denisovan_proxy:
-            leaves = list(tree.leaves(node))
-            if len(leaves) > 1:
-                flags = dict.fromkeys(arrows, False)
-                d_descent["total_d_descent"] += tree.span
-                for leaf in leaves:
-                    if leaf in vindija:
-                        flags["d_v"] = True
-                    elif leaf in nonarchaic:
-                        vindija_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in denisovan_proxy:
-                            if parent in vindija_proxy:
-                                vindija_descendant = True
-                            parent = tree.parent(parent)
-                        if vindija_descendant is True:
-                            flags["d_v_m"] = True
-                        else:
-                            flags["d_m"] = True
-                for path, flag in flags.items():
-                    if flag is True:
-                        d_descent[path] += tree.span
-            else:
-                assert leaves[0] in denisovan or leaves[0] in denisovan_proxy
-
-    # Altai
-    arrows = [
+    c_arrows = ["c_v", "c_d", "c_m", "c_d_v", "c_d_m", "c_v_m"]
+    c_descent = dict.fromkeys(["total_c_descent"] + c_arrows, 0)
+    d_arrows = ["d_v", "d_m", "d_v_m"]
+    d_descent = dict.fromkeys(["total_d_descent"] + d_arrows, 0)
+    a_arrows = [
         "a_d",
         "a_c",
         "a_v",
@@ -945,77 +995,92 @@ def find_archaic_relationships(args):
         "a_d_m",
         "a_v_m",
     ]
+    a_descent = dict.fromkeys(["total_a_descent"] + a_arrows, 0)
 
-    a_descent = dict.fromkeys(["total_a_descent"] + arrows, 0)
-    for tree in tqdm(ts.trees(), desc="Altai Descent"):
-        for node in altai_proxy:
-            leaves = list(tree.leaves(node))
+    def classify(name, leaf, archaics, flags):
+        """
+        Set the flags of the relationships shown by a leaf below a proxy node of the
+        archaic called name, given the archaics with proxies between them
+        """
+        if name == "c":
+            # First check the c->d relationship
+            if members["d"][leaf]:
+                flags["c_d"] = True
+            # Next check vindija, which could be c->v or d->v
+            elif members["v"][leaf]:
+                flags["c_d_v" if "d" in archaics else "c_v"] = True
+            # Enumerate possible paths if leaf is nonarchaic
+            elif is_nonarchaic[leaf]:
+                if "v" in archaics:
+                    flags["c_v_m"] = True
+                elif "d" in archaics:
+                    flags["c_d_m"] = True
+                else:
+                    flags["c_m"] = True
+        elif name == "d":
+            if members["v"][leaf]:
+                flags["d_v"] = True
+            elif is_nonarchaic[leaf]:
+                flags["d_v_m" if "v" in archaics else "d_m"] = True
+        elif name == "a":
+            if members["c"][leaf]:
+                flags["a_c"] = True
+            elif members["d"][leaf]:
+                flags["a_d"] = True
+                if "c" in archaics:
+                    flags["a_c_d"] = True
+            elif members["v"][leaf]:
+                if "d" in archaics and "c" not in archaics:
+                    flags["a_d_v"] = True
+                elif "c" in archaics and "d" not in archaics:
+                    flags["a_c_v"] = True
+                elif "c" not in archaics and "d" not in archaics:
+                    flags["a_v"] = True
+            elif is_nonarchaic[leaf]:
+                if "v" in archaics:
+                    flags["a_v_m"] = True
+                elif "d" in archaics:
+                    flags["a_d_m"] = True
+                elif "c" in archaics:
+                    flags["a_c_m"] = True
+                else:
+                    flags["a_m"] = True
+
+    for tree in tqdm(ts.trees(), desc="Archaic Descent"):
+        below = proxy_leaves(tree)
+        # Descent from Vindija: straightforward descent in nonarchaic samples
+        for node in vindija_proxy:
+            leaves = [leaf for leaf, _ in below[node]] or [node]
             if len(leaves) > 1:
-                a_descent["total_a_descent"] += tree.span
-                flags = dict.fromkeys(arrows, False)
-                for leaf in leaves:
-                    if leaf in chagyrskaya:
-                        flags["a_c"] = True
-                    elif leaf in denisovan:
-                        flags["a_d"] = True
-                        parent = tree.parent(leaf)
-                        while parent not in altai_proxy:
-                            if parent in chagyrskaya_proxy:
-                                flags["a_c_d"] = True
-                            parent = tree.parent(parent)
-                    elif leaf in vindija:
-                        denisovan_descendant = False
-                        chagyrskaya_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in altai_proxy:
-                            if parent in denisovan_proxy:
-                                denisovan_descendant = True
-                            elif parent in chagyrskaya_proxy:
-                                chagyrskaya_descendant = True
-                            parent = tree.parent(parent)
-                        if denisovan_descendant and chagyrskaya_descendant is False:
-                            flags["a_d_v"] = True
-                        elif chagyrskaya_descendant and denisovan_descendant is False:
-                            flags["a_c_v"] = True
-                        elif (
-                            chagyrskaya_descendant is False
-                            and denisovan_descendant is False
-                        ):
-                            flags["a_v"] = True
-                    elif leaf in nonarchaic:
-                        denisovan_descendant = False
-                        chagyrskaya_descendant = False
-                        vindija_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in altai_proxy:
-                            if parent in denisovan_proxy:
-                                denisovan_descendant = True
-                            elif parent in chagyrskaya_proxy:
-                                chagyrskaya_descendant = True
-                            elif parent in vindija_proxy:
-                                vindija_descendant = True
-                            parent = tree.parent(parent)
-                        if vindija_descendant:
-                            flags["a_v_m"] = True
-                        elif denisovan_descendant and vindija_descendant is False:
-                            flags["a_d_m"] = True
-                        elif (
-                            chagyrskaya_descendant
-                            and denisovan_descendant is False
-                            and vindija_descendant is False
-                        ):
-                            flags["a_c_m"] = True
-                        elif (
-                            chagyrskaya_descendant is False
-                            and denisovan_descendant is False
-                            and vindija_descendant is False
-                        ):
-                            flags["a_m"] = True
-                for path, flag in flags.items():
-                    if flag is True:
-                        a_descent[path] += tree.span
-            else:
-                assert leaves[0] in altai or leaves[0] in altai_proxy
+                v_descent["total_v_descent"] += tree.span
+                if np.any(is_nonarchaic[leaves]):
+                    v_descent["v_m"] += tree.span
+                else:
+                    raise ValueError("Leaves must be younger than Vindija")
+            elif len(leaves) == 1:
+                assert proxy_of[leaves[0]] == "v" or members["v"][leaves[0]]
+        # Check both chromosome copies of each older archaic
+        for name, descent, arrows in [
+            ("c", c_descent, c_arrows),
+            ("d", d_descent, d_arrows),
+            ("a", a_descent, a_arrows),
+        ]:
+            for node in proxies[name]:
+                leaves = below[node] or [(node, set())]
+                # Only investigate tree if > 1 leaves (otherwise check child is
+                # archaic)
+                if len(leaves) > 1:
+                    # Dictionary of booleans to track relationships seen at this tree
+                    flags = dict.fromkeys(arrows, False)
+                    descent["total_" + name + "_descent"] += tree.span
+                    for leaf, archaics in leaves:
+                        classify(name, leaf, archaics, flags)
+                    for path, flag in flags.items():
+                        if flag is True:
+                            descent[path] += tree.span
+                else:
+                    leaf = leaves[0][0]
+                    assert members[name][leaf] or proxy_of[leaf] == name
 
     with open("data/archaic_descent.txt", "w") as file:
         file.write(json.dumps(a_descent))
@@ -0,0 +1,472 @@
+"""
+Benchmarks of tsinfer and tsdate on the neutral simulations used by the
+cpu_scaling_samplesize and cpu_scaling_length evaluations. Each case is run a
+number of times after some warmup runs, recording the wall time, CPU time and peak
+memory of every run, for each of a range of thread counts. Results are saved as
+JSON (see RESULTS_SCHEMA) together with details of the machine and package
+versions, and can be compared against a saved baseline to catch regressions, e.g.
+when upgrading tsinfer or tsdate:
+
+ python3 src/run_evaluation.py bench run --suite samplesize -o new.json
+ python3 src/run_evaluation.py bench compare baseline.json new.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import msprime
+import tsinfer
+import tskit
+import tsdate
+
+import cost_model
+import evaluation
+import simcache
+
+SCHEMA_VERSION = 1
+TOOLS = ["tsinfer", "tsdate", "tsdate_infer"]
+METRICS = ["wall_time", "cpu_time", "max_memory"]
+# Fields identifying a benchmark case, used to match results between runs
+CASE_FIELDS = ["tool", "sample_size", "length", "num_threads"]
+
+# The sample sizes and lengths of the cpu_scaling evaluations
+SUITES = {
+    "quick": {"sample_size": [100], "length": [100000]},
+    "samplesize": {
+        "sample_size": [int(n) for n in np.linspace(110, 2000, 10, dtype=int)],
+        "length": [1000000],
+    },
+    "length": {
+        "sample_size": [500],
+        "length": [int(n) for n in np.linspace(1e5, 1e7, 10, dtype=int)],
+    },
+}
+SIM_PARAMS = {"Ne": 10000, "mutation_rate": 1e-8, "recombination_rate": 1e-8}
+
+RESULTS_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "title": "tsinfer/tsdate benchmark results",
+    "type": "object",
+    "required": ["schema_version", "metadata", "config", "results"],
+    "properties": {
+        "schema_version": {"type": "integer", "enum": [SCHEMA_VERSION]},
+        "metadata": {
+            "type": "object",
+            "required": [
+                "timestamp",
+                "hostname",
+                "platform",
+                "python",
+                "cpu_model",
+                "num_cpus",
+                "total_memory",
+                "load_average",
+                "git_commit",
+                "versions",
+            ],
+            "properties": {
+                "timestamp": {"type": "string"},
+                "hostname": {"type": "string"},
+                "platform": {"type": "string"},
+                "python": {"type": "string"},
+                "cpu_model": {"type": "string"},
+                "num_cpus": {"type": "integer"},
+                "total_memory": {"type": "integer"},
+                "load_average": {"type": "array", "items": {"type": "number"}},
+                "git_commit": {"type": ["string", "null"]},
+                "versions": {"type": "object"},
+            },
+        },
+        "config": {
+            "type": "object",
+            "required": ["suite", "tools", "threads", "warmup", "repeats", "seed"],
+            "properties": {
+                "suite": {"type": "string"},
+                "tools": {"type": "array", "items": {"enum": TOOLS}},
+                "threads": {"type": "array", "items": {"type": "integer"}},
+                "warmup": {"type": "integer"},
+                "repeats": {"type": "integer"},
+                "seed": {"type": "integer"},
+            },
+        },
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": CASE_FIELDS + ["num_sites"] + METRICS,
+                "properties": {
+                    "tool": {"enum": TOOLS},
+                    "sample_size": {"type": "integer"},
+                    "length": {"type": "integer"},
+                    "num_threads": {"type": "integer"},
+                    "num_sites": {"type": "integer"},
+                    # One value per repeat: seconds, seconds and bytes
+                    "wall_time": {"type": "array", "items": {"type": "number"}},
+                    "cpu_time": {"type": "array", "items": {"type": "number"}},
+                    "max_memory": {"type": "array", "items": {"type": "integer"}},
+                },
+            },
+        },
+    },
+}
+
+JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "null": type(None),
+}
+
+
+def validate(instance, schema=RESULTS_SCHEMA, path="benchmarks"):
+    """
+    Check instance against the subset of JSON schema used by RESULTS_SCHEMA (type,
+    enum, required, properties and items), raising a ValueError if it does not match
+    """
+    types = schema.get("type", [])
+    types = [types] if isinstance(types, str) else types
+    if len(types) > 0:
+        is_bool = isinstance(instance, bool)
+        if is_bool or not isinstance(instance, tuple(JSON_TYPES[t] for t in types)):
+            raise ValueError("{} should be of type {}".format(path, " or ".join(types)))
+    if "enum" in schema and instance not in schema["enum"]:
+        raise ValueError("{} should be one of {}".format(path, schema["enum"]))
+    if isinstance(instance, dict):
+        for key in schema.get("required", []):
+            if key not in instance:
+                raise ValueError("{} is missing {}".format(path, key))
+        for key, subschema in schema.get("properties", {}).items():
+            if key in instance:
+                validate(instance[key], subschema, path + "." + key)
+    if isinstance(instance, list) and "items" in schema:
+        for j, item in enumerate(instance):
+            validate(item, schema["items"], "{}[{}]".format(path, j))
+
+
+def machine_metadata():
+    """
+    Describe the machine, its current load and the versions of the benchmarked
+    packages
+    """
+    cpu_model = platform.processor()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    try:
+        git_commit = (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        git_commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "hostname": socket.gethostname(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_model": cpu_model,
+        "num_cpus": os.cpu_count(),
+        "total_memory": os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"),
+        "load_average": list(os.getloadavg()),
+        "git_commit": git_commit,
+        "versions": {
+            "tsinfer": tsinfer.__version__,
+            "tsdate": tsdate.__version__,
+            "tskit": tskit.__version__,
+            "msprime": msprime.__version__,
+            "numpy": np.__version__,
+        },
+    }
+
+
+def prepare_case(sample_size, length, seed, data_dir):
+    """
+    Simulate (or load from the simulation cache) the tree sequence for a case and
+    write the input files of each tool to data_dir/benchmark. Returns the path
+    prefix of the input files and the number of sites.
+    """
+    params = dict(
+        SIM_PARAMS,
+        sample_size=sample_size,
+        length=length,
+        simulator="msprime",
+        version=msprime.__version__,
+        seed=seed,
+    )
+    cache = simcache.SimulationCache(os.path.join(data_dir, "simulation_cache"))
+    sim = cache.load_or_simulate(
+        params,
+        lambda: evaluation.run_neutral_sim(
+            sample_size=sample_size, length=length, seed=seed, **SIM_PARAMS
+        ),
+    )
+    bench_dir = os.path.join(data_dir, "benchmark")
+    os.makedirs(bench_dir, exist_ok=True)
+    prefix = os.path.join(bench_dir, simcache.simulation_key(params)[:16])
+    if not os.path.exists(prefix + ".tsinferred.trees"):
+        sim.dump(prefix + ".trees")
+        samples = tsinfer.formats.SampleData.from_tree_sequence(
+            sim, use_sites_time=False, path=prefix + ".samples"
+        )
+        tsinfer.infer(samples).dump(prefix + ".tsinferred.trees")
+    return prefix, sim.num_sites
+
+
+def tool_command(tool, prefix, output, num_threads):
+    """
+    Return the command line which runs tool on the inputs at prefix
+    """
+    if tool == "tsinfer":
+        return [
+            sys.executable,
+            evaluation.tsinfer_executable,
+            prefix + ".samples",
+            output,
+            "--threads",
+            str(num_threads),
+        ]
+    input_fn = prefix + (".trees" if tool == "tsdate" else ".tsinferred.trees")
+    return [
+        sys.executable,
+        evaluation.tsdate_executable,
+        input_fn,
+        output,
+        str(SIM_PARAMS["Ne"]),
+        "--mutation-rate",
+        str(SIM_PARAMS["mutation_rate"]),
+        "--threads",
+        str(num_threads),
+    ]
+
+
+def time_command(cmd):
+    """
+    Run cmd, returning its wall time and CPU time in seconds and its peak memory
+    in bytes
+    """
+    start = time.perf_counter()
+    cpu_time, max_memory = evaluation.time_cmd(cmd)
+    return time.perf_counter() - start, cpu_time, max_memory
+
+
+def run_case(tool, prefix, num_threads, warmup, repeats):
+    """
+    Run tool warmup times, discarding the measurements, then repeats times
+    """
+    measurements = {metric: [] for metric in METRICS}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cmd = tool_command(tool, prefix, os.path.join(tmpdir, "out.trees"), num_threads)
+        for _ in range(warmup):
+            time_command(cmd)
+        for _ in range(repeats):
+            for metric, value in zip(METRICS, time_command(cmd)):
+                measurements[metric].append(value)
+    return measurements
+
+
+def run_benchmarks(
+    suite="quick",
+    tools=TOOLS,
+    threads=(1,),
+    warmup=1,
+    repeats=3,
+    seed=1,
+    data_dir="simulated-data",
+):
+    """
+    Run every tool on every case of the suite with each number of threads, and
+    return the results in the form described by RESULTS_SCHEMA
+    """
+    config = {
+        "suite": suite,
+        "tools": list(tools),
+        "threads": [int(t) for t in threads],
+        "warmup": warmup,
+        "repeats": repeats,
+        "seed": seed,
+    }
+    metadata = machine_metadata()
+    results = []
+    for sample_size in SUITES[suite]["sample_size"]:
+        for length in SUITES[suite]["length"]:
+            prefix, num_sites = prepare_case(sample_size, length, seed, data_dir)
+            for tool in tools:
+                for num_threads in config["threads"]:
+                    logging.info(
+                        "Benchmarking {} with {} threads on n={} L={}".format(
+                            tool, num_threads, sample_size, length
+                        )
+                    )
+                    result = {
+                        "tool": tool,
+                        "sample_size": sample_size,
+                        "length": length,
+                        "num_threads": num_threads,
+                        "num_sites": num_sites,
+                    }
+                    result.update(
+                        run_case(tool, prefix, num_threads, warmup, repeats)
+                    )
+                    results.append(result)
+    benchmarks = {
+        "schema_version": SCHEMA_VERSION,
+        "metadata": metadata,
+        "config": config,
+        "results": results,
+    }
+    validate(benchmarks)
+    return benchmarks
+
+
+def load(path):
+    with open(path) as f:
+        benchmarks = json.load(f)
+    validate(benchmarks, path=path)
+    return benchmarks
+
+
+def summarise(benchmarks):
+    """
+    Return a dataframe of the median of each metric for each case
+    """
+    df = pd.DataFrame(benchmarks["results"])
+    for metric in METRICS:
+        df[metric] = df[metric].apply(np.median)
+    return df.set_index(CASE_FIELDS)[METRICS]
+
+
+def resource_traces(benchmarks):
+    """
+    Return the median CPU time and peak memory of each case in the format of the
+    cost model's resource traces
+    """
+    traces = []
+    for result in benchmarks["results"]:
+        traces.append(
+            {
+                "sample_size": result["sample_size"],
+                "length": result["length"],
+                "n_sites": result["num_sites"],
+                result["tool"] + "_cpu": np.median(result["cpu_time"]),
+                result["tool"] + "_memory": np.median(result["max_memory"]),
+            }
+        )
+    return pd.DataFrame(traces)
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compare the median of each metric for the cases run in both baseline and
+    current. Returns a dataframe with the ratio of current to baseline for each
+    metric, and a "regression" column which is True for cases where any ratio is
+    more than 1 + threshold.
+    """
+    joined = summarise(baseline).join(
+        summarise(current), how="inner", lsuffix="_baseline", rsuffix="_current"
+    )
+    regression = np.zeros(joined.shape[0], dtype=bool)
+    for metric in METRICS:
+        ratio = joined[metric + "_current"] / joined[metric + "_baseline"]
+        joined[metric + "_ratio"] = ratio
+        regression = np.logical_or(regression, ratio > 1 + threshold)
+    joined["regression"] = regression
+    return joined
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="run_evaluation.py bench", description="Benchmark tsinfer and tsdate."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "--suite", choices=sorted(SUITES.keys()), default="quick", help="cases to run"
+    )
+    run_parser.add_argument(
+        "--tools", nargs="+", choices=TOOLS, default=TOOLS, help="tools to run"
+    )
+    run_parser.add_argument(
+        "--threads",
+        nargs="+",
+        type=int,
+        default=[1],
+        help="numbers of threads to run each tool with, e.g. 1 2 4 8",
+    )
+    run_parser.add_argument(
+        "--warmup", type=int, default=1, help="unrecorded runs before each case"
+    )
+    run_parser.add_argument(
+        "--repeats", type=int, default=3, help="recorded runs of each case"
+    )
+    run_parser.add_argument("--seed", type=int, default=1, help="simulation seed")
+    run_parser.add_argument("--data-dir", default="simulated-data")
+    run_parser.add_argument(
+        "--output", "-o", default="simulated-data/benchmark.json", help="JSON output"
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="flag regressions against a saved baseline"
+    )
+    compare_parser.add_argument("baseline", help="JSON results of the baseline")
+    compare_parser.add_argument("current", help="JSON results to compare")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative increase in a median counted as a regression",
+    )
+
+    subparsers.add_parser("schema", help="print the JSON schema of the results")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        benchmarks = run_benchmarks(
+            args.suite,
+            args.tools,
+            args.threads,
+            args.warmup,
+            args.repeats,
+            args.seed,
+            args.data_dir,
+        )
+        with open(args.output, "w") as f:
+            json.dump(benchmarks, f, indent=2)
+        # Also use the measurements to improve the cost model's estimates
+        cost_model.append_traces(args.data_dir, resource_traces(benchmarks))
+        print(summarise(benchmarks).to_string())
+    elif args.command == "compare":
+        baseline = load(args.baseline)
+        current = load(args.current)
+        for package, version in baseline["metadata"]["versions"].items():
+            new_version = current["metadata"]["versions"].get(package)
+            if new_version != version:
+                print("{}: {} -> {}".format(package, version, new_version))
+        comparison = compare(baseline, current, args.threshold)
+        print(comparison.to_string())
+        regressions = comparison[comparison["regression"]]
+        if regressions.shape[0] > 0:
+            print("{} regressions found".format(regressions.shape[0]))
+            sys.exit(1)
+    else:
+        print(json.dumps(RESULTS_SCHEMA, indent=2))
@@ -8,3 +8,7 @@ colors = {
     "geva": "red",
     "relate": "green",
 }
+
+# Edge time index (see edge_index.py) of the unified tree sequence without the 1000
+# Genomes samples, shared by the ancestral geography analyses and figures
+NO_TGP_EDGE_INDEX = "all-data/hgdp_sgdp_ancients_chr20.edge_index.npz"
@@ -0,0 +1,114 @@
+"""
+Estimates of the resources used by each method, fitted to the CPU time and peak
+memory recorded by earlier runs of the cpu_scaling_samplesize and cpu_scaling_length
+evaluations, and by any later resource traces (e.g. from `run_evaluation.py bench`).
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+SCALING_RUNS = ["cpu_scaling_samplesize", "cpu_scaling_length"]
+# Recorded runs of single methods, in the same format as the scaling runs
+TRACE_FILE = "resource_traces.csv"
+METHODS = ["tsdate", "tsinfer", "tsdate_infer", "relate", "geva"]
+PARAMETERS = ["sample_size", "length", "n_sites"]
+METRICS = ["cpu", "memory"]
+
+
+def load_scaling_runs(data_dir):
+    """
+    Return a dataframe of all recorded scaling runs and resource traces found in
+    data_dir
+    """
+    runs = []
+    for filename in [name + ".csv" for name in SCALING_RUNS] + [TRACE_FILE]:
+        path = os.path.join(data_dir, filename)
+        if os.path.exists(path):
+            runs.append(pd.read_csv(path, index_col=0))
+    if len(runs) == 0:
+        logging.warning("No scaling runs found in {}".format(data_dir))
+        return pd.DataFrame(columns=PARAMETERS)
+    return pd.concat(runs, sort=False, ignore_index=True)
+
+
+def append_traces(data_dir, traces):
+    """
+    Add traces, a dataframe with the columns of PARAMETERS and {method}_cpu and
+    {method}_memory for the methods which were run, to the recorded resource traces
+    """
+    path = os.path.join(data_dir, TRACE_FILE)
+    if os.path.exists(path):
+        traces = pd.concat([pd.read_csv(path, index_col=0), traces], sort=False)
+    traces.reset_index(drop=True).to_csv(path)
+
+
+class CostModel:
+    """
+    Power-law models of the CPU time (in seconds) and peak memory (in bytes) used by
+    each method as a function of sample size, sequence length and number of sites,
+    i.e. linear models on the log scale. Each prediction uses a model fitted on the
+    parameters which are known for it and vary in the recorded runs.
+    """
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.coefficients = {}
+
+    @classmethod
+    def from_scaling_runs(cls, data_dir):
+        return cls(load_scaling_runs(data_dir))
+
+    def fit(self, method, metric, params):
+        """
+        Return the coefficients of metric for method on the given parameters, or
+        None if there are no recorded runs
+        """
+        if (method, metric, params) in self.coefficients:
+            return self.coefficients[(method, metric, params)]
+        coefficients = None
+        column = method + "_" + metric
+        if column in self.runs.columns:
+            runs = self.runs[list(params) + [column]].dropna().astype(float)
+            runs = runs[runs[column] > 0]
+            if runs.shape[0] > 0:
+                # Parameters which do not vary are left out of the fit
+                varying = [p for p in params if runs[p].nunique() > 1]
+                design = np.column_stack(
+                    [np.ones(runs.shape[0])] + [np.log(runs[p].values) for p in varying]
+                )
+                coef = np.linalg.lstsq(design, np.log(runs[column].values), rcond=None)
+                coefficients = dict(zip(["intercept"] + varying, coef[0]))
+        self.coefficients[(method, metric, params)] = coefficients
+        return coefficients
+
+    def predict(self, method, metric, sample_size=None, length=None, n_sites=None):
+        """
+        Predicted CPU time in seconds or peak memory in bytes, or 0 if this method
+        has no recorded runs
+        """
+        values = {"sample_size": sample_size, "length": length, "n_sites": n_sites}
+        params = tuple(
+            p for p in PARAMETERS if not pd.isnull(values[p]) and p in self.runs
+        )
+        coef = self.fit(method, metric, params)
+        if coef is None:
+            return 0
+        log_value = coef["intercept"]
+        for param in params:
+            if param in coef:
+                log_value += coef[param] * np.log(float(values[param]))
+        return np.exp(log_value)
+
+    def predict_cpu(self, method, **params):
+        return self.predict(method, "cpu", **params)
+
+    def predict_memory(self, method, **params):
+        return self.predict(method, "memory", **params)
+
+    def known(self, method):
+        """
+        Whether any runs of method have been recorded
+        """
+        return any(self.fit(method, metric, ()) is not None for metric in METRICS)
@@ -0,0 +1,156 @@
+"""
+Index of the time intervals spanned by the edges of a tree sequence, for finding the
+edges which cross given times (i.e. the lineages alive at those times). An edge
+crosses time t if its child is no older than t and its parent is older than t.
+
+The index is a centered interval tree stored in flat arrays, so that it can be saved
+next to the tree sequence and shared by every analysis and figure which uses it.
+Each query takes O(log E + k) time for E edges, k of which cross the time.
+"""
+import logging
+import os
+
+import numpy as np
+
+# Nodes of the interval tree with at most this many edges are not split further
+LEAF_SIZE = 1024
+
+
+class EdgeTimeIndex:
+    def __init__(self, arrays):
+        # center, left and right are per interval-tree node (center is NaN for
+        # leaves); offsets delimit each node's edges in the other arrays, which
+        # hold them sorted by start time and by descending end time
+        self.arrays = arrays
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    @classmethod
+    def from_ts(cls, ts):
+        times = ts.tables.nodes.time
+        edges = ts.tables.edges
+        return cls.from_intervals(times[edges.child], times[edges.parent])
+
+    @classmethod
+    def from_intervals(cls, start, end):
+        center = []
+        left = []
+        right = []
+        segments = []
+        # Stack of (edge ids, index of the parent node, whether it is a right child)
+        stack = [(np.arange(len(start)), -1, False)]
+        while len(stack) > 0:
+            ids, parent, is_right = stack.pop()
+            node = len(center)
+            if parent >= 0:
+                (right if is_right else left)[parent] = node
+            left.append(-1)
+            right.append(-1)
+            if len(ids) <= LEAF_SIZE:
+                center.append(np.nan)
+                segments.append(ids)
+                continue
+            mid_point = np.median(np.concatenate([start[ids], end[ids]]))
+            crossing = np.logical_and(start[ids] <= mid_point, end[ids] > mid_point)
+            if not np.any(crossing):
+                # Use the start of an edge, which is sure to be crossed unless the
+                # edge has zero length
+                nonempty = ids[start[ids] < end[ids]]
+                if len(nonempty) == 0:
+                    # No time is crossed by these edges, so there is nothing to split
+                    center.append(np.nan)
+                    segments.append(ids)
+                    continue
+                mid_point = start[nonempty[0]]
+                crossing = np.logical_and(start[ids] <= mid_point, end[ids] > mid_point)
+            center.append(mid_point)
+            segments.append(ids[crossing])
+            stack.append((ids[end[ids] <= mid_point], node, False))
+            stack.append((ids[start[ids] > mid_point], node, True))
+
+        by_start = np.concatenate(
+            [segment[np.argsort(start[segment], kind="stable")] for segment in segments]
+        ).astype(np.int32)
+        by_end = np.concatenate(
+            [segment[np.argsort(-end[segment], kind="stable")] for segment in segments]
+        ).astype(np.int32)
+        return cls(
+            {
+                "center": np.array(center),
+                "left": np.array(left, dtype=np.int32),
+                "right": np.array(right, dtype=np.int32),
+                "offsets": np.cumsum([0] + [len(s) for s in segments]),
+                "by_start": by_start,
+                "start": start[by_start],
+                "start_end": end[by_start],
+                "by_end": by_end,
+                "neg_end": -end[by_end],
+            }
+        )
+
+    def crossing_edges(self, time):
+        """
+        Return the sorted IDs of the edges which cross time
+        """
+        found = []
+        node = 0
+        while node != -1:
+            first, last = self.offsets[node], self.offsets[node + 1]
+            if np.isnan(self.center[node]):
+                alive = np.logical_and(
+                    self.start[first:last] <= time, self.start_end[first:last] > time
+                )
+                found.append(self.by_start[first:last][alive])
+                break
+            if time < self.center[node]:
+                # Every edge here ends after time, so only the start needs checking
+                count = np.searchsorted(self.start[first:last], time, side="right")
+                found.append(self.by_start[first : first + count])
+                node = self.left[node]
+            else:
+                count = np.searchsorted(self.neg_end[first:last], -time, side="left")
+                found.append(self.by_end[first : first + count])
+                node = self.right[node]
+        return np.sort(np.concatenate(found))
+
+    def crossing_edges_at(self, times):
+        """
+        Return a list of the crossing_edges() at each of times
+        """
+        return [self.crossing_edges(time) for time in times]
+
+    def save(self, path, fingerprint):
+        np.savez(path, fingerprint=fingerprint, **self.arrays)
+
+
+def fingerprint(ts):
+    """
+    Summary of the nodes and edges of ts, to check a saved index belongs to it
+    """
+    tables = ts.tables
+    return np.array(
+        [
+            ts.num_nodes,
+            ts.num_edges,
+            np.sum(tables.nodes.time),
+            np.sum(tables.edges.parent),
+            np.sum(tables.edges.child),
+        ]
+    )
+
+
+def load_or_build(ts, path):
+    """
+    Return the EdgeTimeIndex of ts saved at path, building and saving it first if
+    there is none (or the saved one is for a different tree sequence)
+    """
+    expected = fingerprint(ts)
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            arrays = dict(saved)
+        if np.array_equal(arrays.pop("fingerprint"), expected):
+            return EdgeTimeIndex(arrays)
+        logging.warning("Rebuilding out of date edge index {}".format(path))
+    index = EdgeTimeIndex.from_ts(ts)
+    index.save(path, expected)
+    return index
@@ -25,7 +25,10 @@ import tskit
 import stdpopsim
 
 import utility
+import kc
 import run_inference
+import scheduler
+import storage
 from intervals import read_hapmap
 
 import tsdate  # NOQA
@@ -274,6 +277,36 @@ def sampledata_to_vcf(sample_data, filename):
     return df
 
 
+def align_ages(positions, columns):
+    """
+    Left join of several age estimates onto the given sorted positions. columns maps
+    each column name to a (positions, ages) tuple, where positions must be sorted.
+    Positions with no estimate are given NaN. Returns a DataFrame indexed by
+    positions.
+    """
+    aligned = {}
+    for name, (col_positions, col_ages) in columns.items():
+        ages = np.full(len(positions), np.nan)
+        if len(col_positions) > 0:
+            index = np.searchsorted(col_positions, positions)
+            found = index < len(col_positions)
+            found[found] = col_positions[index[found]] == positions[found]
+            ages[found] = col_ages[index[found]]
+        aligned[name] = ages
+    return pd.DataFrame(aligned, index=positions)
+
+
+def sorted_unique_ages(positions, ages):
+    """
+    Sort ages by position, keeping the first of any ages at the same position
+    """
+    positions = np.asarray(positions)
+    ages = np.asarray(ages, dtype=float)
+    order = np.argsort(positions, kind="stable")
+    positions, first = np.unique(positions[order], return_index=True)
+    return positions, ages[order][first]
+
+
 def compare_mutations(
     ts_list,
     method_names=["tsdate", "tsdate_inferred"],
@@ -281,6 +314,7 @@ def compare_mutations(
     relate_reinfer=None,
     geva_ages=None,
     geva_positions=None,
+    parquet_path=None,
 ):
     """
     Given a list of tree sequences, return a pandas dataframe with the age
@@ -290,72 +324,55 @@ def compare_mutations(
     ts_list: The list of tree sequences
     geva_ages: mutation age estimates from geva (pandas df)
     relate_ages: mutation age estimates from relate (pandas df)
-    Returns a DataFrame of mutations and age estimates from each method
+    parquet_path: if given, the dataframe is also written to this Parquet file
+    Returns a DataFrame of mutations and age estimates from each method, with a row
+    for each site of the simulated tree sequence
     """
 
     assert len(ts_list) == len(method_names)
     # Load tree sequences: simulated, dated (topo), dated(inferred)
     ts = ts_list[0]
     print("Number of mutations", ts.num_mutations)
-    run_results = utility.get_mut_pos_df(
-        ts, "simulated_ts", ts.tables.nodes.time, node_selection="msprime"
-    )
-    print("Number of mutations with true dates", run_results.shape[0])
+    positions, sim_ages = utility.get_mut_pos_ages(ts)
+    print("Number of mutations with true dates", len(positions))
+    columns = {"simulated_ts": (positions, sim_ages)}
 
     for cur_ts, method in zip(ts_list[1:], method_names[1:]):
         # Load age of mutations for each tree sequence
-        mut_dated_ages = utility.get_mut_pos_df(
-            cur_ts,
-            method,
-            cur_ts.tables.nodes.time,
-            node_selection="arithmetic",
-            exclude_root=True,
-        )
-        print("Number of mutations dated by " + method + ": ", mut_dated_ages.shape[0])
-        run_results = pd.merge(
-            run_results, mut_dated_ages, how="left", left_index=True, right_index=True
+        columns[method] = utility.get_mut_pos_ages(cur_ts, exclude_root=True)
+        print(
+            "Number of mutations dated by " + method + ": ", len(columns[method][0])
         )
 
-    # If Relate and GEVA were run, load mutation ages as pandas dataframe
-    # Create an "age" column for both
-    def get_relate_df(relate_ages, run_results, col_name):
+    # If Relate and GEVA were run, load their mutation ages
+    def get_relate_ages(relate_ages, col_name):
         # remove mutations that relate can't date or flipped
         relate_ages = relate_ages[relate_ages["is_flipped"] == 0]
         relate_ages = relate_ages[relate_ages["is_not_mapping"] == 0]
-        relate_ages[col_name] = (relate_ages["age_begin"] + relate_ages["age_end"]) / 2
-        relate = relate_ages[["pos_of_snp", col_name]].copy()
-        relate = relate.rename(columns={"pos_of_snp": "position"}).set_index("position")
-        print("Number of mutations dated by " + col_name + ": ", relate.shape[0])
-        run_results = pd.merge(
-            run_results, relate, how="left", left_index=True, right_index=True
+        print("Number of mutations dated by " + col_name + ": ", relate_ages.shape[0])
+        return sorted_unique_ages(
+            relate_ages["pos_of_snp"].values,
+            (relate_ages["age_begin"].values + relate_ages["age_end"].values) / 2,
         )
-        return run_results
 
     if relate_ages is not None:
-        run_results = get_relate_df(relate_ages, run_results, col_name="relate")
+        columns["relate"] = get_relate_ages(relate_ages, col_name="relate")
     if relate_reinfer is not None:
-        run_results = get_relate_df(
-            relate_reinfer, run_results, col_name="relate_iterate"
+        columns["relate_iterate"] = get_relate_ages(
+            relate_reinfer, col_name="relate_iterate"
         )
 
     if geva_ages is not None and geva_positions is not None:
-        # Merge the GEVA position indices and age estimates
-        geva = pd.merge(
-            geva_ages["PostMean"],
-            geva_positions["Position"],
-            how="left",
-            left_index=True,
-            right_index=True,
-        )
         # For GEVA, we use PostMean as the age estimate
-        geva = geva.rename(
-            columns={"PostMean": "geva", "Position": "position"}
-        ).set_index("position")
-        print("Number of mutations dated by GEVA", geva.shape[0])
-        run_results = pd.merge(
-            run_results, geva, how="left", left_index=True, right_index=True
+        geva_marker_positions = geva_positions["Position"].reindex(geva_ages.index)
+        print("Number of mutations dated by GEVA", geva_ages.shape[0])
+        columns["geva"] = sorted_unique_ages(
+            geva_marker_positions.values, geva_ages["PostMean"].values
         )
 
+    run_results = align_ages(positions, columns)
+    if parquet_path is not None:
+        run_results.to_parquet(parquet_path)
     return run_results
 
 
@@ -426,20 +443,113 @@ def get_dated_ts(ts, dates, Ne, eps):
     return dated_ts
 
 
-def get_kc_distances(ts_list, method_names):
+def trees_at(ts, positions):
     """
-    Get kc_distances between a list of tree sequences with lambda at 0 and 1.
-    Simulated tree sequence must be first in the list.
+    Yield the tree of ts at each of the given positions, which must be sorted, with
+    sample lists as needed by Tree.kc_distance(). The same Tree object is moved to
+    each position in turn.
+    """
+    tree = tskit.Tree(ts, sample_lists=True)
+    for position in positions:
+        tree.seek(position)
+        yield tree
+
+
+def sampled_kc_distance(
+    ts1,
+    ts2,
+    lambdas=(0, 1),
+    num_positions=1000,
+    num_bootstrap=1000,
+    confidence=0.95,
+    random_seed=None,
+):
     """
+    Estimate the KC distances between ts1 and ts2 from the trees at num_positions
+    random positions, one drawn uniformly from each of num_positions equal strata of
+    the sequence, so that each tree is sampled in proportion to its span. Returns an
+    (estimate, lower, upper) tuple for each value of lambda, with a bootstrap
+    confidence interval.
+    """
+    if ts1.sequence_length != ts2.sequence_length:
+        raise ValueError("Sequence lengths must be identical to compare")
+    if ts1.num_samples != ts2.num_samples:
+        raise ValueError("Cannot compare trees with different numbers of samples")
+    rng = np.random.default_rng(random_seed)
+    sequence_length = ts1.sequence_length
+    stratum = sequence_length / num_positions
+    positions = np.arange(num_positions) * stratum + rng.uniform(
+        0, stratum, num_positions
+    )
+    distances = np.zeros((len(lambdas), num_positions))
+    for i, (tree1, tree2) in enumerate(
+        zip(trees_at(ts1, positions), trees_at(ts2, positions))
+    ):
+        for j, lambda_ in enumerate(lambdas):
+            distances[j, i] = tree1.kc_distance(tree2, lambda_=lambda_)
+    resamples = rng.integers(0, num_positions, (num_bootstrap, num_positions))
+    bootstrap = np.mean(distances[:, resamples], axis=2)
+    tail = 100 * (1 - confidence) / 2
+    lower, upper = np.percentile(bootstrap, [tail, 100 - tail], axis=1)
+    return list(zip(np.mean(distances, axis=1), lower, upper))
+
+
+def kc_comparison(ts, others, lambdas, num_positions=None, random_seed=None):
+    """
+    KC distances between ts and each of others at each of lambdas, exact or
+    estimated from num_positions sampled trees
+    """
+    if num_positions is None:
+        return kc.kc_distances(ts, others, lambdas)
+    return [
+        sampled_kc_distance(ts, other, lambdas, num_positions, random_seed=random_seed)
+        for other in others
+    ]
 
-    # Load tree sequences
-    first_ts = ts_list[0]
-    results_lambda_0 = dict()
-    results_lambda_1 = dict()
-    for ts, method_name in zip(ts_list[1:], method_names[1:]):
-        results_lambda_0[method_name] = first_ts.kc_distance(ts, lambda_=0)
-        results_lambda_1[method_name] = first_ts.kc_distance(ts, lambda_=1)
-    return pd.DataFrame.from_dict([results_lambda_0, results_lambda_1])
+
+def get_kc_distances(
+    ts_list,
+    method_names,
+    lambdas=(0, 1),
+    num_processes=1,
+    num_positions=None,
+    random_seed=None,
+):
+    """
+    Get kc_distances between a list of tree sequences, with one row for each value
+    of lambda (by default 0 and 1). Simulated tree sequence must be first in the
+    list. Exact distances at every lambda come from a single pass along the genome
+    with kc.kc_distances(). The methods are split into num_processes tasks, run in
+    worker processes, or in this process if it is itself a pool worker (which cannot
+    start processes of its own). If num_positions is given, distances are estimated
+    from that many sampled trees with sampled_kc_distance(), and the bounds of their
+    95% confidence intervals are added in the {method}_lower and {method}_upper
+    columns.
+    """
+    if multiprocessing.current_process().daemon:
+        num_processes = 1
+    # The methods are split between the processes, as each pass along the genome
+    # walks the trees of the simulated tree sequence once for all its methods
+    groups = np.array_split(np.arange(1, len(ts_list)), max(1, num_processes))
+    tasks = []
+    for group in groups:
+        if len(group) > 0:
+            others = [ts_list[j] for j in group]
+            args = (ts_list[0], others, lambdas, num_positions, random_seed)
+            tasks.append(scheduler.Task(len(tasks), kc_comparison, args, []))
+    grouped = dict(scheduler.run_tasks(tasks, len(tasks)))
+    distances = [row for i in range(len(tasks)) for row in grouped[i]]
+    results = [dict() for _ in lambdas]
+    for i, method_name in enumerate(method_names[1:]):
+        for j in range(len(lambdas)):
+            if num_positions is None:
+                results[j][method_name] = distances[i][j]
+            else:
+                estimate, lower, upper = distances[i][j]
+                results[j][method_name] = estimate
+                results[j][method_name + "_lower"] = lower
+                results[j][method_name + "_upper"] = upper
+    return pd.DataFrame.from_dict(results)
 
 
 def run_tsinfer(
@@ -616,7 +726,7 @@ def run_geva(file_name, Ne, mut_rate, rec_rate=None, genetic_map_path=None):
                 "--rec",
                 str(rec_rate),
                 "--vcf",
-                file_name + ".vcf",
+                storage.vcf_path(file_name),
             ]
         )
     else:
@@ -628,7 +738,7 @@ def run_geva(file_name, Ne, mut_rate, rec_rate=None, genetic_map_path=None):
                 "--map",
                 genetic_map_path,
                 "--vcf",
-                file_name + ".vcf",
+                storage.vcf_path(file_name),
             ]
         )
     with open(file_name + ".positions.txt", "wb") as out:
@@ -0,0 +1,294 @@
+"""
+Kendall-Colijn (KC) distances between tree sequences for several values of lambda
+in a single pass along the genome, giving the same results as
+TreeSequence.kc_distance().
+
+The KC vectors of a tree hold, for each pair of samples, the number of edges m and
+the time M between the root and their MRCA, and the length of the branch above each
+sample. The distance between two trees at lambda is the norm of the difference of
+(1 - lambda) m + lambda M, so its square follows from the inner products of the m
+and M vectors of the two trees, and of each tree with itself, at any lambda.
+
+The m and M entries of a pair of samples are sums over the edges above their MRCA,
+of 1 and of the edge length respectively. An inner product of the vectors of two
+trees is then a sum over pairs of edges, one from each tree, of the product of their
+weights and the number of pairs of samples below both. The numbers of samples below
+each pair of nodes are kept in an overlap matrix, which is updated as edges are
+removed and inserted along the genome, so that only the nodes above a changed edge
+are revisited at each breakpoint rather than every pair of samples.
+
+Differences of inner products lose precision when the two trees are close, so the
+distances at those trees are computed by Tree.kc_distance() instead.
+"""
+import numpy as np
+import tskit
+
+# Squared distances below this fraction of the squared norms of the two trees'
+# vectors are too close to the rounding error of their inner products, which is
+# about 1e-12 of the norms
+TOLERANCE = 1e-6
+
+
+def pairs(counts):
+    """
+    Number of pairs of samples in each of counts samples
+    """
+    return counts * (counts - 1) / 2
+
+
+class TreeState:
+    """
+    The current tree of a tree sequence, with its nodes stored in slots so that
+    the overlap matrices stay small. Samples are always in the first slots, in the
+    order of ts.samples(). The weights of each slot are those of the edge above it,
+    1 for m and its length for M (or 0 for a root).
+    """
+
+    def __init__(self, ts):
+        self.ts = ts
+        self.times = ts.tables.nodes.time
+        self.num_samples = ts.num_samples
+        # A tree without unary nodes has fewer than twice as many nodes as samples
+        capacity = 2 * ts.num_samples
+        self.slot = np.full(ts.num_nodes, -1)
+        self.slot[ts.samples()] = np.arange(ts.num_samples)
+        self.node = np.full(capacity, -1)
+        self.node[: ts.num_samples] = ts.samples()
+        self.free = list(range(capacity - 1, ts.num_samples - 1, -1))
+        self.parent = [-1] * capacity
+        self.num_children = [0] * capacity
+        # The parent of each slot as an array, with an extra slot above the roots
+        # (whose weights and counts stay 0)
+        self.up = np.full(capacity + 1, capacity)
+        self.weights = np.zeros((capacity + 1, 2))
+        self.counts = np.zeros(capacity + 1)
+        self.counts[: ts.num_samples] = 1
+        # Overlap matrices with this tree's slots as rows (axis 0) or columns
+        self.comparisons = []
+        self.diffs = ts.edge_diffs()
+        self.right = 0
+        self.products = None
+
+    def get_slot(self, node):
+        if self.slot[node] == -1:
+            if len(self.free) == 0:
+                raise ValueError("Trees must be simplified, with no unary nodes")
+            self.slot[node] = self.free.pop()
+            self.node[self.slot[node]] = node
+        return self.slot[node]
+
+    def release(self, slot):
+        """
+        Free the slot of a non-sample node with no edges left
+        """
+        if slot >= self.num_samples and self.num_children[slot] == 0:
+            if self.parent[slot] == -1:
+                self.slot[self.node[slot]] = -1
+                self.node[slot] = -1
+                self.free.append(slot)
+
+    def path(self, slot):
+        """
+        Return the slots from slot up to the root
+        """
+        path = [slot]
+        while self.parent[path[-1]] != -1:
+            path.append(self.parent[path[-1]])
+        return path
+
+    def update(self, parent, child, insert):
+        """
+        Insert or remove the edge from parent to child (both slots), returning the
+        slots from parent up to the root
+        """
+        path = self.path(parent)
+        self.num_children[parent] += 1 if insert else -1
+        if insert:
+            self.parent[child] = parent
+            self.up[child] = parent
+            length = self.times[self.node[parent]] - self.times[self.node[child]]
+            self.weights[child] = 1, length
+        else:
+            self.parent[child] = -1
+            self.up[child] = len(self.parent)
+            self.weights[child] = 0
+        return path
+
+    def advance(self):
+        """
+        Move to the next tree, returning the right end of its interval
+        """
+        interval, edges_out, edges_in = next(self.diffs)
+        old_weights = self.weights.copy()
+        moves = []
+        parents = set()
+        for edge in edges_out:
+            parent, child = self.slot[edge.parent], self.slot[edge.child]
+            moves.append((self.update(parent, child, insert=False), child, -1))
+            self.release(child)
+            self.release(parent)
+            parents.add(edge.parent)
+        for edge in edges_in:
+            parent, child = self.get_slot(edge.parent), self.get_slot(edge.child)
+            moves.append((self.update(parent, child, insert=True), child, 1))
+            parents.add(edge.parent)
+        if any(self.num_children[self.slot[node]] == 1 for node in parents):
+            raise ValueError("Trees must be simplified, with no unary nodes")
+        # Slots whose weights or samples have changed (a slot may have been
+        # released and reused, which is fine as its old part is removed first),
+        # and the combined moves of samples between them, where moving the samples
+        # below a child to each slot in a path adds its column to theirs
+        affected = list({slot for path, child, _ in moves for slot in path + [child]})
+        index = {slot: i for i, slot in enumerate(affected)}
+        transfer = np.eye(len(affected))
+        for path, child, sign in moves:
+            columns = [index[slot] for slot in path]
+            transfer[:, columns] += sign * transfer[:, [index[child]]]
+        self.counts[affected] = self.counts[affected] @ transfer
+        if self.counts[self.path(0)[-1]] != self.num_samples:
+            raise ValueError("Trees with multiple roots are not supported")
+        for comparison, axis in self.comparisons:
+            comparison.update(axis, affected, transfer, old_weights)
+        self.products = self.self_products()
+        self.right = interval[1]
+        return self.right
+
+    def self_products(self):
+        """
+        Return the 2x2 matrix of inner products of the m and M vectors of the
+        pairs of samples in this tree with themselves
+        """
+        # Sums of the weights of the edges above the parent of each slot, by
+        # pointer jumping
+        up = self.up
+        above = self.weights[up]
+        while np.any(up != len(self.parent)):
+            above = above + above[up]
+            up = up[up]
+        weighted = pairs(self.counts)[:, np.newaxis] * self.weights
+        # Nested edges both count the pairs of samples below the lower one
+        below = weighted.T @ (self.weights + above)
+        return below + (weighted.T @ above).T
+
+
+class Comparison:
+    """
+    Overlap matrix of the numbers of samples below each pair of slots of tree1
+    (rows) and tree2 (columns), with the inner products of their m and M vectors
+    """
+
+    def __init__(self, tree1, tree2):
+        self.tree1 = tree1
+        self.tree2 = tree2
+        # Counts are exact in single precision, which halves the memory
+        self.overlaps = np.zeros((len(tree1.up), len(tree2.up)), dtype=np.float32)
+        samples = np.arange(tree1.num_samples)
+        self.overlaps[samples, samples] = 1
+        self.products = np.zeros((2, 2))
+        self.squares = None
+        self.norms = None
+        tree1.comparisons.append((self, 0))
+        tree2.comparisons.append((self, 1))
+
+    def update(self, axis, slots, transfer, old_weights):
+        """
+        Apply the transfer of samples between slots of the tree on axis, updating
+        the products from the old to the current weights of that tree
+        """
+        if axis == 0:
+            old = self.overlaps[slots]
+            new = transfer.T @ old
+            self.overlaps[slots] = new
+            weights = self.tree1.weights
+            change = weights[slots].T @ pairs(new) - old_weights[slots].T @ pairs(old)
+            self.products += change @ self.tree2.weights
+        else:
+            old = self.overlaps[:, slots]
+            new = old @ transfer
+            self.overlaps[:, slots] = new
+            weights = self.tree2.weights
+            change = pairs(new) @ weights[slots] - pairs(old) @ old_weights[slots]
+            self.products += self.tree1.weights.T @ change
+        self.squares = None
+
+    def squared_distances(self, lambdas):
+        """
+        Squared KC distances between the current trees at each of lambdas, and the
+        sums of the squared norms of their vectors
+        """
+        if self.squares is not None:
+            return self.squares, self.norms
+        products1 = self.tree1.products
+        products2 = self.tree2.products
+        topology = products1[0, 0] + products2[0, 0] - 2 * self.products[0, 0]
+        mixed = (
+            products1[0, 1]
+            + products2[0, 1]
+            - self.products[0, 1]
+            - self.products[1, 0]
+        )
+        samples = np.arange(self.tree1.num_samples)
+        leaves = self.tree1.weights[samples, 1] - self.tree2.weights[samples, 1]
+        branch = (
+            products1[1, 1]
+            + products2[1, 1]
+            - 2 * self.products[1, 1]
+            + np.dot(leaves, leaves)
+        )
+        self.squares = (
+            (1 - lambdas) ** 2 * topology
+            + 2 * lambdas * (1 - lambdas) * mixed
+            + lambdas ** 2 * branch
+        )
+        norms = products1 + products2
+        leaf_norms = np.sum(self.tree1.weights[samples, 1] ** 2) + np.sum(
+            self.tree2.weights[samples, 1] ** 2
+        )
+        self.norms = (
+            (1 - lambdas) ** 2 * norms[0, 0]
+            + lambdas * (1 - lambdas) * (norms[0, 1] + norms[1, 0])
+            + lambdas ** 2 * (norms[1, 1] + leaf_norms)
+        )
+        return self.squares, self.norms
+
+
+def kc_distances(ts, others, lambdas=(0, 1)):
+    """
+    Return an array of the KC distances between ts and each of the tree sequences in
+    others (rows) at each value of lambda (columns), i.e. the average over the
+    genome of the distances between their trees, weighted by span
+    """
+    for other in others:
+        if other.sequence_length != ts.sequence_length:
+            raise ValueError("Sequence lengths must be identical to compare")
+        if other.num_samples != ts.num_samples:
+            raise ValueError("Cannot compare trees with different numbers of samples")
+    lambdas = np.array(lambdas, dtype=float)
+    tree = TreeState(ts)
+    other_trees = [TreeState(other) for other in others]
+    comparisons = [Comparison(tree, other_tree) for other_tree in other_trees]
+    # Trees for the intervals where the two trees are close, moved there as needed
+    exact_tree = tskit.Tree(ts, sample_lists=True)
+    exact_others = [tskit.Tree(other, sample_lists=True) for other in others]
+    distances = np.zeros((len(others), len(lambdas)))
+    left = 0
+    while left < ts.sequence_length:
+        for state in [tree] + other_trees:
+            if state.right == left:
+                state.advance()
+        right = min(state.right for state in [tree] + other_trees)
+        for i, comparison in enumerate(comparisons):
+            squares, norms = comparison.squared_distances(lambdas)
+            distance = np.sqrt(np.maximum(squares, 0))
+            # Topology terms are sums of integers, so only lambda > 0 can be affected
+            close = np.flatnonzero((squares < TOLERANCE * norms) & (lambdas > 0))
+            if len(close) > 0:
+                exact_tree.seek(left)
+                exact_others[i].seek(left)
+                for j in close:
+                    distance[j] = exact_tree.kc_distance(
+                        exact_others[i], lambda_=lambdas[j]
+                    )
+            distances[i] += (right - left) * distance
+        left = right
+    return distances / ts.sequence_length
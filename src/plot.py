@@ -36,6 +36,7 @@ import cartopy.crs as ccrs
 from matplotlib.animation import FuncAnimation
 
 import constants
+import edge_index
 import utility
 
 sgdp_region_map = {
@@ -530,7 +531,7 @@ class Chr20AncientIteration(Figure):
         plt.setp(ax[0, 1].artists, edgecolor="k", facecolor="silver")
         plt.setp(ax[0, 0].lines, color="k")
         plt.setp(ax[0, 1].lines, color="k")
-        cols = ["Subset " + str(subset) for subset in [1, 5, 10]]
+        cols = [col for col in df.columns if col.startswith("Subset ")]
         df_melt = df.melt(value_vars=cols)
         df_melt["variable"] = df_melt["variable"].str.split().str[-1]
 
@@ -600,7 +601,7 @@ class Chr20AncientIteration(Figure):
         plt.setp(ax[1, 0].lines, color="k")
         plt.setp(ax[1, 1].lines, color="k")
 
-        cols = ["Subset " + str(subset) for subset in [1, 5, 10]]
+        cols = [col for col in spearman.columns if col.startswith("Subset ")]
 
         df_melt = spearman.melt(value_vars=cols)
         df_melt["variable"] = df_melt["variable"].str.split().str[-1]
@@ -2590,19 +2591,17 @@ class WorldDensity(Figure):
             ))[0]
         )
         times = ts.tables.nodes.time[:]
-        for time in [100, 1000, 2240, 5600, 11200, 33600]:
+        time_points = [100, 1000, 2240, 5600, 11200, 33600]
+        index = edge_index.load_or_build(ts, constants.NO_TGP_EDGE_INDEX)
+        for time, time_slice in zip(time_points, index.crossing_edges_at(time_points)):
             _ = plt.figure(figsize=(15, 6))
             ax = plt.axes(projection=ccrs.Robinson(central_longitude=41))
             ax.coastlines(linewidth=0.1)
             ax.add_feature(cartopy.feature.LAND, facecolor="lightgray")
             ax.set_global()
             ax.set_extent([-170, 180, -40, 90], crs=ccrs.Geodetic())
-            edges = np.logical_and(
-                times[ts.tables.edges.child] <= time,
-                times[ts.tables.edges.parent] > time,
-            )
-            time_slice_child = ts.tables.edges.child[edges]
-            time_slice_parent = ts.tables.edges.parent[edges]
+            time_slice_child = ts.tables.edges.child[time_slice]
+            time_slice_parent = ts.tables.edges.parent[time_slice]
             edge_lengths = times[time_slice_parent] - times[time_slice_child]
             weight_parent = 1 - ((times[time_slice_parent] - time) / edge_lengths)
             weight_child = 1 - ((time - times[time_slice_child]) / edge_lengths)
@@ -3104,7 +3103,7 @@ class AncestryVideo(Figure):
             ))[0]
         )
         tables = self.main_ts().tables
-        times = tables.nodes.time[:]
+        times = ts_no_tgp.tables.nodes.time[:]
         reference_sets = []
         population_names = []
         pop_region_map = []
@@ -3187,13 +3186,13 @@ class AncestryVideo(Figure):
 
         time_intervals_log = np.concatenate([lintime, logtime])
         ancestor_children = []
-        for time in time_intervals_log:
-            edges = np.logical_and(
-                times[ts_no_tgp.tables.edges.child] <= time,
-                times[ts_no_tgp.tables.edges.parent] > time,
-            )
-            time_slice_child = ts_no_tgp.tables.edges.child[edges]
-            time_slice_parent = ts_no_tgp.tables.edges.parent[edges]
+        index = edge_index.load_or_build(ts_no_tgp, constants.NO_TGP_EDGE_INDEX)
+        edges = ts_no_tgp.tables.edges
+        for time, time_slice in zip(
+            time_intervals_log, index.crossing_edges_at(time_intervals_log)
+        ):
+            time_slice_child = edges.child[time_slice]
+            time_slice_parent = edges.parent[time_slice]
             ancestor_children.append(time_slice_child)
             edge_lengths = times[time_slice_parent] - times[time_slice_child]
             weight_parent = 1 - ((times[time_slice_parent] - time) / edge_lengths)
@@ -15,6 +15,7 @@ import multiprocessing
 import numpy as np
 import random
 import shutil
+import sys
 from tqdm import tqdm
 import scipy
 from sklearn.metrics import mean_squared_log_error
@@ -30,7 +31,13 @@ import evaluation
 import constants
 import utility
 import error_generation
-from intervals import read_hapmap
+import benchmark
+import scheduler
+import simcache
+import storage
+import workqueue
+import cost_model
+from intervals import read_hapmap, RateMap
 
 
 class DataGeneration:
@@ -46,6 +53,16 @@ class DataGeneration:
     # Each summary has a unique name. This is used as the identifier for the csv file.
     name = None
 
+    # Methods run in each stage of inference, used to estimate the memory of a task
+    stage_methods = {}
+
+    # Whether inference is split into tasks which can be run from the work queue
+    queueable = True
+
+    # Whether inference only needs the simulated tree sequence and sample data
+    # files, so that it can be run in memory (see run_in_memory())
+    in_memory_inputs = False
+
     def __init__(self):
         self.data_file = os.path.abspath(
             os.path.join(self.data_dir, self.name + ".csv")
@@ -67,6 +84,30 @@ class DataGeneration:
         self.make_vcf = True
         self.empirical_error = False
         self.ancestral_state_error = False
+        # Threads used by each tsinfer and tsdate call, see plan_parallelism()
+        self.num_threads = 1
+        self.simulation_cache = simcache.SimulationCache(
+            os.path.join(self.data_dir, "simulation_cache")
+        )
+        # Where memoized inference stages are stored, or None to keep them in memory
+        self.stage_cache_dir = os.path.join(self.data_dir, "stage_cache")
+        # Write tree sequences with tszip and VCFs with bgzip to save disk space
+        self.compress_outputs = True
+        # If set, inference results are collected from workers through this queue
+        self.work_queue = None
+        # When running in memory, the replicate simulated by setup(), the inputs it
+        # would otherwise have written (keyed by file path) and whether to still
+        # save the simulated tree sequence
+        self.in_memory = False
+        self.only_replicate = None
+        self.inputs = {}
+        self.save_simulations = False
+        # "exact" KC distances, or "sampled" to estimate them from the trees at
+        # kc_positions random positions
+        self.kc_mode = "exact"
+        self.kc_positions = 1000
+        # Also write the mutation ages compared on each sample file to Parquet
+        self.mutations_parquet = False
 
     def setup(
         self,
@@ -78,8 +119,12 @@ class DataGeneration:
         progress=False,
     ):
         """
-        Run Simulations
+        Run Simulations. When running in memory, setup() only records the
+        replicates, and is run again for each replicate at the start of inference
+        with only_replicate set, keeping its inputs in self.inputs.
         """
+        # Index of the current replicate's row in self.data
+        row_index = -1
         for param in tqdm(
             parameter_arr, desc="Running Simulations", disable=not progress
         ):
@@ -89,33 +134,52 @@ class DataGeneration:
             for index, seed in tqdm(
                 enumerate(seeds), desc="Running Iterations", total=len(seeds)
             ):
-                sim = simulate_func((param, seed))
-                # Dump simulated tree
+                row_index += 1
                 filename = self.name + "_" + str(param) + "_" + str(index)
                 row_data["filename"] = filename
                 row_data["replicate"] = index
+                row_data["seed"] = seed
+                if param:
+                    row_data[parameter] = param
+                if self.in_memory:
+                    if self.only_replicate is None:
+                        # Simulations are run with inference
+                        self.data = self.data.append(row_data, ignore_index=True)
+                        continue
+                    if row_index != self.only_replicate:
+                        continue
+
+                sim = simulate_func((param, seed))
                 row_data["n_edges"] = sim.num_edges
                 row_data["n_trees"] = sim.num_trees
                 row_data["n_sites"] = sim.num_sites
-                row_data["seed"] = seed
 
-                if param:
-                    row_data[parameter] = param
                 # Save the simulated tree sequence
-                sim.dump(os.path.join(self.data_dir, filename + ".trees"))
+                path_to_file = os.path.join(self.data_dir, filename)
+                if self.in_memory:
+                    self.inputs[path_to_file + ".trees"] = sim
+                if not self.in_memory or self.save_simulations:
+                    storage.dump_ts(
+                        sim, path_to_file + ".trees", compress=self.compress_outputs
+                    )
+
+                # Create sampledata file, in memory if its path is None
+                def samples_path(suffix):
+                    if self.in_memory:
+                        return None
+                    return path_to_file + suffix
 
-                # Create sampledata file
                 samples = tsinfer.formats.SampleData.from_tree_sequence(
                     sim,
                     use_sites_time=False,
                 )
-                sample_data_indiv_times = samples.copy(
-                    path=os.path.join(self.data_dir, filename + ".samples")
-                )
+                sample_data_indiv_times = samples.copy(path=samples_path(".samples"))
                 sample_data_indiv_times.individuals_time[:] = np.array(
                     sim.tables.nodes.time[sim.samples()]
                 )
                 sample_data_indiv_times.finalise()
+                if self.in_memory:
+                    self.inputs[path_to_file + ".samples"] = sample_data_indiv_times
 
                 # Add error to sampledata file
                 if self.empirical_error:
@@ -130,10 +194,10 @@ class DataGeneration:
                         )
                     )
                     error_samples = error_samples.subset(sites=invariant_sites)
-                    copy = error_samples.copy(
-                        os.path.join(self.data_dir, filename + ".error.samples")
-                    )
+                    copy = error_samples.copy(samples_path(".error.samples"))
                     copy.finalise()
+                    if self.in_memory:
+                        self.inputs[path_to_file + ".error.samples"] = copy
 
                 # Add error to sampledata file
                 if self.ancestral_state_error:
@@ -157,14 +221,21 @@ class DataGeneration:
                         )[0]
                     )
                     copy = anc_error_samples.copy(
-                        os.path.join(
-                            self.data_dir, filename + ".ancestral_state.error.samples"
-                        )
+                        samples_path(".ancestral_state.error.samples")
                     )
                     copy.finalise()
+                    if self.in_memory:
+                        suffix = ".ancestral_state.error.samples"
+                        self.inputs[path_to_file + suffix] = copy
+
+                # Inputs for Relate and GEVA are not needed when running in memory
+                if self.in_memory:
+                    self.data = self.data.append(row_data, ignore_index=True)
+                    continue
 
                 # Create VCF file
                 if self.make_vcf:
+                    vcf_prefixes = [filename]
                     with open(
                         os.path.join(self.data_dir, filename + ".vcf"), "w"
                     ) as vcf_file:
@@ -174,6 +245,7 @@ class DataGeneration:
                             error_samples,
                             os.path.join(self.data_dir, filename + ".error"),
                         )
+                        vcf_prefixes.append(filename + ".error")
                     if self.ancestral_state_error:
                         evaluation.sampledata_to_vcf(
                             anc_error_samples,
@@ -181,6 +253,12 @@ class DataGeneration:
                                 self.data_dir, filename + ".ancestral_state.error"
                             ),
                         )
+                        vcf_prefixes.append(filename + ".ancestral_state.error")
+                    if self.compress_outputs:
+                        for prefix in vcf_prefixes:
+                            storage.compress_vcf(
+                                os.path.join(self.data_dir, prefix + ".vcf")
+                            )
 
                 # Create the genetic map
                 genetic_map_func(row_data, filename)
@@ -189,7 +267,70 @@ class DataGeneration:
                 self.data = self.data.append(row_data, ignore_index=True)
 
         # Save dataframe
-        self.summarize()
+        if self.only_replicate is None:
+            self.summarize()
+
+    def simulate_cached(self, params, simulate):
+        """
+        Return the simulation described by params from the simulation cache, only
+        running simulate() if it has not been cached by any evaluation
+        """
+        if self.simulation_cache is None:
+            return simulate()
+        return self.simulation_cache.load_or_simulate(params, simulate)
+
+    def run_neutral_sim(self, seed, **kwargs):
+        """
+        Cached version of evaluation.run_neutral_sim()
+        """
+        params = dict(kwargs, simulator="msprime", version=msprime.__version__)
+        params["seed"] = seed
+        return self.simulate_cached(
+            params, lambda: evaluation.run_neutral_sim(seed=seed, **kwargs)
+        )
+
+    def run_stdpopsim(self, model, contig, samples, seed, contig_params):
+        """
+        Cached simulation of the stdpopsim model and contig. contig_params must
+        uniquely describe the contig, e.g. its species, chromosome and genetic map.
+        """
+        params = dict(
+            contig_params,
+            simulator="stdpopsim",
+            version=stdpopsim.__version__,
+            msprime_version=msprime.__version__,
+            model=model.id,
+            samples=[(sample.population, sample.time) for sample in samples],
+            seed=seed,
+        )
+        engine = stdpopsim.get_default_engine()
+        return self.simulate_cached(
+            params, lambda: engine.simulate(model, contig, samples, seed=seed)
+        )
+
+    def dump_ts(self, ts, path):
+        """
+        Save a tree sequence, compressing it if compress_outputs is set. Use
+        storage.load_ts() to load it again. Nothing is saved when running in memory.
+        """
+        if not self.in_memory:
+            storage.dump_ts(ts, path, compress=self.compress_outputs)
+
+    def load_ts(self, path):
+        """
+        Load a tree sequence saved by setup(), or take it from memory
+        """
+        if path in self.inputs:
+            return self.inputs[path]
+        return storage.load_ts(path)
+
+    def load_samples(self, path):
+        """
+        Load a sample data file saved by setup(), or take it from memory
+        """
+        if path in self.inputs:
+            return self.inputs[path]
+        return tsinfer.load(path)
 
     def make_genetic_map(self, row_data, filename):
         pos = np.array([0, row_data["length"]])
@@ -205,38 +346,266 @@ class DataGeneration:
         genetic_map_output.to_csv(path_to_genetic_map, sep=" ", index=False)
         return path_to_genetic_map
 
-    def run_multiprocessing(self, function, num_processes=1):
+    def inference_tasks(self, row_data):
         """
-        Run multiprocessing of inputted function a specified number of times
+        Return the scheduler tasks needed to run inference on one replicate. By
+        default this is a single task running the whole of inference().
         """
+        index = row_data[0]
+        if self.in_memory:
+            return [
+                scheduler.Task(
+                    (index, "inference"), self.inference_in_memory, (row_data,), ()
+                )
+            ]
+        return [scheduler.Task((index, "inference"), self.inference, (row_data,), ())]
+
+    def inference_in_memory(self, row_data):
+        """
+        Simulate one replicate and run inference on it, keeping its inputs in memory
+        """
+        index = row_data[0]
+        data = self.data
+        rng_state = self.rng.getstate()
+        self.data = pd.DataFrame(columns=self.sim_cols)
+        self.only_replicate = index
         try:
-            self.data = pd.read_csv(self.data_file)
-        except FileNotFoundError:
-            logging.error("Must run with --setup flag first")
+            self.setup()
+            row = self.data.iloc[0]
+            row.name = index
+            return self.inference((index, row))
+        finally:
+            # Leave this object as it was, in case we are running serially
+            self.data = data
+            self.rng.setstate(rng_state)
+            self.only_replicate = None
+            self.inputs = {}
+
+    def run_in_memory(
+        self,
+        num_processes=1,
+        memory_budget=None,
+        num_cores=None,
+        save_simulations=False,
+    ):
+        """
+        Run setup and inference of each replicate together in a single task, passing
+        the simulated tree sequence and sample data in memory rather than through
+        files. Only the results are written (and the simulated tree sequences if
+        save_simulations is True, which also stores them in the simulation cache).
+        """
+        if not self.in_memory_inputs:
+            raise ValueError("{} cannot be run in memory".format(self.name))
+        self.in_memory = True
+        self.save_simulations = save_simulations
+        if not save_simulations:
+            # The caches would write small files for every replicate
+            self.simulation_cache = None
+            self.stage_cache_dir = None
+        rng_state = self.rng.getstate()
+        self.setup()
+        self.rng.setstate(rng_state)
+        self.run_multiprocessing(
+            self.inference, num_processes, memory_budget, num_cores
+        )
 
+    def task_params(self, task):
+        """
+        Return the parameters of the replicate of a task used by the cost model
+        """
+        row = self.data.loc[task.key[0]]
+        sample_size = row.get("sample_size")
+        if pd.isnull(sample_size) and "sample_size_modern" in row:
+            sample_size = row["sample_size_modern"] + row["sample_size_ancient"]
+        return {
+            "sample_size": sample_size,
+            "length": row.get("length"),
+            "n_sites": row.get("n_sites"),
+        }
+
+    def task_memory(self, task, model):
+        """
+        Estimate the peak memory of a task as the largest predicted memory of the
+        methods run in that stage of inference
+        """
+        params = self.task_params(task)
+        return max(
+            [
+                model.predict_memory(method, **params)
+                for method in self.stage_methods.get(task.key[1], [])
+            ],
+            default=0,
+        )
+
+    def task_cost(self, task, model):
+        """
+        Estimate the CPU time of a task as the total predicted CPU time of the
+        methods run in that stage of inference
+        """
+        params = self.task_params(task)
+        return sum(
+            model.predict_cpu(method, **params)
+            for method in self.stage_methods.get(task.key[1], [])
+        )
+
+    def get_kc_distances(self, ts_list, method_names, num_processes=None):
+        """
+        KC distances between the simulated tree sequence (first in ts_list) and
+        each method's, exact or sampled according to self.kc_mode
+        """
+        if num_processes is None:
+            num_processes = self.num_threads
+        num_positions = None
+        if self.kc_mode == "sampled":
+            num_positions = self.kc_positions
+        return evaluation.get_kc_distances(
+            ts_list,
+            method_names,
+            num_processes=num_processes,
+            num_positions=num_positions,
+            random_seed=self.default_seed,
+        )
+
+    def mutations_parquet_path(self, prefix):
+        """
+        Path of the Parquet file of mutation ages compared for the files starting
+        with prefix, or None if they are not written to Parquet
+        """
+        if not self.mutations_parquet:
+            return None
+        return prefix + ".mutations.parquet"
+
+    def schedule_inference(self, num_processes=1, memory_budget=None, num_cores=None):
+        """
+        Run the inference tasks of every replicate, yielding (key, result) tuples as
+        they complete. If memory_budget (in bytes) is given, tasks are only started
+        while their estimated total memory stays within the budget. If num_cores is
+        given, it is divided between worker processes and the threads used by
+        tsinfer and tsdate in each process, overriding num_processes.
+        """
+        tasks = []
+        for row_data in self.data.iterrows():
+            tasks += self.inference_tasks(row_data)
+        if num_cores is not None:
+            # Replicates split into several independent method runs can use more
+            # processes than there are replicates
+            num_processes, self.num_threads = scheduler.plan_parallelism(
+                num_cores, scheduler.num_ready(tasks)
+            )
+            logging.info(
+                "Using {} processes with {} threads each".format(
+                    num_processes, self.num_threads
+                )
+            )
+        if self.work_queue is not None:
+            logging.info("Collecting results from the work queue")
+            return self.work_queue.results(self.name, [task.key for task in tasks])
+        # Longer tasks are started first, and memory is only estimated if needed
+        model = cost_model.CostModel.from_scaling_runs(self.data_dir)
+        tasks = [task._replace(cost=self.task_cost(task, model)) for task in tasks]
+        if memory_budget is not None:
+            tasks = [
+                task._replace(memory=self.task_memory(task, model)) for task in tasks
+            ]
         if num_processes > 1:
             logging.info(
                 "Setting up using multiprocessing ({} processes)".format(num_processes)
             )
-            with multiprocessing.Pool(
-                processes=num_processes, maxtasksperchild=10
-            ) as pool:
-
-                for index, row in tqdm(
-                    pool.imap_unordered(function, self.data.iterrows()),
-                    desc="Inference Run",
-                    total=self.data.shape[0],
-                ):
-                    self.data.loc[index] = row
-                    self.summarize()
         else:
-            # When we have only one process it's easier to keep everything in the
-            # same process for debugging.
             logging.info("Setting up using a single process")
-            for index, row in map(function, self.data.iterrows()):
-                logging.info("Running inference")
-                self.data.loc[index] = row
-                self.summarize()
+        return scheduler.run_tasks(tasks, num_processes, memory_budget)
+
+    def dry_run(self, num_processes=1, num_cores=None):
+        """
+        Print the predicted CPU time and memory needed for inference, without
+        running it
+        """
+        try:
+            self.data = pd.read_csv(self.data_file)
+        except FileNotFoundError:
+            print("{}: must run with --setup flag first".format(self.name))
+            return
+        tasks = []
+        for row_data in self.data.iterrows():
+            tasks += self.inference_tasks(row_data)
+        if num_cores is not None:
+            num_processes, _ = scheduler.plan_parallelism(
+                num_cores, scheduler.num_ready(tasks)
+            )
+        model = cost_model.CostModel.from_scaling_runs(self.data_dir)
+        tasks = [
+            task._replace(
+                cost=self.task_cost(task, model), memory=self.task_memory(task, model)
+            )
+            for task in tasks
+        ]
+        total_cost = sum(task.cost for task in tasks)
+        memories = sorted([task.memory for task in tasks], reverse=True)
+        critical_path = max(scheduler.critical_path_costs(tasks).values(), default=0)
+        print(
+            "{}: {} tasks over {} replicates".format(
+                self.name, len(tasks), self.data.shape[0]
+            )
+        )
+        print("  predicted CPU time: {:.1f} core-hours".format(total_cost / 3600))
+        print(
+            "  predicted wall time with {} processes: at least {:.1f} hours".format(
+                num_processes, max(total_cost / num_processes, critical_path) / 3600
+            )
+        )
+        print(
+            "  predicted peak memory: {:.1f} GB per task, at most {:.1f} GB with "
+            "{} processes".format(
+                max(memories, default=0) / 1024 ** 3,
+                sum(memories[:num_processes]) / 1024 ** 3,
+                num_processes,
+            )
+        )
+        methods = {m for task in tasks for m in self.stage_methods.get(task.key[1], [])}
+        unknown = sorted(method for method in methods if not model.known(method))
+        if len(unknown) > 0:
+            print("  not included, no recorded runs: {}".format(", ".join(unknown)))
+
+    def enqueue(self, work_queue):
+        """
+        Write the inference tasks of every replicate to the work queue, to be run
+        by workers started with `run_evaluation.py worker`
+        """
+        self.data = pd.read_csv(self.data_file)
+        tasks = []
+        for row_data in self.data.iterrows():
+            tasks += self.inference_tasks(row_data)
+        work_queue.enqueue(self.name, tasks)
+
+    def run_queued_task(self, key):
+        """
+        Run the inference task with key, as enqueued by enqueue()
+        """
+        index = key[0]
+        tasks = self.inference_tasks((index, self.data.loc[index]))
+        task = next(task for task in tasks if task.key == key)
+        return task.func(*task.args)
+
+    def run_multiprocessing(
+        self, function, num_processes=1, memory_budget=None, num_cores=None
+    ):
+        """
+        Run multiprocessing of inputted function a specified number of times
+        """
+        try:
+            self.data = pd.read_csv(self.data_file)
+        except FileNotFoundError:
+            logging.error("Must run with --setup flag first")
+
+        for key, result in tqdm(
+            self.schedule_inference(num_processes, memory_budget, num_cores),
+            desc="Inference Run",
+        ):
+            if key[1] != "inference":
+                continue
+            index, row = result
+            self.data.loc[index] = row
+            self.summarize()
 
     def summarize(self):
         """
@@ -252,6 +621,15 @@ class NeutralSims(DataGeneration):
     """
 
     name = "neutral_simulated_mutation_accuracy"
+    stage_methods = {
+        "tsdate": ["tsdate"],
+        "tsinfer": ["tsinfer"],
+        "tsinfer_tsdate": ["tsdate_infer"],
+        "tsinfer_iterate": ["tsinfer", "tsdate_infer"],
+        "relate": ["relate"],
+        "relate_reinfer": ["relate"],
+        "geva": ["geva"],
+    }
 
     def __init__(self):
         DataGeneration.__init__(self)
@@ -287,7 +665,7 @@ class NeutralSims(DataGeneration):
 
         def simulate_func(params):
             seed = params[1]
-            return evaluation.run_neutral_sim(
+            return self.run_neutral_sim(
                 sample_size=row_data["sample_size"],
                 mutation_rate=row_data["mut_rate"],
                 recombination_rate=row_data["rec_rate"],
@@ -300,9 +678,12 @@ class NeutralSims(DataGeneration):
             self, None, [None], simulate_func, self.make_genetic_map, row_data
         )
 
-    def run_multiprocessing(self, function, num_processes=1):
+    def run_multiprocessing(
+        self, function, num_processes=1, memory_budget=None, num_cores=None
+    ):
         """
-        Run multiprocessing of inputted function a specified number of times
+        Run the inference tasks of every replicate, sharing the worker processes
+        between independent method runs from all replicates
         """
         try:
             self.data = pd.read_csv(self.data_file)
@@ -316,247 +697,249 @@ class NeutralSims(DataGeneration):
             pd.DataFrame(columns=self.columns)
             for index in range(len(self.output_suffixes))
         ]
-        if num_processes > 1:
-            logging.info(
-                "Setting up using multiprocessing ({} processes)".format(num_processes)
-            )
-            with multiprocessing.Pool(
-                processes=num_processes, maxtasksperchild=10
-            ) as pool:
-
-                for index, row, dfs in tqdm(
-                    pool.imap_unordered(function, self.data.iterrows()),
-                    desc="Inference Run",
-                    total=self.data.shape[0],
-                ):
-                    self.data.loc[index] = row
-                    self.summarize()
-                    for index, (_, df) in enumerate(dfs.items()):
-                        master_dfs[index] = pd.concat(
-                            [master_dfs[index], df], sort=False
-                        )
-
-        else:
-            # When we have only one process it's easier to keep everything in the
-            # same process for debugging.
-            logging.info("Setting up using a single process")
-            for index, row, dfs in tqdm(
-                map(function, self.data.iterrows()), total=self.data.shape[0]
+        with tqdm(desc="Inference Run", total=self.data.shape[0]) as progress:
+            for key, result in self.schedule_inference(
+                num_processes, memory_budget, num_cores
             ):
-                logging.info("Running inference")
+                if key[1] != "inference":
+                    continue
+                index, row, dfs = result
                 self.data.loc[index] = row
                 self.summarize()
                 for index, (_, df) in enumerate(dfs.items()):
                     master_dfs[index] = pd.concat([master_dfs[index], df], sort=False)
+                progress.update()
 
         for master_df, output_name in zip(master_dfs, output_names):
             master_df.to_csv(output_name)
 
-    def inference(self, row_data):
+    def sample_file_suffixes(self):
         """
-        Run four methods on the simulated data
+        Suffixes of the sample files each method is run on
+        """
+        suffixes = [""]
+        if self.empirical_error:
+            suffixes.append(".error")
+        if self.ancestral_state_error:
+            suffixes.append(".ancestral_state.error")
+        return suffixes
+
+    def inference_tasks(self, row_data):
+        """
+        Split inference on one replicate into a DAG of tasks:
+        tsdate, tsinfer -> tsdate -> iterate, Relate -> Relate pop-size and GEVA are
+        run on each sample file, followed by a single comparison task. Stages pass
+        their results to each other through the files they write.
         """
         index = row_data[0]
         row = row_data[1]
-
-        # Name of output file with mutations ages
-        path_to_file = os.path.join(self.data_dir, row["filename"])
-        sim = tskit.load(path_to_file + ".trees")
-
-        dated_ts = tsdate.date(sim, row["Ne"], row["mut_rate"])
-        dated_ts.dump(path_to_file + ".tsdated.trees")
-
-        sample_data = tsinfer.load(path_to_file + ".samples")
-
-        def run_all_inference(
-            sim,
-            dated_ts,
-            samples,
-            output_fn,
-            tsinfer_mismatch=False,
-            relate_reinfer=False,
-        ):
-            path_to_genetic_map = path_to_file + "_four_col_genetic_map.txt"
-            compare_ts_dict = {"simulated_ts": sim, "tsdate": dated_ts}
-            if self.tsinfer_mismatch:
-                inferred_ts = evaluation.infer_with_mismatch(
-                    samples,
-                    path_to_genetic_map,
-                    ma_mismatch=0.1,
-                    ms_mismatch=0.1,
-                    num_threads=1,
+        tasks = [scheduler.Task((index, "tsdate"), self.date_simulation, (row,), ())]
+        compare_depends = [(index, "tsdate")]
+        for output_fn in self.sample_file_suffixes():
+            tsinfer_key = (index, "tsinfer", output_fn)
+            dated_key = (index, "tsinfer_tsdate", output_fn)
+            tasks.append(
+                scheduler.Task(tsinfer_key, self.run_tsinfer, (row, output_fn), ())
+            )
+            tasks.append(
+                scheduler.Task(
+                    dated_key, self.date_inferred, (row, output_fn), (tsinfer_key,)
                 )
-                inferred_ts = tsdate.preprocess_ts(inferred_ts)
-            else:
-                inferred_ts = tsinfer.infer(samples).simplify()
-            inferred_ts.dump(path_to_file + output_fn + ".tsinferred.trees")
-            dated_inferred_ts = tsdate.date(inferred_ts, row["Ne"], row["mut_rate"])
-            dated_inferred_ts.dump(
-                path_to_file + output_fn + ".tsinferred.tsdated.trees"
             )
-            compare_ts_dict["tsdate_inferred"] = dated_inferred_ts
+            compare_depends.append(dated_key)
             if self.tsinfer_iterate:
-                sites_time = tsdate.sites_time_from_ts(dated_inferred_ts)
-                dated_samples = tsdate.add_sampledata_times(samples, sites_time)
-                if self.tsinfer_iterate_mismatch:
-                    reinferred_ts = evaluation.infer_with_mismatch(
-                        dated_samples,
-                        path_to_genetic_map,
-                        ma_mismatch=0.1,
-                        ms_mismatch=0.1,
-                        num_threads=1,
+                iterate_key = (index, "tsinfer_iterate", output_fn)
+                tasks.append(
+                    scheduler.Task(
+                        iterate_key, self.run_iteration, (row, output_fn), (dated_key,)
                     )
-                    reinferred_ts = tsdate.preprocess_ts(reinferred_ts)
-                else:
-                    reinferred_ts = tsinfer.infer(dated_samples).simplify()
-                reinferred_ts.dump(path_to_file + output_fn + ".iter.tsinferred.trees")
-                redated_inferred_ts = tsdate.date(
-                    reinferred_ts, row["Ne"], row["mut_rate"]
                 )
-                compare_ts_dict["tsdate_iterate"] = redated_inferred_ts
-                redated_inferred_ts.dump(
-                    path_to_file + output_fn + ".iter.tsinferred.tsdated.trees"
-                )
-            else:
-                redated_inferred_ts = None
-
-            relate_dir = os.path.join(
-                self.data_dir, "relate_" + row["filename"] + output_fn
-            )
-            path_to_genetic_map = path_to_file + "_genetic_map.txt"
-            relate_ts, relate_age, relate_cpu, relate_memory = evaluation.run_relate(
-                sim,
-                path_to_file + output_fn,
-                row["mut_rate"],
-                row["Ne"] * 2,
-                path_to_genetic_map,
-                relate_dir,
-                "relate_run" + output_fn,
+                compare_depends.append(iterate_key)
+            relate_key = (index, "relate", output_fn)
+            tasks.append(
+                scheduler.Task(relate_key, self.run_relate, (row, output_fn), ())
             )
-            relate_ts.dump(path_to_file + output_fn + ".relate.trees")
-            relate_age.to_csv(path_to_file + output_fn + ".relate_age.csv")
+            compare_depends.append(relate_key)
             if self.relate_reinfer:
-                relate_iter_ages, relate_iter_ts = evaluation.run_relate_pop_size(
-                    sim,
-                    "relate_run" + output_fn,
-                    row["mut_rate"],
-                    "relate_reinfer" + output_fn,
-                    relate_dir,
-                )
-            else:
-                relate_iter_ages = None
-                relate_iter_ts = None
-            if self.geva_genetic_map is True:
-                geva_ages, geva_cpu, geva_memory = evaluation.run_geva(
-                    path_to_file + output_fn,
-                    row["Ne"],
-                    row["mut_rate"],
-                    row["rec_rate"],  # genetic_map_path=path_to_genetic_map
-                )
-            else:
-                geva_ages, geva_cpu, geva_memory = evaluation.run_geva(
-                    path_to_file + output_fn,
-                    row["Ne"],
-                    row["mut_rate"],
-                    row["rec_rate"],
+                relate_reinfer_key = (index, "relate_reinfer", output_fn)
+                tasks.append(
+                    scheduler.Task(
+                        relate_reinfer_key,
+                        self.run_relate_pop_size,
+                        (row, output_fn),
+                        (relate_key,),
+                    )
                 )
-
-            geva_positions = pd.read_csv(
-                path_to_file + output_fn + ".marker.txt",
-                delimiter=" ",
-                index_col="MarkerID",
-            )
-            geva_ages.to_csv(path_to_file + output_fn + ".geva.csv")
-            print("Compare Mutations")
-            mutation_df = evaluation.compare_mutations(
-                list(compare_ts_dict.values()),
-                list(compare_ts_dict.keys()),
-                geva_ages=geva_ages,
-                geva_positions=geva_positions,
-                relate_ages=relate_age,
-                relate_reinfer=relate_iter_ages,
+                compare_depends.append(relate_reinfer_key)
+            geva_key = (index, "geva", output_fn)
+            tasks.append(scheduler.Task(geva_key, self.run_geva, (row, output_fn), ()))
+            compare_depends.append(geva_key)
+        tasks.append(
+            scheduler.Task(
+                (index, "inference"),
+                self.compare_methods,
+                (index, row),
+                tuple(compare_depends),
             )
+        )
+        return tasks
 
-            sim_pos = sim.tables.sites.position
-            sim = sim.keep_intervals(
-                [[np.round(sim_pos[0]), np.round(sim_pos[-1])]]
-            ).trim()
+    def inference(self, row_data):
+        """
+        Run four methods on the simulated data
+        """
+        results = dict(scheduler.run_serial(self.inference_tasks(row_data)))
+        return results[(row_data[0], "inference")]
 
-            dated_ts_pos = dated_ts.tables.sites.position
-            dated_ts = dated_ts.keep_intervals(
-                [[np.round(dated_ts_pos[0]), np.round(dated_ts_pos[-1])]]
-            ).trim()
-            compare_ts_dict = {"simulated_ts": sim, "tsdate": dated_ts}
+    def date_simulation(self, row):
+        """
+        Run tsdate on the simulated topology
+        """
+        path_to_file = os.path.join(self.data_dir, row["filename"])
+        sim = storage.load_ts(path_to_file + ".trees")
+        dated_ts = tsdate.date(
+            sim, row["Ne"], row["mut_rate"], num_threads=self.num_threads
+        )
+        self.dump_ts(dated_ts, path_to_file + ".tsdated.trees")
 
-            dated_inferred_ts_pos = dated_inferred_ts.tables.sites.position
-            dated_inferred_ts = dated_inferred_ts.keep_intervals(
-                [
-                    [
-                        np.round(dated_inferred_ts_pos[0]),
-                        np.round(dated_inferred_ts_pos[-1]),
-                    ]
-                ]
-            ).trim()
-            tables = dated_inferred_ts.dump_tables()
-            tables.sequence_length = sim.get_sequence_length()
-            dated_inferred_ts = tables.tree_sequence()
-            compare_ts_dict["tsdate_inferred"] = dated_inferred_ts
+    def run_tsinfer(self, row, output_fn):
+        """
+        Infer a tree sequence from the sample file with the given suffix
+        """
+        path_to_file = os.path.join(self.data_dir, row["filename"])
+        samples = tsinfer.load(path_to_file + output_fn + ".samples")
+        if self.tsinfer_mismatch:
+            inferred_ts = evaluation.infer_with_mismatch(
+                samples,
+                path_to_file + "_four_col_genetic_map.txt",
+                ma_mismatch=0.1,
+                ms_mismatch=0.1,
+                num_threads=self.num_threads,
+            )
+            inferred_ts = tsdate.preprocess_ts(inferred_ts)
+        else:
+            inferred_ts = tsinfer.infer(
+                samples, num_threads=self.num_threads
+            ).simplify()
+        self.dump_ts(inferred_ts, path_to_file + output_fn + ".tsinferred.trees")
 
-            if self.relate_reinfer:
-                relate_ts_pos = relate_iter_ts.tables.sites.position
-                relate_ts = relate_iter_ts.keep_intervals(
-                    [[np.round(relate_ts_pos[0]), np.round(relate_ts_pos[-1])]]
-                ).trim()
-                compare_ts_dict["relate_iterate"] = relate_ts
-            else:
-                relate_ts_pos = relate_ts.tables.sites.position
-                relate_ts = relate_ts.keep_intervals(
-                    [
-                        [
-                            np.round(relate_ts.tables.sites.position[0]),
-                            np.round(relate_ts.tables.sites.position[-1]),
-                        ]
-                    ]
-                ).trim()
-                compare_ts_dict["relate"] = relate_ts
+    def date_inferred(self, row, output_fn):
+        """
+        Run tsdate on the tree sequence inferred by tsinfer
+        """
+        path_to_file = os.path.join(self.data_dir, row["filename"])
+        inferred_ts = storage.load_ts(path_to_file + output_fn + ".tsinferred.trees")
+        dated_inferred_ts = tsdate.date(
+            inferred_ts, row["Ne"], row["mut_rate"], num_threads=self.num_threads
+        )
+        self.dump_ts(
+            dated_inferred_ts, path_to_file + output_fn + ".tsinferred.tsdated.trees"
+        )
 
-            print("Find KC Distances")
-            if self.tsinfer_iterate:
-                redated_inferred_ts_pos = redated_inferred_ts.tables.sites.position
-                redated_inferred_ts = redated_inferred_ts.keep_intervals(
-                    [
-                        [
-                            np.round(redated_inferred_ts_pos[0]),
-                            np.round(redated_inferred_ts_pos[-1]),
-                        ]
-                    ]
-                ).trim()
-                tables = redated_inferred_ts.dump_tables()
-                tables.sequence_length = sim.get_sequence_length()
-                redated_inferred_ts = tables.tree_sequence()
-                compare_ts_dict["tsdate_iterate"] = redated_inferred_ts
-            kc_df = evaluation.get_kc_distances(
-                list(compare_ts_dict.values()), list(compare_ts_dict.keys())
+    def run_iteration(self, row, output_fn):
+        """
+        Reinfer using site times from the dated inferred tree sequence, then redate
+        """
+        path_to_file = os.path.join(self.data_dir, row["filename"])
+        samples = tsinfer.load(path_to_file + output_fn + ".samples")
+        dated_inferred_ts = storage.load_ts(
+            path_to_file + output_fn + ".tsinferred.tsdated.trees"
+        )
+        sites_time = tsdate.sites_time_from_ts(dated_inferred_ts)
+        dated_samples = tsdate.add_sampledata_times(samples, sites_time)
+        if self.tsinfer_iterate_mismatch:
+            reinferred_ts = evaluation.infer_with_mismatch(
+                dated_samples,
+                path_to_file + "_four_col_genetic_map.txt",
+                ma_mismatch=0.1,
+                ms_mismatch=0.1,
+                num_threads=self.num_threads,
             )
-            return mutation_df, kc_df
+            reinferred_ts = tsdate.preprocess_ts(reinferred_ts)
+        else:
+            reinferred_ts = tsinfer.infer(
+                dated_samples, num_threads=self.num_threads
+            ).simplify()
+        self.dump_ts(reinferred_ts, path_to_file + output_fn + ".iter.tsinferred.trees")
+        redated_inferred_ts = tsdate.date(
+            reinferred_ts, row["Ne"], row["mut_rate"], num_threads=self.num_threads
+        )
+        self.dump_ts(
+            redated_inferred_ts,
+            path_to_file + output_fn + ".iter.tsinferred.tsdated.trees",
+        )
 
-        mut_df, kc_df = run_all_inference(sim, dated_ts, sample_data, "")
-        error_mut_df = None
-        error_kc_df = None
-        if self.empirical_error:
-            error_samples = tsinfer.load(path_to_file + ".error.samples")
-            error_mut_df, error_kc_df = run_all_inference(
-                sim, dated_ts, error_samples, ".error"
+    def run_relate(self, row, output_fn):
+        """
+        Run Relate on the VCF with the given suffix
+        """
+        path_to_file = os.path.join(self.data_dir, row["filename"])
+        sim = storage.load_ts(path_to_file + ".trees")
+        relate_dir = os.path.join(self.data_dir, "relate_" + row["filename"] + output_fn)
+        relate_ts, relate_age, relate_cpu, relate_memory = evaluation.run_relate(
+            sim,
+            path_to_file + output_fn,
+            row["mut_rate"],
+            row["Ne"] * 2,
+            path_to_file + "_genetic_map.txt",
+            relate_dir,
+            "relate_run" + output_fn,
+        )
+        self.dump_ts(relate_ts, path_to_file + output_fn + ".relate.trees")
+        relate_age.to_csv(path_to_file + output_fn + ".relate_age.csv")
+
+    def run_relate_pop_size(self, row, output_fn):
+        """
+        Reestimate population sizes with Relate and redate the Relate trees
+        """
+        path_to_file = os.path.join(self.data_dir, row["filename"])
+        sim = storage.load_ts(path_to_file + ".trees")
+        relate_dir = os.path.join(self.data_dir, "relate_" + row["filename"] + output_fn)
+        relate_iter_ages, relate_iter_ts = evaluation.run_relate_pop_size(
+            sim,
+            "relate_run" + output_fn,
+            row["mut_rate"],
+            "relate_reinfer" + output_fn,
+            relate_dir,
+        )
+        self.dump_ts(relate_iter_ts, path_to_file + output_fn + ".relate_iterate.trees")
+        relate_iter_ages.to_csv(path_to_file + output_fn + ".relate_iterate_age.csv")
+
+    def run_geva(self, row, output_fn):
+        """
+        Run GEVA on the VCF with the given suffix
+        """
+        path_to_file = os.path.join(self.data_dir, row["filename"])
+        if self.geva_genetic_map is True:
+            geva_ages, geva_cpu, geva_memory = evaluation.run_geva(
+                path_to_file + output_fn,
+                row["Ne"],
+                row["mut_rate"],
+                row["rec_rate"],  # genetic_map_path=path_to_genetic_map
             )
-        anc_error_mut_df = None
-        anc_error_kc_df = None
-        if self.ancestral_state_error:
-            anc_error_samples = tsinfer.load(
-                path_to_file + ".ancestral_state.error.samples"
+        else:
+            geva_ages, geva_cpu, geva_memory = evaluation.run_geva(
+                path_to_file + output_fn, row["Ne"], row["mut_rate"], row["rec_rate"],
             )
-            anc_error_mut_df, anc_error_kc_df = run_all_inference(
-                sim, dated_ts, anc_error_samples, ".ancestral_state.error"
+        geva_ages.to_csv(path_to_file + output_fn + ".geva.csv")
+
+    def compare_methods(self, index, row):
+        """
+        Compare the mutation ages and KC distances of every method on each sample file
+        """
+        path_to_file = os.path.join(self.data_dir, row["filename"])
+        sim = storage.load_ts(path_to_file + ".trees")
+        dated_ts = storage.load_ts(path_to_file + ".tsdated.trees")
+        results = {}
+        for output_fn in self.sample_file_suffixes():
+            results[output_fn] = self.compare_sample_file(
+                path_to_file, sim, dated_ts, output_fn
             )
+        mut_df, kc_df = results[""]
+        error_mut_df, error_kc_df = results.get(".error", (None, None))
+        anc_error_mut_df, anc_error_kc_df = results.get(
+            ".ancestral_state.error", (None, None)
+        )
         return_vals = {
             "muts_noerr": mut_df,
             "muts_err": error_mut_df,
@@ -568,6 +951,104 @@ class NeutralSims(DataGeneration):
         print(mut_df)
         return index, row, return_vals
 
+    def compare_sample_file(self, path_to_file, sim, dated_ts, output_fn):
+        """
+        Load the outputs of each method run on the sample file with the given suffix
+        and return dataframes of mutation ages and KC distances
+        """
+        compare_ts_dict = {"simulated_ts": sim, "tsdate": dated_ts}
+        dated_inferred_ts = storage.load_ts(
+            path_to_file + output_fn + ".tsinferred.tsdated.trees"
+        )
+        compare_ts_dict["tsdate_inferred"] = dated_inferred_ts
+        if self.tsinfer_iterate:
+            redated_inferred_ts = storage.load_ts(
+                path_to_file + output_fn + ".iter.tsinferred.tsdated.trees"
+            )
+            compare_ts_dict["tsdate_iterate"] = redated_inferred_ts
+        relate_ts = storage.load_ts(path_to_file + output_fn + ".relate.trees")
+        relate_age = pd.read_csv(
+            path_to_file + output_fn + ".relate_age.csv", index_col=0
+        )
+        if self.relate_reinfer:
+            relate_iter_ts = storage.load_ts(
+                path_to_file + output_fn + ".relate_iterate.trees"
+            )
+            relate_iter_ages = pd.read_csv(
+                path_to_file + output_fn + ".relate_iterate_age.csv", index_col=0
+            )
+        else:
+            relate_iter_ages = None
+        geva_ages = pd.read_csv(
+            path_to_file + output_fn + ".geva.csv", index_col="MarkerID"
+        )
+        geva_positions = pd.read_csv(
+            path_to_file + output_fn + ".marker.txt",
+            delimiter=" ",
+            index_col="MarkerID",
+        )
+        print("Compare Mutations")
+        mutation_df = evaluation.compare_mutations(
+            list(compare_ts_dict.values()),
+            list(compare_ts_dict.keys()),
+            geva_ages=geva_ages,
+            geva_positions=geva_positions,
+            relate_ages=relate_age,
+            relate_reinfer=relate_iter_ages,
+            parquet_path=self.mutations_parquet_path(path_to_file + output_fn),
+        )
+
+        sim_pos = sim.tables.sites.position
+        sim = sim.keep_intervals([[np.round(sim_pos[0]), np.round(sim_pos[-1])]]).trim()
+
+        dated_ts_pos = dated_ts.tables.sites.position
+        dated_ts = dated_ts.keep_intervals(
+            [[np.round(dated_ts_pos[0]), np.round(dated_ts_pos[-1])]]
+        ).trim()
+        compare_ts_dict = {"simulated_ts": sim, "tsdate": dated_ts}
+
+        dated_inferred_ts_pos = dated_inferred_ts.tables.sites.position
+        dated_inferred_ts = dated_inferred_ts.keep_intervals(
+            [[np.round(dated_inferred_ts_pos[0]), np.round(dated_inferred_ts_pos[-1])]]
+        ).trim()
+        tables = dated_inferred_ts.dump_tables()
+        tables.sequence_length = sim.get_sequence_length()
+        dated_inferred_ts = tables.tree_sequence()
+        compare_ts_dict["tsdate_inferred"] = dated_inferred_ts
+
+        if self.relate_reinfer:
+            relate_ts_pos = relate_iter_ts.tables.sites.position
+            relate_ts = relate_iter_ts.keep_intervals(
+                [[np.round(relate_ts_pos[0]), np.round(relate_ts_pos[-1])]]
+            ).trim()
+            compare_ts_dict["relate_iterate"] = relate_ts
+        else:
+            relate_ts_pos = relate_ts.tables.sites.position
+            relate_ts = relate_ts.keep_intervals(
+                [[np.round(relate_ts_pos[0]), np.round(relate_ts_pos[-1])]]
+            ).trim()
+            compare_ts_dict["relate"] = relate_ts
+
+        print("Find KC Distances")
+        if self.tsinfer_iterate:
+            redated_inferred_ts_pos = redated_inferred_ts.tables.sites.position
+            redated_inferred_ts = redated_inferred_ts.keep_intervals(
+                [
+                    [
+                        np.round(redated_inferred_ts_pos[0]),
+                        np.round(redated_inferred_ts_pos[-1]),
+                    ]
+                ]
+            ).trim()
+            tables = redated_inferred_ts.dump_tables()
+            tables.sequence_length = sim.get_sequence_length()
+            redated_inferred_ts = tables.tree_sequence()
+            compare_ts_dict["tsdate_iterate"] = redated_inferred_ts
+        kc_df = self.get_kc_distances(
+            list(compare_ts_dict.values()), list(compare_ts_dict.keys())
+        )
+        return mutation_df, kc_df
+
 
 class TsdateNeutralSims(NeutralSims):
     """
@@ -576,6 +1057,11 @@ class TsdateNeutralSims(NeutralSims):
 
     name = "tsdate_neutral_sims"
 
+    # Inference is run as a single task per replicate
+    inference_tasks = DataGeneration.inference_tasks
+    stage_methods = {"inference": ["tsinfer", "tsdate_infer"]}
+    in_memory_inputs = True
+
     def __init__(self):
         DataGeneration.__init__(self)
         self.columns = ["simulated_ts", "tsdate", "tsdate_inferred"]
@@ -593,20 +1079,25 @@ class TsdateNeutralSims(NeutralSims):
         row = row_data[1]
         # Name of output file with mutations ages
         path_to_file = os.path.join(self.data_dir, row["filename"])
-        sim = tskit.load(path_to_file + ".trees")
-        samples = tsinfer.load(path_to_file + ".samples")
-        dated_ts = tsdate.date(sim, row["Ne"], row["mut_rate"])
-        dated_ts.dump(path_to_file + ".tsdated.trees")
+        sim = self.load_ts(path_to_file + ".trees")
+        samples = self.load_samples(path_to_file + ".samples")
+        dated_ts = tsdate.date(
+            sim, row["Ne"], row["mut_rate"], num_threads=self.num_threads
+        )
+        self.dump_ts(dated_ts, path_to_file + ".tsdated.trees")
 
-        inferred_ts = tsinfer.infer(samples).simplify()
-        inferred_ts.dump(path_to_file + ".tsinferred.trees")
+        inferred_ts = tsinfer.infer(samples, num_threads=self.num_threads).simplify()
+        self.dump_ts(inferred_ts, path_to_file + ".tsinferred.trees")
 
-        dated_inferred_ts = tsdate.date(inferred_ts, row["Ne"], row["mut_rate"])
-        dated_inferred_ts.dump(path_to_file + ".tsinferred.tsdated.trees")
+        dated_inferred_ts = tsdate.date(
+            inferred_ts, row["Ne"], row["mut_rate"], num_threads=self.num_threads
+        )
+        self.dump_ts(dated_inferred_ts, path_to_file + ".tsinferred.tsdated.trees")
 
         compare_df = evaluation.compare_mutations(
             [sim, dated_ts, dated_inferred_ts],
             ["simulated_ts", "tsdate", "tsdate_inferred"],
+            parquet_path=self.mutations_parquet_path(path_to_file),
         )
         return_vals = {"mut_df": compare_df}
         return index, row, return_vals
@@ -616,12 +1107,17 @@ class CpuScalingSampleSize(DataGeneration):
     """
     Plot CPU times of tsdate, tsinfer, tsdate+tsinfer, Relate, and GEVA
     Run the following to occupy other threads: nice -n 15 stress -c 40
+    For repeatable measurements of tsinfer and tsdate, e.g. to compare versions,
+    use the bench subcommand instead (see benchmark.py).
     WARNING: GEVA uses a *large* amount of memory, ~20Gb per run when the SampleSize
     is 2000.
     """
 
     name = "cpu_scaling_samplesize"
     default_replicates = 5
+    stage_methods = {
+        "inference": ["tsdate", "tsinfer", "tsdate_infer", "relate", "geva"]
+    }
     include_geva = True
 
     def __init__(self):
@@ -655,6 +1151,8 @@ class CpuScalingSampleSize(DataGeneration):
             self.tools = ["tsdate", "tsinfer", "relate", "geva"]
         else:
             self.tools = ["tsdate", "tsinfer", "relate"]
+        # The timed command line tools read uncompressed files
+        self.compress_outputs = False
         self.num_rows = len(self.sample_sizes) * self.default_replicates
         self.data = pd.DataFrame(columns=self.sim_cols)
         self.rng = random.Random(self.default_seed)
@@ -669,7 +1167,7 @@ class CpuScalingSampleSize(DataGeneration):
         def simulate_func(params):
             sample_size = params[0]
             seed = params[1]
-            return evaluation.run_neutral_sim(
+            return self.run_neutral_sim(
                 sample_size=sample_size,
                 mutation_rate=row_data["mut_rate"],
                 recombination_rate=row_data["rec_rate"],
@@ -694,7 +1192,7 @@ class CpuScalingSampleSize(DataGeneration):
         index = row_data[0]
         row = row_data[1]
         path_to_file = os.path.join(self.data_dir, row["filename"])
-        sim = tskit.load(path_to_file + ".trees")
+        sim = storage.load_ts(path_to_file + ".trees")
 
         _, tsdate_cpu, tsdate_memory = evaluation.run_tsdate(
             path_to_file + ".trees", row["Ne"], row["mut_rate"], 20, "inside_outside"
@@ -780,7 +1278,7 @@ class CpuScalingLength(CpuScalingSampleSize):
         def simulate_func(params):
             length = params[0]
             seed = params[1]
-            return evaluation.run_neutral_sim(
+            return self.run_neutral_sim(
                 sample_size=row_data["sample_size"],
                 mutation_rate=row_data["mut_rate"],
                 recombination_rate=row_data["rec_rate"],
@@ -829,6 +1327,8 @@ class Chr20Sims(NeutralSims):
         self.remove_ancient_mutations = False
         self.ancient_times = None
         self.geva_genetic_map = True
+        # Simulate only the chosen snippet rather than the whole of chromosome 20
+        self.simulate_snippet_only = False
 
     def setup(self):
         row_data = dict.fromkeys(self.sim_cols)
@@ -884,35 +1384,23 @@ class Chr20Sims(NeutralSims):
                 ]
 
             samples = yri_samples + ceu_samples + chb_samples + ancient_samples
-            engine = stdpopsim.get_default_engine()
-            ts = engine.simulate(model, contig, samples, seed=seed)
-            if self.remove_ancient_mutations:
-                ts = evaluation.remove_ancient_only_muts(ts)
-            chr20_centromere = [25700000, 30400000]
-            snippet_start = self.rng.randint(
-                0, ts.get_sequence_length() - row_data["length"]
+            self.snippet = self.choose_snippet(
+                contig.recombination_map.get_sequence_length(), row_data["length"]
             )
-            snippet_end = snippet_start + row_data["length"]
-            # Don't allow snippets to include the centromere
-            while (
-                snippet_end > chr20_centromere[0] and snippet_end < chr20_centromere[1]
-            ) or (
-                snippet_start > chr20_centromere[0]
-                and snippet_start < chr20_centromere[1]
-            ):
-                print("Rechoosing snippet")
-                snippet_start = self.rng.randint(
-                    0, ts.get_sequence_length() - row_data["length"]
-                )
-                snippet_end = snippet_start + row_data["length"]
-            print(
-                "Random Snippet Start:"
-                + str(snippet_start)
-                + " end: "
-                + str(snippet_end)
-            )
-            self.snippet = [snippet_start, snippet_start + row_data["length"]]
             row_data["snippet"] = self.snippet
+            contig_params = {
+                "species": "HomSap",
+                "contig": "chr20",
+                "genetic_map": "HapMapII_GRCh37",
+            }
+            if self.simulate_snippet_only:
+                contig = self.get_snippet_contig(contig, self.snippet)
+                contig_params["snippet"] = self.snippet
+            ts = self.run_stdpopsim(model, contig, samples, seed, contig_params)
+            if self.remove_ancient_mutations:
+                ts = evaluation.remove_ancient_only_muts(ts)
+            if self.simulate_snippet_only:
+                return ts
             return ts.keep_intervals(np.array([self.snippet])).trim()
 
         genetic_map_func = self.get_genetic_map_chr20_snippet
@@ -920,6 +1408,44 @@ class Chr20Sims(NeutralSims):
             self, None, [None], simulate_func, genetic_map_func, row_data
         )
 
+    def choose_snippet(self, sequence_length, snippet_length):
+        """
+        Randomly choose a region of chromosome 20 which avoids the centromere
+        """
+        chr20_centromere = [25700000, 30400000]
+        snippet_start = self.rng.randint(0, sequence_length - snippet_length)
+        snippet_end = snippet_start + snippet_length
+        # Don't allow snippets to include the centromere
+        while (
+            snippet_end > chr20_centromere[0] and snippet_end < chr20_centromere[1]
+        ) or (
+            snippet_start > chr20_centromere[0] and snippet_start < chr20_centromere[1]
+        ):
+            print("Rechoosing snippet")
+            snippet_start = self.rng.randint(0, sequence_length - snippet_length)
+            snippet_end = snippet_start + snippet_length
+        print(
+            "Random Snippet Start:" + str(snippet_start) + " end: " + str(snippet_end)
+        )
+        return [snippet_start, snippet_start + snippet_length]
+
+    def get_snippet_contig(self, contig, snippet):
+        """
+        Return a contig with the recombination map of the given snippet of contig, so
+        that only the snippet is simulated
+        """
+        chr_map = RateMap(
+            contig.recombination_map.get_positions(),
+            contig.recombination_map.get_rates()[:-1],
+        )
+        snip_map = chr_map.slice(start=snippet[0], end=snippet[1], trim=True)
+        recombination_map = msprime.RecombinationMap(
+            list(snip_map.position), list(snip_map.rate) + [0]
+        )
+        return stdpopsim.Contig(
+            recombination_map=recombination_map, mutation_rate=contig.mutation_rate
+        )
+
     def get_genetic_map_chr20_snippet(self, rowdata, filename):
         """
         For each chromosome 20 simulation, randomly select a region to run inference on
@@ -957,6 +1483,11 @@ class Chr20AncientIteration(Chr20Sims):
 
     name = "chr20_ancient_iteration"
 
+    # Inference is run as a single task per replicate
+    inference_tasks = DataGeneration.inference_tasks
+    stage_methods = {"inference": ["tsinfer", "tsdate_infer"]}
+    in_memory_inputs = True
+
     def __init__(self):
         DataGeneration.__init__(self)
         self.columns = ["simulated_ts", "tsdate", "tsdate_inferred", "tsdate_iteration"]
@@ -976,6 +1507,8 @@ class Chr20AncientIteration(Chr20Sims):
         self.modern_sample_size = 150  # 1008
         self.ancient_sample_size = 50
         self.ancient_times = "empirical_age_distribution"
+        # Numbers of ancient individuals added to the moderns when reinferring
+        self.ancient_sample_sizes = [1, 5, 10, 20, 40]
 
     def setup(self):
         row_data = dict.fromkeys(self.sim_cols)
@@ -1036,8 +1569,12 @@ class Chr20AncientIteration(Chr20Sims):
                 ]
 
             samples = yri_samples + ceu_samples + chb_samples + ancient_samples
-            engine = stdpopsim.get_default_engine()
-            ts = engine.simulate(model, contig, samples, seed=seed)
+            contig_params = {
+                "species": "HomSap",
+                "contig": "chr20",
+                "length_multiplier": 0.05,
+            }
+            ts = self.run_stdpopsim(model, contig, samples, seed, contig_params)
             if self.remove_ancient_mutations:
                 ts = evaluation.remove_ancient_only_muts(ts)
             return ts
@@ -1053,27 +1590,43 @@ class Chr20AncientIteration(Chr20Sims):
         index = row_data[0]
         row = row_data[1]
 
+        num_threads = self.num_threads
         path_to_file = os.path.join(self.data_dir, row["filename"])
         # Load the original simulation
-        sim = tskit.load(path_to_file + ".trees")
-        samples = tsinfer.load(path_to_file + ".samples")
+        sim = self.load_ts(path_to_file + ".trees")
+        samples = self.load_samples(path_to_file + ".samples")
         assert samples.num_sites == sim.num_sites
 
         modern_samples = samples.subset(
             individuals=np.arange(0, row["sample_size_modern"])
         )
-        inferred_ts = tsinfer.infer(modern_samples)
+        inferred_ts = tsinfer.infer(modern_samples, num_threads=num_threads)
         inferred_ts = tsdate.preprocess_ts(inferred_ts, filter_sites=False)
-        dated = tsdate.date(inferred_ts, row["Ne"], row["mut_rate"])
+        dated = tsdate.date(
+            inferred_ts, row["Ne"], row["mut_rate"], num_threads=num_threads
+        )
         assert dated.num_sites == modern_samples.num_sites
 
-        # Iterate with only modern samples
+        # Iterate with only modern samples. The modern ancestors are generated once
+        # here and reused for every subset of ancient samples below.
         sites_time = tsdate.sites_time_from_ts(dated)
         dated_samples = tsdate.add_sampledata_times(modern_samples, sites_time)
-        iter_inferred_ts = tsinfer.infer(dated_samples, path_compression=False)
+        ancestors = tsinfer.generate_ancestors(dated_samples, num_threads=num_threads)
+        iter_ancestors_ts = tsinfer.match_ancestors(
+            dated_samples, ancestors, path_compression=False, num_threads=num_threads
+        )
+        iter_inferred_ts = tsinfer.match_samples(
+            dated_samples,
+            iter_ancestors_ts,
+            path_compression=False,
+            num_threads=num_threads,
+        )
         iter_inferred_ts = tsdate.preprocess_ts(iter_inferred_ts)
         iter_dated = tsdate.date(
-            iter_inferred_ts.simplify(), row["Ne"], row["mut_rate"]
+            iter_inferred_ts.simplify(),
+            row["Ne"],
+            row["mut_rate"],
+            num_threads=num_threads,
         )
 
         modern_sim = sim.simplify(
@@ -1083,47 +1636,64 @@ class Chr20AncientIteration(Chr20Sims):
         modern_samples_keeptimes = tsinfer.formats.SampleData.from_tree_sequence(
             modern_sim, use_sites_time=True
         )
-        inferred_modern = tsinfer.infer(modern_samples_keeptimes)
+        inferred_modern = tsinfer.infer(
+            modern_samples_keeptimes, num_threads=num_threads
+        )
         inferred_modern_dated = tsdate.date(
-            inferred_modern.simplify(), row["Ne"], row["mut_rate"]
+            inferred_modern.simplify(),
+            row["Ne"],
+            row["mut_rate"],
+            num_threads=num_threads,
         )
         assert np.array_equal(
             sim.tables.sites.position, inferred_modern_dated.tables.sites.position
         )
 
-        # ancient_sample_sizes = [1, 5, 10, 20, 40]
-        ancient_sample_sizes = [1, 5, 10]
-        tables = sim.tables
+        ancient_sample_sizes = self.ancient_sample_sizes
         iter_ts_ancients = []
         iter_ts_inferred = []
         iter_ts_moderns_only = []
+        # Site times only depend on the dated modern tree sequence, so the times
+        # computed above are used for every subset. Proxy ancestors are added
+        # incrementally: each subset inserts only the ancients not already
+        # inserted for the previous one.
+        ancestors_with_anc = ancestors
+        prev_num_individuals = row["sample_size_modern"]
         for subset_size in ancient_sample_sizes:
-            subsetted = samples.subset(
-                individuals=np.arange(0, row["sample_size_modern"] + subset_size)
-            )
-            sites_time = tsdate.sites_time_from_ts(
-                dated.simplify(
-                    samples=np.arange(
-                        0, row["sample_size_modern"] + subset_size
-                    ).astype("int32")
-                )
-            )
+            num_individuals = row["sample_size_modern"] + subset_size
+            subsetted = samples.subset(individuals=np.arange(0, num_individuals))
             dated_samples = tsdate.add_sampledata_times(subsetted, sites_time)
-            ancestors_reinferred = tsinfer.generate_ancestors(dated_samples)
-            ancestors_reinferred_with_anc = ancestors_reinferred.insert_proxy_samples(
-                dated_samples, allow_mutation=True
+            samples_individual = dated_samples.samples_individual[:]
+            added_ancients = np.where(
+                np.logical_and(
+                    samples_individual >= prev_num_individuals,
+                    samples_individual < num_individuals,
+                )
+            )[0]
+            ancestors_with_anc = ancestors_with_anc.insert_proxy_samples(
+                dated_samples,
+                sample_ids=added_ancients,
+                allow_mutation=True,
+                require_same_sample_data=False,
             )
+            prev_num_individuals = num_individuals
             ancestors_ts_reinferred = tsinfer.match_ancestors(
-                dated_samples, ancestors_reinferred_with_anc
+                dated_samples, ancestors_with_anc, num_threads=num_threads
             )  # , path_compression=False)
             reinferred = tsinfer.match_samples(
-                modern_samples, ancestors_ts_reinferred, force_sample_times=True
+                modern_samples,
+                ancestors_ts_reinferred,
+                force_sample_times=True,
+                num_threads=num_threads,
             )
             reinferred = tsdate.preprocess_ts(reinferred)
 
             iter_ts_inferred.append(reinferred)
             reinferred_dated = tsdate.date(
-                reinferred.simplify(), row["Ne"], row["mut_rate"]
+                reinferred.simplify(),
+                row["Ne"],
+                row["mut_rate"],
+                num_threads=num_threads,
             )
             iter_ts_ancients.append(reinferred_dated)
             reinferred_modern = reinferred_dated.simplify(
@@ -1140,6 +1710,7 @@ class Chr20AncientIteration(Chr20Sims):
             + [ts for ts in iter_ts_ancients],
             ["simulated_ts", "tsdate_keep_times", "tsdate_inferred", "tsdate_iterate",]
             + subset_names,
+            parquet_path=self.mutations_parquet_path(path_to_file),
         )
         msle_results = {}
         for col in mut_df.columns:
@@ -1175,10 +1746,11 @@ class Chr20AncientIteration(Chr20Sims):
             kc_ts_list[i] = ts.keep_intervals(
                 [[np.floor(ts_pos[0]), np.ceil(ts_pos[-1])]]
             ).trim()
-        kc_df = evaluation.get_kc_distances(
+        kc_df = self.get_kc_distances(
             kc_ts_list,
             ["simulated_ts", "tsdate_keep_times", "tsdate_inferred", "tsdate_iterate",]
             + subset_names,
+            num_processes=num_threads,
         )
 
         return_vals = {
@@ -1220,6 +1792,7 @@ class EvaluatePrior(DataGeneration):
     """
 
     name = "evaluateprior"
+    queueable = False
 
     def setup(self):
         pass
@@ -1234,59 +1807,67 @@ class EvaluatePrior(DataGeneration):
         mixture_prior = base_priors.get_mixture_prior_params(span_data)
         confidence_intervals = np.zeros((ts.num_nodes - ts.num_samples, 4))
 
+        nodes = np.arange(num_samples, ts.num_nodes)
+        for node in nodes:
+            weights = span_data.get_weights(node)[num_samples]
+            confidence_intervals[node - num_samples, 0] = np.sum(
+                weights["descendant_tips"] * weights["weight"]
+            )
+        # scipy distributions accept arrays of parameters, so compute the means and
+        # 95% intervals of all nodes at once
         if prior_distr == "lognorm":
-            lognorm_func = scipy.stats.lognorm
-            for node in np.arange(num_samples, ts.num_nodes):
-                confidence_intervals[node - num_samples, 0] = np.sum(
-                    span_data.get_weights(node)[num_samples]["descendant_tips"]
-                    * span_data.get_weights(node)[num_samples]["weight"]
-                )
-                confidence_intervals[node - num_samples, 1] = (
-                    2
-                    * Ne
-                    * lognorm_func.mean(
-                        s=np.sqrt(mixture_prior[node, 1]),
-                        scale=np.exp(mixture_prior[node, 0]),
-                    )
-                )
-                confidence_intervals[node - num_samples, 2:4] = (
-                    2
-                    * Ne
-                    * lognorm_func.ppf(
-                        [0.025, 0.975],
-                        s=np.sqrt(mixture_prior[node, 1]),
-                        scale=np.exp(mixture_prior[node, 0]),
-                    )
-                )
+            distr = scipy.stats.lognorm(
+                s=np.sqrt(mixture_prior[nodes, 1]),
+                scale=np.exp(mixture_prior[nodes, 0]),
+            )
         elif prior_distr == "gamma":
-            gamma_func = scipy.stats.gamma
-            for node in np.arange(ts.num_samples, ts.num_nodes):
-                confidence_intervals[node - num_samples, 0] = np.sum(
-                    span_data.get_weights(node)[ts.num_samples]["descendant_tips"]
-                    * span_data.get_weights(node)[ts.num_samples]["weight"]
-                )
-                confidence_intervals[node - num_samples, 1] = (
-                    2
-                    * Ne
-                    * gamma_func.mean(
-                        mixture_prior[node, 0], scale=1 / mixture_prior[node, 1]
-                    )
-                )
-                confidence_intervals[node - num_samples, 2:4] = (
-                    2
-                    * Ne
-                    * gamma_func.ppf(
-                        [0.025, 0.975],
-                        mixture_prior[node, 0],
-                        scale=1 / mixture_prior[node, 1],
-                    )
-                )
+            distr = scipy.stats.gamma(
+                mixture_prior[nodes, 0], scale=1 / mixture_prior[nodes, 1]
+            )
+        else:
+            raise ValueError("Unknown prior distribution {}".format(prior_distr))
+        confidence_intervals[:, 1] = 2 * Ne * distr.mean()
+        confidence_intervals[:, 2] = 2 * Ne * distr.ppf(0.025)
+        confidence_intervals[:, 3] = 2 * Ne * distr.ppf(0.975)
         return confidence_intervals
 
-    def run_multiprocessing(self, inference_func, num_processes=1):
-        inference_func()
+    def run_multiprocessing(
+        self, inference_func, num_processes=1, memory_budget=None, num_cores=None
+    ):
+        inference_func(num_processes, num_cores)
 
-    def inference(self):
+    def evaluate_prior_replicate(self, prior_distr, rec_rate, random_seed):
+        """
+        Simulate a tree sequence and return the results for one prior and seed
+        """
+        Ne = 10000
+        ts = msprime.simulate(
+            sample_size=1000,
+            length=5e5,
+            Ne=Ne,
+            mutation_rate=1e-8,
+            recombination_rate=rec_rate,
+            random_seed=random_seed,
+        )
+
+        confidence_intervals = self.evaluate_prior(ts, Ne, prior_distr)
+        real_ages = ts.tables.nodes.time[ts.num_samples :]
+        return {
+            "in_range": np.sum(
+                np.logical_and(
+                    real_ages < confidence_intervals[:, 3],
+                    real_ages > confidence_intervals[:, 2],
+                )
+            ),
+            "lower_bound": confidence_intervals[:, 2],
+            "upper_bound": confidence_intervals[:, 3],
+            "expectations": confidence_intervals[:, 1],
+            "num_tips": confidence_intervals[:, 0],
+            "real_ages": real_ages,
+            "ts_size": ts.num_nodes - ts.num_samples,
+        }
+
+    def inference(self, num_processes=1, num_cores=None):
         all_results = {
             i: {
                 i: []
@@ -1302,45 +1883,36 @@ class EvaluatePrior(DataGeneration):
             }
             for i in ["Lognormal_0", "Lognormal_1e-8", "Gamma_0", "Gamma_1e-8"]
         }
+        random_seeds = range(1, 11)
 
-        for prior, (prior_distr, rec_rate) in tqdm(
-            zip(
-                all_results.keys(),
-                [("lognorm", 0), ("lognorm", 1e-8), ("gamma", 0), ("gamma", 1e-8)],
-            ),
-            desc="Evaluating Priors",
-            total=4,
+        # Each (prior, seed) combination is independent
+        tasks = []
+        for prior, (prior_distr, rec_rate) in zip(
+            all_results.keys(),
+            [("lognorm", 0), ("lognorm", 1e-8), ("gamma", 0), ("gamma", 1e-8)],
         ):
-            for i in range(1, 11):
-                Ne = 10000
-                ts = msprime.simulate(
-                    sample_size=1000,
-                    length=5e5,
-                    Ne=Ne,
-                    mutation_rate=1e-8,
-                    recombination_rate=rec_rate,
-                    random_seed=i,
-                )
-
-                confidence_intervals = self.evaluate_prior(ts, Ne, prior_distr)
-                all_results[prior]["in_range"].append(
-                    np.sum(
-                        np.logical_and(
-                            ts.tables.nodes.time[ts.num_samples :]
-                            < confidence_intervals[:, 3],
-                            ts.tables.nodes.time[ts.num_samples :]
-                            > confidence_intervals[:, 2],
-                        )
+            for i in random_seeds:
+                tasks.append(
+                    scheduler.Task(
+                        (prior, i),
+                        self.evaluate_prior_replicate,
+                        (prior_distr, rec_rate, i),
+                        (),
                     )
                 )
-                all_results[prior]["lower_bound"].append(confidence_intervals[:, 2])
-                all_results[prior]["upper_bound"].append(confidence_intervals[:, 3])
-                all_results[prior]["expectations"].append(confidence_intervals[:, 1])
-                all_results[prior]["num_tips"].append(confidence_intervals[:, 0])
-                all_results[prior]["real_ages"].append(
-                    ts.tables.nodes.time[ts.num_samples :]
-                )
-                all_results[prior]["ts_size"].append(ts.num_nodes - ts.num_samples)
+        if num_cores is not None:
+            num_processes, _ = scheduler.plan_parallelism(num_cores, len(tasks))
+        replicates = dict(
+            tqdm(
+                scheduler.run_tasks(tasks, num_processes),
+                desc="Evaluating Priors",
+                total=len(tasks),
+            )
+        )
+        for prior, results in all_results.items():
+            for i in random_seeds:
+                for key, value in replicates[(prior, i)].items():
+                    results[key].append(value)
         pickle.dump(all_results, open("simulated-data/" + self.name + ".csv", "wb"))
 
 
@@ -1350,162 +1922,139 @@ class TsdateAccuracy(DataGeneration):
     """
 
     name = "tsdate_accuracy"
+    queueable = False
 
     def setup(self):
         pass
 
-    def inference(self):
-        parameters_arr = [1e-9, 1e-8, 1e-7]
-
+    def accuracy_replicate(self, param, random_seed):
+        """
+        Simulate a tree sequence with mutation rate param, date it (and the tree
+        sequence inferred from it) with both tsdate methods, and return the
+        mutation ages and KC distances to the simulated trees
+        """
         Ne = 10000
-
-        simulated = []
-        io = []
-        inferred_io = []
-        maximized = []
-        inferred_max = []
-
-        io_kc = []
-        max_kc = []
-        inferred_io_kc = []
-        inferred_max_kc = []
-
         mutation_rate = 1e-8
         recombination_rate = 1e-8
+        ts = msprime.simulate(
+            sample_size=500,
+            Ne=Ne,
+            length=1e6,
+            mutation_rate=mutation_rate,
+            recombination_rate=recombination_rate,
+            random_seed=random_seed,
+        )
 
-        random_seeds = range(1, 11)
+        mutated_ts = msprime.mutate(ts, rate=param, random_seed=random_seed)
+        sample_data = tsinfer.formats.SampleData.from_tree_sequence(
+            mutated_ts, use_sites_time=False
+        )
+        inferred_ts = tsinfer.infer(sample_data).simplify()
+        io_dated = tsdate.date(
+            mutated_ts, mutation_rate=param, Ne=Ne, method="inside_outside"
+        )
+        max_dated = tsdate.date(
+            mutated_ts, mutation_rate=param, Ne=Ne, method="maximization"
+        )
+        io_inferred_dated = tsdate.date(
+            inferred_ts, mutation_rate=param, Ne=Ne, method="inside_outside"
+        )
+        max_inferred_dated = tsdate.date(
+            inferred_ts, mutation_rate=param, Ne=Ne, method="maximization"
+        )
 
-        for param in tqdm(
-            parameters_arr, desc="Testing tsdate accuracy", total=len(parameters_arr)
-        ):
-            simulated_mut_ages = pd.DataFrame(columns=["Simulated Age", "Node"])
-            io_mut_ages = pd.DataFrame(columns=["IO Age", "Node"])
-            inferred_io_mut_ages = pd.DataFrame(columns=["IO Age", "Node"])
-            max_mut_ages = pd.DataFrame(columns=["Max Age", "Node"])
-            inferred_max_mut_ages = pd.DataFrame(columns=["Max Age", "Node"])
-
-            cur_io_kc = []
-            inferred_cur_io_kc = []
-            cur_max_kc = []
-            inferred_cur_max_kc = []
-            for random_seed in random_seeds:
-                ts = msprime.simulate(
-                    sample_size=500,
-                    Ne=Ne,
-                    length=1e6,
-                    mutation_rate=mutation_rate,
-                    recombination_rate=recombination_rate,
-                    random_seed=random_seed,
-                )
+        mut_ages = {
+            "simulated": utility.get_mut_pos_df(
+                mutated_ts, "Simulated Age", mutated_ts.tables.nodes.time
+            ),
+            "io": utility.get_mut_pos_df(
+                io_dated, "IO Age", io_dated.tables.nodes.time
+            ),
+            "maximized": utility.get_mut_pos_df(
+                max_dated, "Max Age", max_dated.tables.nodes.time
+            ),
+            "inferred_io": utility.get_mut_pos_df(
+                io_inferred_dated, "IO Age", io_inferred_dated.tables.nodes.time
+            ),
+            "inferred_max": utility.get_mut_pos_df(
+                max_inferred_dated, "Max Age", max_inferred_dated.tables.nodes.time
+            ),
+        }
+        kc_distances = {
+            "io": mutated_ts.kc_distance(io_dated, lambda_=1),
+            "maximized": mutated_ts.kc_distance(max_dated, lambda_=1),
+            "inferred_io": mutated_ts.kc_distance(io_inferred_dated, lambda_=1),
+            "inferred_max": mutated_ts.kc_distance(max_inferred_dated, lambda_=1),
+        }
+        return mut_ages, kc_distances
 
-                mutated_ts = msprime.mutate(ts, rate=param, random_seed=random_seed)
-                sample_data = tsinfer.formats.SampleData.from_tree_sequence(
-                    mutated_ts, use_sites_time=False
-                )
-                inferred_ts = tsinfer.infer(sample_data).simplify()
-                io_dated = tsdate.date(
-                    mutated_ts, mutation_rate=param, Ne=Ne, method="inside_outside"
-                )
-                max_dated = tsdate.date(
-                    mutated_ts, mutation_rate=param, Ne=Ne, method="maximization"
-                )
-                io_inferred_dated = tsdate.date(
-                    inferred_ts, mutation_rate=param, Ne=Ne, method="inside_outside"
-                )
-                max_inferred_dated = tsdate.date(
-                    inferred_ts, mutation_rate=param, Ne=Ne, method="maximization"
-                )
+    def inference(self, num_processes=1, num_cores=None):
+        parameters_arr = [1e-9, 1e-8, 1e-7]
+        random_seeds = range(1, 11)
 
-                # Get Mut Ages
-                simulated_mut_ages = pd.concat(
-                    [
-                        simulated_mut_ages,
-                        utility.get_mut_pos_df(
-                            mutated_ts, "Simulated Age", mutated_ts.tables.nodes.time
-                        ),
-                    ],
-                    sort=False,
-                )
-                io_mut_ages = pd.concat(
-                    [
-                        io_mut_ages,
-                        utility.get_mut_pos_df(
-                            io_dated, "IO Age", io_dated.tables.nodes.time
-                        ),
-                    ],
-                    sort=False,
-                )
-                max_mut_ages = pd.concat(
-                    [
-                        max_mut_ages,
-                        utility.get_mut_pos_df(
-                            max_dated, "Max Age", max_dated.tables.nodes.time
-                        ),
-                    ],
-                    sort=False,
-                )
-                inferred_io_mut_ages = pd.concat(
-                    [
-                        inferred_io_mut_ages,
-                        utility.get_mut_pos_df(
-                            io_inferred_dated,
-                            "IO Age",
-                            io_inferred_dated.tables.nodes.time,
-                        ),
-                    ],
-                    sort=False,
-                )
-                inferred_max_mut_ages = pd.concat(
-                    [
-                        inferred_max_mut_ages,
-                        utility.get_mut_pos_df(
-                            max_inferred_dated,
-                            "Max Age",
-                            max_inferred_dated.tables.nodes.time,
-                        ),
-                    ],
-                    sort=False,
-                )
+        # Each (mutation rate, seed) combination is independent
+        tasks = [
+            scheduler.Task(
+                (param, random_seed),
+                self.accuracy_replicate,
+                (param, random_seed),
+                (),
+            )
+            for param in parameters_arr
+            for random_seed in random_seeds
+        ]
+        if num_cores is not None:
+            num_processes, _ = scheduler.plan_parallelism(num_cores, len(tasks))
+        replicates = dict(
+            tqdm(
+                scheduler.run_tasks(tasks, num_processes),
+                desc="Testing tsdate accuracy",
+                total=len(tasks),
+            )
+        )
 
-                # Get KC Distances
-                cur_io_kc.append(mutated_ts.kc_distance(io_dated, lambda_=1))
-                inferred_cur_io_kc.append(
-                    mutated_ts.kc_distance(io_inferred_dated, lambda_=1)
-                )
-                cur_max_kc.append(mutated_ts.kc_distance(max_dated, lambda_=1))
-                inferred_cur_max_kc.append(
-                    mutated_ts.kc_distance(max_inferred_dated, lambda_=1)
+        # Concatenate the mutation ages of each mutation rate once, in seed order
+        empty_mut_ages = {
+            "simulated": pd.DataFrame(columns=["Simulated Age", "Node"]),
+            "io": pd.DataFrame(columns=["IO Age", "Node"]),
+            "maximized": pd.DataFrame(columns=["Max Age", "Node"]),
+            "inferred_io": pd.DataFrame(columns=["IO Age", "Node"]),
+            "inferred_max": pd.DataFrame(columns=["Max Age", "Node"]),
+        }
+        mut_ages = {method: [] for method in empty_mut_ages}
+        kc_distances = {method: [] for method in mut_ages if method != "simulated"}
+        for param in parameters_arr:
+            results = [replicates[(param, seed)] for seed in random_seeds]
+            for method, empty in empty_mut_ages.items():
+                mut_ages[method].append(
+                    pd.concat(
+                        [empty] + [ages[method] for ages, _ in results], sort=False
+                    )
                 )
-            simulated.append(simulated_mut_ages)
-            io.append(io_mut_ages)
-            maximized.append(max_mut_ages)
-            inferred_io.append(inferred_io_mut_ages)
-            inferred_max.append(inferred_max_mut_ages)
-
-            io_kc.append(np.mean(cur_io_kc))
-            max_kc.append(np.mean(cur_max_kc))
-            inferred_io_kc.append(np.mean(inferred_cur_io_kc))
-            inferred_max_kc.append(np.mean(inferred_cur_max_kc))
+            for method in kc_distances:
+                kc_distances[method].append(np.mean([kc[method] for _, kc in results]))
 
         pickle.dump(
             [
-                simulated,
-                io,
-                maximized,
-                inferred_io,
-                inferred_max,
-                io_kc,
-                max_kc,
-                inferred_io_kc,
-                inferred_max_kc,
+                mut_ages["simulated"],
+                mut_ages["io"],
+                mut_ages["maximized"],
+                mut_ages["inferred_io"],
+                mut_ages["inferred_max"],
+                kc_distances["io"],
+                kc_distances["maximized"],
+                kc_distances["inferred_io"],
+                kc_distances["inferred_max"],
             ],
             open(
                 "simulated-data/" + self.name + ".mutation_ages.kc_distances.csv", "wb"
             ),
         )
 
-    def run_multiprocessing(self, inference_func, num_processes=1):
-        inference_func()
+    def run_multiprocessing(
+        self, inference_func, num_processes=1, memory_budget=None, num_cores=None
+    ):
+        inference_func(num_processes, num_cores)
 
 
 class TsdateChr20(NeutralSims):
@@ -1515,6 +2064,10 @@ class TsdateChr20(NeutralSims):
 
     name = "tsdate_chr20_accuracy"
 
+    # Inference is run as a single task per replicate
+    inference_tasks = DataGeneration.inference_tasks
+    stage_methods = {"inference": ["tsinfer", "tsdate_infer"]}
+
     def __init__(self):
         DataGeneration.__init__(self)
         self.default_replicates = 1
@@ -1555,9 +2108,12 @@ class TsdateChr20(NeutralSims):
                 row_data["sample_size"],
                 row_data["sample_size"],
             )
-            engine = stdpopsim.get_default_engine()
-            ts = engine.simulate(model, contig, samples, seed=seed)
-            return ts
+            contig_params = {
+                "species": "HomSap",
+                "contig": "chr20",
+                "genetic_map": "HapMapII_GRCh37",
+            }
+            return self.run_stdpopsim(model, contig, samples, seed, contig_params)
 
         def genetic_map_func(row_data, filename):
             pass
@@ -1566,13 +2122,15 @@ class TsdateChr20(NeutralSims):
             self, None, [None], simulate_func, genetic_map_func, row_data
         )
 
-    def inference(self, row_data, num_threads=1, progress=False):
+    def inference(self, row_data, num_threads=None, progress=False):
         index = row_data[0]
         row = row_data[1]
+        if num_threads is None:
+            num_threads = self.num_threads
 
         filename = row["filename"]
         path_to_file = os.path.join(self.data_dir, filename)
-        sim = tskit.load(path_to_file + ".trees")
+        sim = storage.load_ts(path_to_file + ".trees")
 
         sample_data = tsinfer.load(path_to_file + ".samples")
         error_samples = tsinfer.load(path_to_file + ".error.samples")
@@ -1580,80 +2138,126 @@ class TsdateChr20(NeutralSims):
             path_to_file + ".ancestral_state.error.samples"
         )
 
+        # Stages are memoized on their sample file, method and parameters, so
+        # that rerunning inference skips any stage which has already been run
+        stage_cache = simcache.StageCache(self.stage_cache_dir)
+        tsdate_params = {"mutation_rate": row["mutation_rate"], "Ne": int(row["Ne"])}
+        mismatch_params = {
+            "genetic_map": "chr20",
+            "ma_mismatch": 0.1,
+            "ms_mismatch": 0.1,
+        }
+        iterate_params = {"mismatch": mismatch_params, "sites_time": tsdate_params}
+
+        def date(ts):
+            return tsdate.date(
+                ts,
+                mutation_rate=row["mutation_rate"],
+                Ne=int(row["Ne"]),
+                num_threads=num_threads,
+                progress=progress,
+            )
+
         print("Dating Simulated Tree Sequence")
-        dated = tsdate.date(
-            sim, mutation_rate=1e-8, Ne=int(row["Ne"]), progress=progress
+        dated = stage_cache.load_or_run(
+            storage.ts_path(path_to_file + ".trees"),
+            "tsdate",
+            dict(tsdate_params, mutation_rate=1e-8),
+            lambda: tsdate.date(
+                sim,
+                mutation_rate=1e-8,
+                Ne=int(row["Ne"]),
+                num_threads=num_threads,
+                progress=progress,
+            ),
         )
-        dated.dump(path_to_file + ".dated.trees")
+        self.dump_ts(dated, path_to_file + ".dated.trees")
 
-        def infer_all_methods(sample_data, name, inferred_dated):
+        def infer_all_methods(sample_data, name, sample_file):
             print("Inferring Tree Sequence")
-            inferred_ts = tsinfer.infer(sample_data, num_threads=1).simplify(
-                filter_sites=False
+            inferred_ts = stage_cache.load_or_run(
+                sample_file,
+                "tsinfer",
+                {"simplify": True},
+                lambda: tsinfer.infer(sample_data, num_threads=num_threads).simplify(
+                    filter_sites=False
+                ),
             )
             print("Dating Inferred Tree Sequence")
-            inferred_dated = tsdate.date(
-                inferred_ts,
-                mutation_rate=row["mutation_rate"],
-                Ne=int(row["Ne"]),
-                progress=progress,
+            inferred_dated = stage_cache.load_or_run(
+                sample_file,
+                "tsinfer_tsdate",
+                tsdate_params,
+                lambda: date(inferred_ts),
             )
             print("Inferring TS with Mismatch")
-            mismatch_simplified_inferred_ts = evaluation.infer_with_mismatch(
-                sample_data, "chr20", num_threads=1
+            mismatch_simplified_inferred_ts = stage_cache.load_or_run(
+                sample_file,
+                "tsinfer_mismatch",
+                mismatch_params,
+                lambda: evaluation.infer_with_mismatch(
+                    sample_data, "chr20", num_threads=num_threads
+                ),
             )
             print("Dating Mismatched TS")
-            mismatch_inferred_dated = tsdate.date(
-                mismatch_simplified_inferred_ts,
-                mutation_rate=row["mutation_rate"],
-                Ne=int(row["Ne"]),
-                progress=progress,
+            mismatch_inferred_dated = stage_cache.load_or_run(
+                sample_file,
+                "tsinfer_mismatch_tsdate",
+                tsdate_params,
+                lambda: date(mismatch_simplified_inferred_ts),
             )
 
-            copy = sample_data.copy()
-            sites_time = tsdate.get_sites_time(inferred_dated)
-            sites_time[sites_time > 1] = np.round(sites_time[sites_time > 1])
-            copy.sites_time[:] = sites_time
-            copy.finalise()
+            def reinfer():
+                copy = sample_data.copy()
+                sites_time = tsdate.get_sites_time(inferred_dated)
+                sites_time[sites_time > 1] = np.round(sites_time[sites_time > 1])
+                copy.sites_time[:] = sites_time
+                copy.finalise()
+                return evaluation.infer_with_mismatch(
+                    copy, "chr20", num_threads=num_threads
+                )
+
             print("Reinferring TS")
-            iter_simplified_ts = evaluation.infer_with_mismatch(
-                copy, "chr20", num_threads=1
+            iter_simplified_ts = stage_cache.load_or_run(
+                sample_file,
+                "tsinfer_iterate",
+                iterate_params,
+                reinfer,
             )
             print("Dating Reinferred TS")
-            iter_dated_ts = tsdate.date(
-                iter_simplified_ts,
-                mutation_rate=row["mutation_rate"],
-                Ne=int(row["Ne"]),
-                num_threads=1,
-                progress=progress,
+            iter_dated_ts = stage_cache.load_or_run(
+                sample_file,
+                "tsinfer_iterate_tsdate",
+                dict(iterate_params, tsdate=tsdate_params),
+                lambda: date(iter_simplified_ts),
             )
 
-            inferred_dated.dump(path_to_file + name + ".inferred.dated.trees")
-            mismatch_inferred_dated.dump(
-                path_to_file + name + ".mismatch.inferred.dated.trees"
+            self.dump_ts(inferred_dated, path_to_file + name + ".inferred.dated.trees")
+            self.dump_ts(
+                mismatch_inferred_dated,
+                path_to_file + name + ".mismatch.inferred.dated.trees",
+            )
+            self.dump_ts(
+                iter_dated_ts, path_to_file + name + ".iter.mismatch.dated.trees"
             )
-            iter_dated_ts.dump(path_to_file + name + ".iter.mismatch.dated.trees")
             return inferred_dated, mismatch_inferred_dated, iter_dated_ts
 
         inferred_dated, mismatch_inferred_dated, iter_dated_ts = infer_all_methods(
-            sample_data, "", inferred_dated
+            sample_data, "", path_to_file + ".samples"
         )
         (
             error_inferred_dated,
             error_mismatch_inferred_dated,
             error_iter_dated_ts,
-        ) = infer_all_methods(error_samples, ".error", error_inferred_dated)
+        ) = infer_all_methods(error_samples, ".error", path_to_file + ".error.samples")
         (
             anc_error_inferred_dated,
             anc_error_mismatch_inferred_dated,
             anc_error_iter_dated_ts,
-        ) = infer_all_methods(anc_error_samples, ".anc_error", anc_error_inferred_dated)
-        iter_dated_ts = infer_all_methods(sample_data, "", inferred_dated)
-        error_iter_dated_ts = infer_all_methods(
-            error_samples, ".error", error_inferred_dated
-        )
-        anc_error_iter_dated_ts = infer_all_methods(
-            anc_error_samples, ".anc_error", anc_error_inferred_dated
+        ) = infer_all_methods(
+            anc_error_samples,
+            ".anc_error",
+            path_to_file + ".ancestral_state.error.samples",
         )
 
         ts_dict = {
@@ -1699,25 +2303,33 @@ class TsdateChr20(NeutralSims):
         }
 
         mut_df = evaluation.compare_mutations(
-            list(no_error.values()), list(no_error.keys())
+            list(no_error.values()),
+            list(no_error.keys()),
+            parquet_path=self.mutations_parquet_path(path_to_file),
         )
         error_mut_df = evaluation.compare_mutations(
-            list(error.values()), list(error.keys())
+            list(error.values()),
+            list(error.keys()),
+            parquet_path=self.mutations_parquet_path(path_to_file + ".error"),
         )
         anc_error_mut_df = evaluation.compare_mutations(
-            list(anc_error.values()), list(anc_error.keys())
+            list(anc_error.values()),
+            list(anc_error.keys()),
+            parquet_path=self.mutations_parquet_path(
+                path_to_file + ".ancestral_state.error"
+            ),
         )
         print("Starting KC No Error")
-        kc_df = evaluation.get_kc_distances(
-            list(no_error.values()), list(no_error.keys())
+        kc_df = self.get_kc_distances(
+            list(no_error.values()), list(no_error.keys()), num_threads
         )
         print("Starting KC Error")
-        error_kc_df = evaluation.get_kc_distances(
-            list(error.values()), list(error.keys())
+        error_kc_df = self.get_kc_distances(
+            list(error.values()), list(error.keys()), num_threads
         )
         print("Starting KC Ancestral State Error")
-        anc_error_kc_df = evaluation.get_kc_distances(
-            list(anc_error.values()), list(anc_error.keys())
+        anc_error_kc_df = self.get_kc_distances(
+            list(anc_error.values()), list(anc_error.keys()), num_threads
         )
         return_vals = {
             "muts_noerr": mut_df,
@@ -1736,11 +2348,146 @@ def get_subclasses(cls):
         yield subclass
 
 
+def run_worker(argv, name_map):
+    """
+    Run inference tasks enqueued with --enqueue, from any figure
+    """
+    parser = argparse.ArgumentParser(
+        prog="run_evaluation.py worker",
+        description="Run inference tasks from a work queue shared between nodes.",
+    )
+    parser.add_argument(
+        "--queue-dir",
+        default=os.path.join("simulated-data", "queue"),
+        help="directory of the work queue, on a filesystem shared by all workers",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1, help="tsinfer and tsdate threads per task"
+    )
+    parser.add_argument(
+        "--heartbeat",
+        type=float,
+        default=30,
+        help="seconds between updates of the claimed task file",
+    )
+    parser.add_argument(
+        "--stale-after",
+        type=float,
+        default=600,
+        help="seconds without a heartbeat after which a claimed task is requeued",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=10,
+        help="seconds to wait before looking for tasks again when none can be run",
+    )
+    parser.add_argument(
+        "--exit-when-idle",
+        action="store_true",
+        default=False,
+        help="exit once no tasks are left to run, rather than waiting for more",
+    )
+    parser.add_argument(
+        "--kc-mode",
+        choices=["exact", "sampled"],
+        default="exact",
+        help="compute exact KC distances, or estimate them with confidence "
+        "intervals from the trees at --kc-positions random positions, which is "
+        "much faster on chromosome-scale simulations",
+    )
+    parser.add_argument(
+        "--kc-positions",
+        type=int,
+        default=1000,
+        help="number of positions sampled with --kc-mode sampled",
+    )
+    parser.add_argument(
+        "--mutations-parquet",
+        action="store_true",
+        default=False,
+        help="also write the mutation ages compared on each sample file to a "
+        "Parquet file next to it, ending in .mutations.parquet",
+    )
+    args = parser.parse_args(argv)
+
+    work_queue = workqueue.WorkQueue(args.queue_dir, args.heartbeat, args.stale_after)
+    logging.basicConfig(
+        filename="simulated-data/worker." + work_queue.worker_id + ".log",
+        filemode="w",
+        level=logging.DEBUG,
+    )
+    figs = {}
+
+    def run_task(info):
+        name = info["name"]
+        fig = figs.get(name)
+        # Reload the replicates if the figure has been set up again
+        if fig is None or fig.data_mtime != os.path.getmtime(fig.data_file):
+            fig = name_map[name]()
+            fig.num_threads = args.threads
+            fig.kc_mode = args.kc_mode
+            fig.kc_positions = args.kc_positions
+            fig.mutations_parquet = args.mutations_parquet
+            fig.data_mtime = os.path.getmtime(fig.data_file)
+            fig.data = pd.read_csv(fig.data_file)
+            figs[name] = fig
+        return fig.run_queued_task(info["key"])
+
+    work_queue.work(run_task, args.poll_interval, args.exit_when_idle)
+
+
+def run_figure(fig, args, memory_budget):
+    if args.dry_run:
+        if fig.queueable:
+            fig.dry_run(args.processes, args.cores)
+        else:
+            print("{}: no per-replicate tasks to estimate".format(fig.name))
+        return
+    fig.simulate_snippet_only = args.snippet_only
+    fig.kc_mode = args.kc_mode
+    fig.kc_positions = args.kc_positions
+    fig.mutations_parquet = args.mutations_parquet
+    if args.no_simulation_cache:
+        fig.simulation_cache = None
+        fig.stage_cache_dir = None
+    if (args.enqueue or args.collect) and not fig.queueable:
+        raise ValueError("{} cannot be run from the work queue".format(fig.name))
+    if args.in_memory and (args.enqueue or args.collect):
+        raise ValueError("--in-memory cannot be used with the work queue")
+    if args.in_memory:
+        fig.run_in_memory(
+            args.processes, memory_budget, args.cores, args.save_simulations
+        )
+        return
+    if args.setup:
+        fig.setup()
+    if args.enqueue:
+        fig.enqueue(workqueue.WorkQueue(args.queue_dir))
+    if args.collect:
+        fig.work_queue = workqueue.WorkQueue(args.queue_dir)
+    if args.inference or args.collect:
+        fig.run_multiprocessing(
+            fig.inference,
+            num_processes=args.processes,
+            memory_budget=memory_budget,
+            num_cores=args.cores,
+        )
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark.main(sys.argv[2:])
+        return
+
     figures = get_subclasses(DataGeneration)
     figures = list(get_subclasses(DataGeneration))
     name_map = {fig.name: fig for fig in figures if fig.name is not None}
 
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        run_worker(sys.argv[2:], name_map)
+        return
+
     parser = argparse.ArgumentParser(description="Generate the data for a figure.")
     parser.add_argument(
         "name",
@@ -1762,8 +2509,100 @@ def main():
         default=1,
         help="number of worker processes, e.g. 40",
     )
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=None,
+        help="total number of cores to divide between worker processes and "
+        "tsinfer/tsdate threads, overriding --processes, e.g. 64",
+    )
+    parser.add_argument(
+        "--no-simulation-cache",
+        action="store_true",
+        default=False,
+        help="always rerun simulations and inference stages rather than reusing "
+        "identical runs stored in simulated-data/simulation_cache and "
+        "simulated-data/stage_cache",
+    )
+    parser.add_argument(
+        "--snippet-only",
+        action="store_true",
+        default=False,
+        help="in chr20_sims, simulate only the region used for inference rather "
+        "than the whole chromosome",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        help="total memory in gigabytes for concurrently running tasks, estimated "
+        "from earlier cpu_scaling runs, e.g. 256",
+    )
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        default=False,
+        help="run setup and inference of each replicate together, without writing "
+        "intermediate files (for small experiments such as tsdate_neutral_sims)",
+    )
+    parser.add_argument(
+        "--save-simulations",
+        action="store_true",
+        default=False,
+        help="with --in-memory, also save the simulated tree sequences",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="print the predicted core-hours and peak memory of inference, "
+        "estimated from earlier cpu_scaling runs, without running anything",
+    )
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        default=False,
+        help="write the inference tasks to the work queue, to be run by any number "
+        "of `run_evaluation.py worker` processes",
+    )
+    parser.add_argument(
+        "--collect",
+        action="store_true",
+        default=False,
+        help="wait for the enqueued inference tasks to be run by workers and "
+        "summarise their results",
+    )
+    parser.add_argument(
+        "--queue-dir",
+        default=os.path.join("simulated-data", "queue"),
+        help="directory of the work queue, on a filesystem shared by all workers",
+    )
+    parser.add_argument(
+        "--kc-mode",
+        choices=["exact", "sampled"],
+        default="exact",
+        help="compute exact KC distances, or estimate them with confidence "
+        "intervals from the trees at --kc-positions random positions, which is "
+        "much faster on chromosome-scale simulations",
+    )
+    parser.add_argument(
+        "--kc-positions",
+        type=int,
+        default=1000,
+        help="number of positions sampled with --kc-mode sampled",
+    )
+    parser.add_argument(
+        "--mutations-parquet",
+        action="store_true",
+        default=False,
+        help="also write the mutation ages compared on each sample file to a "
+        "Parquet file next to it, ending in .mutations.parquet",
+    )
 
     args = parser.parse_args()
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = args.memory_budget * 1024 ** 3
 
     logging.basicConfig(
         filename="simulated-data/" + args.name + ".log",
@@ -1773,20 +2612,25 @@ def main():
     if args.name == "all":
         for _, fig in name_map.items():
             if fig in figures:
-                fig = fig()
-                if args.setup:
-                    fig.setup()
-                if args.inference:
-                    fig.run_multiprocessing(fig.inference, num_processes=args.processes)
+                if (args.enqueue or args.collect) and not fig.queueable:
+                    continue
+                if args.in_memory and not fig.in_memory_inputs:
+                    continue
+                run_figure(fig(), args, memory_budget)
 
     else:
-        fig = name_map[args.name]()
-        if args.setup:
-            fig.setup()
-        if args.inference:
-            fig.run_multiprocessing(fig.inference, args.processes)
-    if not args.setup and not args.inference:
-        raise ValueError("must run with --setup, --inference, or both.")
+        run_figure(name_map[args.name](), args, memory_budget)
+    if not (
+        args.setup
+        or args.inference
+        or args.enqueue
+        or args.collect
+        or args.dry_run
+        or args.in_memory
+    ):
+        raise ValueError(
+            "must run with --setup, --inference, --in-memory, --enqueue or --collect."
+        )
 
 
 if __name__ == "__main__":
@@ -30,6 +30,9 @@ def main():
     parser.add_argument(
         "--mutation-rate", default=1e-8, type=float,
         help="Mutation rate")
+    parser.add_argument(
+        "-t", "--threads", default=1, type=int,
+        help="The number of worker threads to use")
     parser.add_argument(
         "-V", "--version", action='version', version=description)
 
@@ -40,7 +43,8 @@ def main():
     input_ts = tskit.load(args.input)
     prior = tsdate.build_prior_grid(input_ts, approximate_priors=True)
     ts = tsdate.date(
-        input_ts, args.Ne, mutation_rate=args.mutation_rate, priors=prior)
+        input_ts, args.Ne, mutation_rate=args.mutation_rate, priors=prior,
+        num_threads=args.threads)
     ts.dump(args.output)
 
 
@@ -0,0 +1,169 @@
+"""
+Dependency-aware scheduling of evaluation tasks over a multiprocessing pool.
+Each task is run once all the tasks it depends on have finished, so independent
+method runs from different replicates can share the available cores.
+"""
+import collections
+import logging
+import multiprocessing
+import queue
+
+
+# The memory of a task is its estimated peak memory use in bytes, and its cost is
+# its estimated CPU time in seconds (both 0 if unknown)
+Task = collections.namedtuple(
+    "Task", ["key", "func", "args", "depends", "memory", "cost"], defaults=[0, 0]
+)
+
+
+def topological_order(tasks):
+    """
+    Return the tasks in an order where every task comes after its dependencies.
+    Raises a ValueError if a dependency is missing or the tasks contain a cycle.
+    """
+    by_key = {}
+    for task in tasks:
+        if task.key in by_key:
+            raise ValueError("Duplicate task key {}".format(task.key))
+        by_key[task.key] = task
+    for task in tasks:
+        for dep in task.depends:
+            if dep not in by_key:
+                raise ValueError("Task {} depends on unknown {}".format(task.key, dep))
+
+    ordered = []
+    num_waiting = {task.key: len(task.depends) for task in tasks}
+    dependents = collections.defaultdict(list)
+    for task in tasks:
+        for dep in task.depends:
+            dependents[dep].append(task.key)
+    ready = collections.deque(task.key for task in tasks if not task.depends)
+    while ready:
+        key = ready.popleft()
+        ordered.append(by_key[key])
+        for child in dependents[key]:
+            num_waiting[child] -= 1
+            if num_waiting[child] == 0:
+                ready.append(child)
+    if len(ordered) != len(tasks):
+        raise ValueError("Task dependencies contain a cycle")
+    return ordered
+
+
+def critical_path_costs(tasks):
+    """
+    Return a dict mapping the key of each task to the total cost of the most costly
+    chain of tasks starting with it, i.e. a lower bound on the time until all the
+    tasks depending on it have finished
+    """
+    ordered = topological_order(tasks)
+    dependents = collections.defaultdict(list)
+    for task in ordered:
+        for dep in task.depends:
+            dependents[dep].append(task.key)
+    path_costs = {}
+    for task in reversed(ordered):
+        path_costs[task.key] = task.cost + max(
+            [path_costs[child] for child in dependents[task.key]], default=0
+        )
+    return path_costs
+
+
+def run_serial(tasks):
+    """
+    Run the tasks one after another in the current process, yielding
+    (key, result) tuples in dependency order.
+    """
+    for task in topological_order(tasks):
+        yield task.key, task.func(*task.args)
+
+
+def run_tasks(tasks, num_processes=1, memory_budget=None, maxtasksperchild=10):
+    """
+    Run a DAG of tasks across a pool of worker processes, yielding (key, result)
+    tuples as tasks complete. A task is started as soon as every task it depends on
+    has finished and a worker is free. Ready tasks are started longest first, by the
+    cost of the longest chain of tasks they start, so that long tasks do not hold up
+    the end of the run. If memory_budget (in bytes) is given, a task is only started
+    while the estimated memory of all running tasks stays within the budget, so
+    smaller tasks fill the free workers while large ones wait. A task larger than the
+    whole budget is run on its own.
+    """
+    ordered = topological_order(tasks)
+    if num_processes <= 1:
+        # When we have only one process it's easier to keep everything in the
+        # same process for debugging.
+        yield from run_serial(ordered)
+        return
+
+    by_key = {task.key: task for task in ordered}
+    num_waiting = {task.key: len(task.depends) for task in ordered}
+    dependents = collections.defaultdict(list)
+    for task in ordered:
+        for dep in task.depends:
+            dependents[dep].append(task.key)
+    path_costs = critical_path_costs(ordered)
+    ready = [task.key for task in ordered if not task.depends]
+    finished = queue.Queue()
+    running = {}
+
+    def fits(task):
+        if len(running) == 0 or memory_budget is None:
+            return True
+        return sum(running.values()) + task.memory <= memory_budget
+
+    with multiprocessing.Pool(
+        processes=num_processes, maxtasksperchild=maxtasksperchild
+    ) as pool:
+
+        def submit(key):
+            task = by_key[key]
+            logging.debug("Submitting task {}".format(key))
+            running[key] = task.memory
+            pool.apply_async(
+                task.func,
+                task.args,
+                callback=lambda result: finished.put((key, result, None)),
+                error_callback=lambda error: finished.put((key, None, error)),
+            )
+
+        num_done = 0
+        while num_done < len(ordered):
+            ready.sort(key=lambda key: -path_costs[key])
+            for key in list(ready):
+                if len(running) == num_processes:
+                    break
+                if fits(by_key[key]):
+                    ready.remove(key)
+                    submit(key)
+            key, result, error = finished.get()
+            del running[key]
+            num_done += 1
+            if error is not None:
+                raise error
+            for child in dependents[key]:
+                num_waiting[child] -= 1
+                if num_waiting[child] == 0:
+                    ready.append(child)
+            yield key, result
+
+
+def num_ready(tasks):
+    """
+    Return the number of tasks that can be started straight away, i.e. that have
+    no dependencies
+    """
+    return sum(1 for task in tasks if len(task.depends) == 0)
+
+
+def plan_parallelism(num_cores, num_tasks):
+    """
+    Divide num_cores between worker processes and the threads used by tsinfer and
+    tsdate within each process. The num_tasks independent tasks (e.g. replicates)
+    are run in parallel first, and any cores left over are given to the threads of
+    each process, so that an experiment with a single large replicate can still
+    use the whole machine. Returns a tuple of (num_processes, num_threads).
+    """
+    num_processes = max(1, min(num_cores, num_tasks))
+    num_threads = max(1, num_cores // num_processes)
+    return num_processes, num_threads
@@ -0,0 +1,108 @@
+"""
+Content-addressed cache of simulated tree sequences, shared between evaluations.
+Simulations are keyed by a hash of their parameters (including the random seed and
+simulator version) and stored compressed with tszip. The same store is used to
+memoize the output of inference stages run on a sample file.
+"""
+import hashlib
+import json
+import numbers
+import os
+
+import numpy as np
+import tsdate
+import tsinfer
+import tszip
+
+
+def canonical(value):
+    """
+    Convert simulation parameters to plain JSON types. Numbers with integral
+    values are stored as ints, so that e.g. a length of 5e6 and 5000000 give the
+    same key.
+    """
+    if isinstance(value, dict):
+        return {str(k): canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [canonical(v) for v in value]
+    if isinstance(value, (bool, np.bool_)) or value is None:
+        return value
+    if isinstance(value, numbers.Number):
+        if float(value).is_integer():
+            return int(value)
+        return float(value)
+    return str(value)
+
+
+def simulation_key(params):
+    """
+    Return the hash identifying the simulation described by params
+    """
+    encoded = json.dumps(canonical(params), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class SimulationCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".trees.tsz")
+
+    def load_or_simulate(self, params, simulate):
+        """
+        Return the cached simulation described by params, running simulate() and
+        storing its result if it has not been cached yet
+        """
+        key = simulation_key(params)
+        path = self.path(key)
+        if os.path.exists(path):
+            return tszip.decompress(path)
+        ts = simulate()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so concurrent setups never see a
+        # partially written simulation
+        tmp_path = path + ".{}.tmp".format(os.getpid())
+        tszip.compress(ts, tmp_path)
+        with open(os.path.join(os.path.dirname(path), key + ".json"), "w") as f:
+            json.dump(canonical(params), f, sort_keys=True, indent=2)
+        os.replace(tmp_path, path)
+        return ts
+
+
+class StageCache(SimulationCache):
+    """
+    Memoizes the tree sequences output by inference stages, keyed on the sample
+    file they were run on, the method and its parameters. Results are kept in
+    memory and, if cache_dir is not None, also stored on disk so that they can be
+    reused by later runs. The size and modification time of the sample file are
+    part of the key, so rerunning the setup invalidates the stored results.
+    """
+
+    def __init__(self, cache_dir=None):
+        super().__init__(cache_dir)
+        self.memory = {}
+
+    def load_or_run(self, sample_file, method, params, run):
+        """
+        Return the output of method run on sample_file with params, calling run()
+        if it has not been cached yet
+        """
+        stat = os.stat(sample_file)
+        stage_params = {
+            "sample_file": os.path.abspath(sample_file),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "method": method,
+            "params": params,
+            # Stages are rerun when the inference tools are upgraded
+            "tsinfer_version": tsinfer.__version__,
+            "tsdate_version": tsdate.__version__,
+        }
+        key = simulation_key(stage_params)
+        if key not in self.memory:
+            if self.cache_dir is None:
+                self.memory[key] = run()
+            else:
+                self.memory[key] = self.load_or_simulate(stage_params, run)
+        return self.memory[key]
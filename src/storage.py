@@ -0,0 +1,61 @@
+"""
+Reading and writing of simulated-data files. Tree sequences can be compressed with
+tszip and VCFs with bgzip; loading picks the compressed file if it exists, so code
+can keep referring to files by their uncompressed names.
+"""
+import os
+import subprocess
+
+import tskit
+import tszip
+
+TSZ_SUFFIX = ".tsz"
+
+
+def dump_ts(ts, path, compress=True):
+    """
+    Save ts to path, or to path + ".tsz" compressed with tszip if compress is True
+    """
+    if compress:
+        tszip.compress(ts, path + TSZ_SUFFIX)
+    else:
+        ts.dump(path)
+
+
+def ts_path(path):
+    """
+    Return the path of the tree sequence saved to path by dump_ts(), preferring the
+    compressed file if present
+    """
+    if not path.endswith(TSZ_SUFFIX) and os.path.exists(path + TSZ_SUFFIX):
+        return path + TSZ_SUFFIX
+    return path
+
+
+def load_ts(path):
+    """
+    Load a tree sequence saved by dump_ts(), whether or not it was compressed
+    """
+    path = ts_path(path)
+    if path.endswith(TSZ_SUFFIX):
+        return tszip.decompress(path)
+    return tskit.load(path)
+
+
+def compress_vcf(path):
+    """
+    Compress the VCF at path with bgzip, replacing the original, and index it with
+    tabix. Requires htslib (see tools/Makefile) on the path.
+    """
+    subprocess.check_call(["bgzip", "-f", path])
+    subprocess.check_call(["tabix", "-f", "-p", "vcf", path + ".gz"])
+    return path + ".gz"
+
+
+def vcf_path(prefix):
+    """
+    Return the path of the VCF for prefix, preferring the bgzipped file if present
+    """
+    if os.path.exists(prefix + ".vcf.gz"):
+        return prefix + ".vcf.gz"
+    return prefix + ".vcf"
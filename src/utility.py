@@ -50,7 +50,12 @@ def sites_time_from_ts(
     return sites_time
 
 
-def get_mut_pos_df(ts, name, node_dates, mutation_age="arithmetic", exclude_root=False):
+def get_mut_pos_ages(ts, mutation_age="arithmetic", exclude_root=False):
+    """
+    Return arrays of the positions of the sites in ts, rounded to integers, and their
+    estimated ages. Sites which round to the same position as an earlier site are
+    dropped, so positions are unique and sorted.
+    """
     if mutation_age == "uniform":
         child_times = tsdate.sites_time_from_ts(
             ts, mutation_age="child", unconstrained=False, eps=0
@@ -68,13 +73,63 @@ def get_mut_pos_df(ts, name, node_dates, mutation_age="arithmetic", exclude_root
             sites_time = tsdate.sites_time_from_ts(
                 ts, mutation_age=mutation_age, unconstrained=False, eps=0
             )
-    positions = ts.tables.sites.position
-    mut_dict = dict(zip(positions, sites_time))
-    mut_df = pd.DataFrame.from_dict(mut_dict, orient="index", columns=[name])
-    mut_df.index = (np.round(mut_df.index)).astype(int)
-    # Remove duplicates
-    mut_df = mut_df[~mut_df.index.duplicated(keep="first")]
-    return mut_df
+    positions = np.round(ts.tables.sites.position).astype(int)
+    positions, first = np.unique(positions, return_index=True)
+    return positions, sites_time[first]
+
+
+def get_mut_pos_df(ts, name, node_dates, mutation_age="arithmetic", exclude_root=False):
+    positions, sites_time = get_mut_pos_ages(ts, mutation_age, exclude_root)
+    return pd.DataFrame({name: sites_time}, index=positions)
+
+
+def mutation_num_samples(ts):
+    """
+    Return the number of samples below the node of each mutation in ts, from one
+    pass over the trees
+    """
+    tables = ts.tables
+    mutations_position = tables.sites.position[tables.mutations.site]
+    nodes = tables.mutations.node
+    num_samples = np.zeros(ts.num_mutations, dtype=int)
+    # Mutations are sorted by position, so those in each tree are contiguous
+    bounds = np.searchsorted(mutations_position, list(ts.breakpoints()))
+    for tree, start, end in zip(ts.trees(), bounds[:-1], bounds[1:]):
+        num_samples[start:end] = [tree.num_samples(u) for u in nodes[start:end]]
+    return num_samples
+
+
+def derived_allele_frequencies(ts, num_samples=None):
+    """
+    Return the fraction of samples carrying a derived (non-ancestral) state at each
+    site of ts, computed from the number of samples below each mutation (see
+    mutation_num_samples()) rather than by decoding genotypes. Samples below a later
+    mutation at the same site take that mutation's state.
+    """
+    if num_samples is None:
+        num_samples = mutation_num_samples(ts)
+    tables = ts.tables
+    mutations = tables.mutations
+    # Samples whose closest mutation above them is each mutation
+    has_parent = mutations.parent != tskit.NULL
+    carriers = num_samples - np.bincount(
+        mutations.parent[has_parent],
+        weights=num_samples[has_parent],
+        minlength=ts.num_mutations,
+    )
+    ancestral_states = np.array(
+        tskit.unpack_strings(
+            tables.sites.ancestral_state, tables.sites.ancestral_state_offset
+        )
+    )
+    derived_states = np.array(
+        tskit.unpack_strings(mutations.derived_state, mutations.derived_state_offset)
+    )
+    derived = derived_states != ancestral_states[mutations.site]
+    site_carriers = np.bincount(
+        mutations.site[derived], weights=carriers[derived], minlength=ts.num_sites
+    )
+    return site_carriers / ts.num_samples
 
 
 def weighted_geographic_center(lat_list, long_list, weights):
@@ -0,0 +1,210 @@
+"""
+Work queue on a shared filesystem, for running evaluation tasks on several nodes
+without a job broker. Each task is a small JSON file which moves between the
+pending, claimed, done and failed directories of the queue. Workers claim a task by
+renaming it into the claimed directory, which is atomic so only one worker can
+succeed, and touch the claimed file while the task runs. Tasks whose claimed file
+has not been touched for a while are assumed to belong to a dead worker and are
+moved back to pending. Task results are pickled into the results directory.
+"""
+import json
+import logging
+import os
+import pickle
+import socket
+import threading
+import time
+import traceback
+
+import simcache
+
+STATES = ["pending", "claimed", "done", "failed", "results"]
+
+
+def task_name(name, key):
+    """
+    Return the file name (without extension) of the task with key for the
+    evaluation called name
+    """
+    return "-".join([name] + [str(k) for k in key]).replace(os.sep, "_")
+
+
+class WorkQueue:
+    def __init__(self, queue_dir, heartbeat=30, stale_after=600):
+        self.queue_dir = queue_dir
+        # Seconds between touches of a running task's file, and the time after
+        # which a claimed task without a touch is requeued
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.worker_id = "{}.{}".format(socket.gethostname(), os.getpid())
+        for state in STATES:
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+    def path(self, state, task, suffix=".json"):
+        return os.path.join(self.queue_dir, state, task + suffix)
+
+    def enqueue(self, name, tasks):
+        """
+        Write a pending task file for each scheduler task of the evaluation called
+        name. Tasks which are already done are skipped, so an interrupted run can be
+        enqueued again.
+        """
+        num_enqueued = 0
+        for task in tasks:
+            filename = task_name(name, task.key)
+            if os.path.exists(self.path("done", filename)):
+                continue
+            for suffix in [".json", ".txt"]:
+                if os.path.exists(self.path("failed", filename, suffix)):
+                    os.remove(self.path("failed", filename, suffix))
+            info = {
+                "name": name,
+                "key": simcache.canonical(task.key),
+                "depends": [task_name(name, dep) for dep in task.depends],
+            }
+            tmp_path = self.path("pending", filename, ".json.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(info, f)
+            os.replace(tmp_path, self.path("pending", filename))
+            num_enqueued += 1
+        logging.info("Enqueued {} tasks for {}".format(num_enqueued, name))
+        return num_enqueued
+
+    def list(self, state):
+        return sorted(
+            filename[: -len(".json")]
+            for filename in os.listdir(os.path.join(self.queue_dir, state))
+            if filename.endswith(".json")
+        )
+
+    def last_heartbeat(self, path):
+        # Renaming a file changes its ctime but not its mtime, so a freshly
+        # claimed task is not mistaken for a stale one
+        stat = os.stat(path)
+        return max(stat.st_mtime, stat.st_ctime)
+
+    def requeue_stale(self):
+        """
+        Move tasks claimed by workers which have stopped sending heartbeats back to
+        pending
+        """
+        for task in self.list("claimed"):
+            path = self.path("claimed", task)
+            try:
+                if time.time() - self.last_heartbeat(path) < self.stale_after:
+                    continue
+                os.rename(path, self.path("pending", task))
+                logging.warning("Requeued stale task {}".format(task))
+            except FileNotFoundError:
+                # Finished or requeued by another worker in the meantime
+                pass
+
+    def claim(self):
+        """
+        Claim a pending task whose dependencies are all done, returning its name and
+        contents, or None if there is no such task
+        """
+        done = set(self.list("done"))
+        for task in self.list("pending"):
+            path = self.path("pending", task)
+            if task in done:
+                # A task requeued while its worker was still running it
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    info = json.load(f)
+            except FileNotFoundError:
+                continue
+            if not all(dep in done for dep in info["depends"]):
+                continue
+            try:
+                os.rename(path, self.path("claimed", task))
+            except FileNotFoundError:
+                # Claimed by another worker first
+                continue
+            os.utime(self.path("claimed", task))
+            info["key"] = tuple(info["key"])
+            return task, info
+        return None
+
+    def run(self, task, info, run_task):
+        """
+        Run a claimed task, touching its file every heartbeat seconds, and store its
+        result
+        """
+        claimed_path = self.path("claimed", task)
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat):
+                try:
+                    os.utime(claimed_path)
+                except FileNotFoundError:
+                    logging.warning("Task {} was requeued while running".format(task))
+
+        heart = threading.Thread(target=beat, daemon=True)
+        heart.start()
+        logging.info("Worker {} running {}".format(self.worker_id, task))
+        try:
+            result = run_task(info)
+        except Exception:
+            stop.set()
+            with open(self.path("failed", task, ".txt"), "w") as f:
+                f.write(traceback.format_exc())
+            self.finish(task, "failed")
+            logging.exception("Task {} failed".format(task))
+            return
+        stop.set()
+        tmp_path = self.path("results", task, ".{}.tmp".format(self.worker_id))
+        with open(tmp_path, "wb") as f:
+            pickle.dump(result, f)
+        os.replace(tmp_path, self.path("results", task, ".pickle"))
+        self.finish(task, "done")
+
+    def finish(self, task, state):
+        try:
+            os.rename(self.path("claimed", task), self.path(state, task))
+        except FileNotFoundError:
+            # Requeued while we were running it; record it as finished anyway
+            with open(self.path(state, task), "w") as f:
+                json.dump({"worker": self.worker_id}, f)
+
+    def work(self, run_task, poll_interval=10, exit_when_idle=False):
+        """
+        Repeatedly claim and run tasks with run_task(info). If exit_when_idle is
+        True, return once no task can be claimed and no other worker is running one
+        (any tasks left pending depend on a failed task).
+        """
+        while True:
+            self.requeue_stale()
+            claimed = self.claim()
+            if claimed is not None:
+                self.run(*claimed, run_task)
+                continue
+            if exit_when_idle and not self.list("claimed"):
+                return
+            time.sleep(poll_interval)
+
+    def results(self, name, keys, poll_interval=10):
+        """
+        Wait for the tasks of the evaluation called name with the given keys, yielding
+        (key, result) tuples as they are done. Raises a RuntimeError if a task failed.
+        """
+        waiting = {task_name(name, key): key for key in keys}
+        while len(waiting) > 0:
+            done = set(self.list("done"))
+            failed = set(self.list("failed"))
+            for task in list(waiting):
+                if task in failed:
+                    with open(self.path("failed", task, ".txt")) as f:
+                        raise RuntimeError("Task {} failed:\n{}".format(task, f.read()))
+                if task in done:
+                    with open(self.path("results", task, ".pickle"), "rb") as f:
+                        result = pickle.load(f)
+                    yield waiting.pop(task), result
+            if len(waiting) > 0:
+                time.sleep(poll_interval)
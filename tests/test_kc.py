@@ -0,0 +1,72 @@
+"""
+Tests for the single-pass KC distances in src/kc.py, against tskit's
+"""
+import os
+import sys
+import unittest
+
+import msprime
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import kc  # noqa: E402
+
+
+def simulate(seed, num_samples=20, sequence_length=2e5):
+    return msprime.sim_ancestry(
+        num_samples,
+        population_size=1e4,
+        sequence_length=sequence_length,
+        recombination_rate=1e-8,
+        random_seed=seed,
+    )
+
+
+def scale_times(ts, factor):
+    tables = ts.dump_tables()
+    tables.nodes.time = tables.nodes.time * factor
+    return tables.tree_sequence()
+
+
+class TestKCDistances(unittest.TestCase):
+    lambdas = (0, 0.25, 0.5, 1)
+
+    def verify(self, ts, others):
+        distances = kc.kc_distances(ts, others, self.lambdas)
+        self.assertEqual(distances.shape, (len(others), len(self.lambdas)))
+        for i, other in enumerate(others):
+            for j, lambda_ in enumerate(self.lambdas):
+                expected = ts.kc_distance(other, lambda_=lambda_)
+                self.assertAlmostEqual(
+                    distances[i, j], expected, delta=1e-9 * max(1, expected)
+                )
+        return distances
+
+    def test_identical(self):
+        ts = simulate(1)
+        distances = self.verify(ts, [ts])
+        self.assertTrue(np.all(distances == 0))
+
+    def test_near_identical(self):
+        ts = simulate(2)
+        self.verify(ts, [scale_times(ts, 1 + 1e-9), scale_times(ts, 1 + 1e-4)])
+
+    def test_unrelated(self):
+        ts = simulate(3)
+        self.verify(ts, [simulate(4), simulate(5)])
+
+    def test_mixed(self):
+        ts = simulate(6)
+        self.verify(ts, [simulate(7), ts, scale_times(ts, 1 + 1e-7)])
+
+    def test_single_tree(self):
+        ts = simulate(8, sequence_length=1)
+        self.verify(ts, [simulate(9, sequence_length=1)])
+
+    def test_different_lengths(self):
+        with self.assertRaises(ValueError):
+            kc.kc_distances(simulate(10), [simulate(11, sequence_length=1e5)])
+
+    def test_different_samples(self):
+        with self.assertRaises(ValueError):
+            kc.kc_distances(simulate(12), [simulate(13, num_samples=10)])